@@ -0,0 +1,263 @@
+"""PBL2.backend.batch
+无界面的批量讨论：从 JSONL 读取病例，不经过 WebSocket 直接运行 graph.app，
+把每个病例的讨论记录逐行写入 JSONL（例如每晚预生成评分校准用的参考讨论）。
+
+    python -m backend.batch cases.jsonl --output discussions.jsonl --concurrency 32 --workers 4
+
+输入每行一个病例：``{"case_id": "c1", "initial_case": "...", "max_turns": 12, "max_tokens": 20000}``，
+max_turns / max_tokens 可选，缺省时使用命令行参数。输出每行一个结果，写完一行立即落盘；
+再次运行同一命令时跳过输出文件中已完成的病例（失败的病例会重跑），因此进程崩溃后可以直接续跑。
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import queue as queue_module
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Set
+
+from tqdm import tqdm
+
+Record = Dict
+
+
+@dataclass
+class Case:
+    """一个待讨论的病例及其限制（None 表示使用命令行的默认值）。"""
+
+    case_id: str
+    initial_case: str
+    max_turns: Optional[int] = None
+    max_tokens: Optional[int] = None
+
+
+def load_cases(path: str) -> List[Case]:
+    """读取病例文件；没有 case_id 的行以行号作为 id。
+
+    case_id 同时决定检查点的 thread_id 与续跑时的去重，重复的 id 会互相覆盖，因此直接报错。
+    """
+    cases = []
+    seen: Dict[str, int] = {}
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            case_id = str(item.get("case_id", f"line-{lineno}"))
+            if case_id in seen:
+                raise ValueError(f"{path}:{lineno}: 病例 id {case_id!r} 与第 {seen[case_id]} 行重复")
+            seen[case_id] = lineno
+            cases.append(Case(
+                case_id=case_id,
+                initial_case=item["initial_case"],
+                max_turns=item.get("max_turns"),
+                max_tokens=item.get("max_tokens"),
+            ))
+    return cases
+
+
+def load_finished(path: str) -> Set[str]:
+    """返回输出文件中已完成（非 error）的病例 id。
+
+    进程在写某一行的中途崩溃时，文件末尾会留下不完整的一行，这里将其截掉，之后的结果从新行开始追加。
+    """
+    finished: Set[str] = set()
+    if not os.path.exists(path):
+        return finished
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            f.truncate(end)
+    for line in data[:end].splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if record.get("status") != "error":
+            finished.add(record["case_id"])
+    return finished
+
+
+# 图状态中用完的预算项 -> 输出记录的 status
+_LIMIT_STATUS = {"max_turns": "turn_limit", "max_tokens": "token_limit", "max_seconds": "time_limit"}
+
+
+async def run_case(case: Case, max_turns: int, max_tokens: Optional[int], timeout: Optional[float]) -> Record:
+    """运行一个病例的讨论，直到图结束或超时。
+
+    发言轮数与 token 上限作为会话预算传入图中，由路由器执行：用完后生成总结再结束。
+    """
+    # 配置在导入时读取，命令行设置的环境变量需要先生效
+    from langchain_core.messages import AIMessage
+
+    from . import agents
+    from .budget import recursion_limit
+    from .components import COMPONENTS
+    from .session import initial_state
+
+    state = initial_state(case.initial_case, {
+        "max_turns": case.max_turns or max_turns,
+        "max_tokens": case.max_tokens or max_tokens,
+    })
+    thread_id = f"batch-{case.case_id}"
+    config = {"configurable": {"thread_id": thread_id}, "recursion_limit": recursion_limit(state["budget"])}
+    record: Record = {
+        "case_id": case.case_id,
+        "status": "completed",
+        "turns": 0,
+        "tokens": 0,
+        "transcript": [{"node": "case_introduction", "content": case.initial_case}],
+        "summary": "",
+    }
+    started = time.perf_counter()
+
+    async def _drive() -> None:
+        async for event in COMPONENTS.app.astream(state, config=config, stream_mode="updates"):
+            for node_name, output in event.items():
+                if not output:
+                    continue
+                if output.get("summary"):
+                    record["summary"] = output["summary"]
+                for msg in output.get("messages") or []:
+                    if isinstance(msg, AIMessage):
+                        record["transcript"].append({"node": node_name, "content": msg.content})
+        values = (await COMPONENTS.app.aget_state(config)).values
+        record["turns"] = values["usage"].get("turns", 0)
+        record["tokens"] = values["usage"].get("tokens", 0)
+        if values.get("budget_exhausted"):
+            record["status"] = _LIMIT_STATUS[values["budget_exhausted"]]
+
+    await COMPONENTS.checkpointer.adelete_thread(thread_id)
+    try:
+        await asyncio.wait_for(_drive(), timeout)
+    except asyncio.TimeoutError:
+        record["status"] = "timeout"
+    except Exception as e:
+        record["status"] = "error"
+        record["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        agents.SUMMARIZER.cancel(thread_id)
+        agents.SPECULATOR.cancel(thread_id)
+        await COMPONENTS.checkpointer.adelete_thread(thread_id)
+    record["elapsed"] = round(time.perf_counter() - started, 3)
+    return record
+
+
+async def run_cases(
+    cases: List[Case],
+    concurrency: int,
+    max_turns: int,
+    max_tokens: Optional[int],
+    timeout: Optional[float],
+    on_result: Callable[[Record], None],
+) -> None:
+    """以最多 concurrency 个并发讨论运行 cases，每完成一个调用一次 on_result。"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _one(case: Case) -> None:
+        async with semaphore:
+            record = await run_case(case, max_turns, max_tokens, timeout)
+        on_result(record)
+
+    await asyncio.gather(*[_one(case) for case in cases])
+
+
+def _worker_main(cases: List[Case], options: Dict, results) -> None:
+    """进程池中的 worker：运行分到的病例，结果经队列交给主进程写出，最后发送 None。"""
+    try:
+        asyncio.run(run_cases(cases, on_result=results.put, **options))
+    finally:
+        results.put(None)
+
+
+def _run_in_processes(cases: List[Case], workers: int, options: Dict, on_result: Callable[[Record], None]) -> None:
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    procs = [
+        ctx.Process(target=_worker_main, args=(cases[rank::workers], options, results), daemon=True)
+        for rank in range(workers)
+    ]
+    for p in procs:
+        p.start()
+    remaining = len(procs)
+    while remaining:
+        try:
+            item = results.get(timeout=1.0)
+        except queue_module.Empty:
+            # 所有 worker 都已退出（包括异常退出）且队列已取空时结束
+            if not any(p.is_alive() for p in procs) and results.empty():
+                break
+            continue
+        if item is None:
+            remaining -= 1
+        else:
+            on_result(item)
+    for p in procs:
+        p.join()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="批量运行 PBL 讨论并输出 JSONL")
+    parser.add_argument("cases", help="病例 JSONL 文件")
+    parser.add_argument("--output", default="discussions.jsonl", help="结果 JSONL 文件（追加写入，支持续跑）")
+    parser.add_argument("--concurrency", type=int, default=16, help="每个进程内同时进行的讨论数")
+    parser.add_argument("--workers", type=int, default=1, help="进程数；大于 1 时病例按进程分片")
+    parser.add_argument("--max-turns", type=int, default=12, help="每个病例的学生发言上限")
+    parser.add_argument(
+        "--max-tokens", type=int, default=0, help="每个病例的 LLM token 总数上限（提示词 + 输出），0 表示使用默认预算"
+    )
+    parser.add_argument("--timeout", type=float, default=0, help="单个病例的超时（秒），0 表示不限")
+    parser.add_argument(
+        "--checkpoint-backend", choices=["memory", "sqlite"], default="memory",
+        help="检查点存储；批量运行按病例续跑，默认不写磁盘检查点",
+    )
+    args = parser.parse_args()
+
+    os.environ["PBL_CHECKPOINT_BACKEND"] = args.checkpoint_backend
+
+    try:
+        cases = load_cases(args.cases)
+    except ValueError as e:
+        parser.error(str(e))
+    finished = load_finished(args.output)
+    todo = [c for c in cases if c.case_id not in finished]
+    options = {
+        "concurrency": args.concurrency,
+        "max_turns": args.max_turns,
+        "max_tokens": args.max_tokens or None,
+        "timeout": args.timeout or None,
+    }
+
+    started = time.perf_counter()
+    stats = {"turns": 0, "errors": 0}
+    with open(args.output, "a", encoding="utf-8") as out, tqdm(
+        total=len(cases), initial=len(cases) - len(todo), unit="case"
+    ) as progress:
+
+        def _write(record: Record) -> None:
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            stats["turns"] += record["turns"]
+            stats["errors"] += record["status"] == "error"
+            elapsed = time.perf_counter() - started
+            progress.set_postfix(turns_per_sec=round(stats["turns"] / elapsed, 2), errors=stats["errors"])
+            progress.update(1)
+
+        if args.workers > 1 and len(todo) > 1:
+            _run_in_processes(todo, min(args.workers, len(todo)), options, _write)
+        else:
+            asyncio.run(run_cases(todo, on_result=_write, **options))
+
+    print(
+        f"{len(todo)} cases ({len(cases) - len(todo)} already done), {stats['turns']} turns, "
+        f"{stats['errors']} errors in {time.perf_counter() - started:.1f}s -> {args.output}"
+    )
+
+
+if __name__ == "__main__":
+    main()
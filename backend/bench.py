@@ -0,0 +1,300 @@
+"""PBL2.backend.bench
+离线基准测试：启动本地假模型服务（fake_llm.py），在进程内运行 app_fastapi，
+用 N 个并发 WebSocket 会话驱动讨论，统计吞吐与延迟并写入 JSON 文件，便于比较不同版本。
+
+    python -m backend.bench --sessions 16 --turns 12 --output bench.json
+
+也可以不启动假模型，回放录制的 LLM 调用（cassette.py），每个磁带对应一个会话，以录制时的病例重跑：
+
+    python -m backend.bench --replay backend/data/cassettes --replay-timing none --output replay.json
+
+统计项：
+- turns_per_sec：所有会话的学生发言总数 / 墙钟时间；
+- ttff：从发送 start_discussion 到收到第一个内容帧（delta 或 message_complete）的时间；
+- turn_ttff：上一条消息完成到下一轮第一个内容帧的时间；
+  connected、discussion_started、budget、backpressure 等控制帧不计入这两项；
+- nodes：各节点从上一条消息完成到本条消息完成的延迟（客户端视角）；
+- peak_rss_mb 与 checkpoint_bytes：进程峰值内存与检查点存储大小。
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+import numpy as np
+import websockets
+
+
+@dataclass
+class SessionResult:
+    """单个会话的客户端观测结果。"""
+
+    session_id: str
+    ttff: Optional[float] = None
+    turn_ttff: List[float] = field(default_factory=list)
+    node_latency: Dict[str, List[float]] = field(default_factory=lambda: defaultdict(list))
+    turns: int = 0
+    frames: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    timed_out: bool = False
+    error: Optional[str] = None
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"count": 0}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        "count": len(values),
+        "mean": round(float(np.mean(values)), 4),
+        "p50": round(float(p50), 4),
+        "p95": round(float(p95), 4),
+        "p99": round(float(p99), 4),
+    }
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位为 KB，macOS 为字节
+    return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+
+
+async def _wait_until_ready(url: str, timeout: float = 20.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Service at {url} did not become ready.")
+            await asyncio.sleep(0.1)
+
+
+DEFAULT_CASE = "54岁男性，突发胸痛 2 小时。"
+
+
+def replay_sessions(directory: str, max_turns: int) -> List[Tuple[str, str, int]]:
+    """磁带目录中可重跑的会话：(会话 id, 病例, 学生发言次数)，发言次数不超过录制时的次数。"""
+    from .cassette import recorded_sessions
+
+    sessions = []
+    for name, records in recorded_sessions(directory).items():
+        case = next((r["case"] for r in records if "case" in r), None)
+        if case is None:
+            continue
+        turns = sum(1 for r in records if (r.get("node") or "").startswith("student_"))
+        sessions.append((f"replay-{name}", case, min(turns, max_turns)))
+    return sessions
+
+
+# 计入首帧延迟的内容帧；其余为控制帧
+CONTENT_FRAMES = ("delta", "message_complete")
+
+
+async def run_session(
+    url: str, session_id: str, turns: int, stream: bool, idle_timeout: float, initial_case: str = DEFAULT_CASE
+) -> SessionResult:
+    """驱动一个会话直到完成 turns 次学生发言，或 idle_timeout 秒内没有新帧。"""
+    result = SessionResult(session_id)
+    try:
+        async with websockets.connect(f"{url}/ws/pbl/{session_id}", max_size=None) as ws:
+            started = time.perf_counter()
+            await ws.send(json.dumps({"action": "start_discussion", "initial_case": initial_case, "stream": stream}))
+            last_complete = started
+            turn_started = False
+            while result.turns < turns:
+                try:
+                    raw = await asyncio.wait_for(ws.recv(), timeout=idle_timeout)
+                except asyncio.TimeoutError:
+                    result.timed_out = True
+                    break
+                now = time.perf_counter()
+                frame = json.loads(raw)
+                kind = frame.get("type", "unknown")
+                result.frames[kind] += 1
+                if kind not in CONTENT_FRAMES:
+                    continue
+                if result.ttff is None:
+                    result.ttff = now - started
+                if not turn_started:
+                    result.turn_ttff.append(now - last_complete)
+                    turn_started = True
+                if kind == "message_complete":
+                    node = frame.get("node", "unknown")
+                    result.node_latency[node].append(now - last_complete)
+                    last_complete = now
+                    turn_started = False
+                    if node.startswith("student_"):
+                        result.turns += 1
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    return result
+
+
+def summarize(results: List[SessionResult], wall: float) -> Dict:
+    """把各会话的观测结果汇总为报告。"""
+    node_latency: Dict[str, List[float]] = defaultdict(list)
+    frames: Dict[str, int] = defaultdict(int)
+    for r in results:
+        for node, values in r.node_latency.items():
+            node_latency[node].extend(values)
+        for kind, count in r.frames.items():
+            frames[kind] += count
+    turns = sum(r.turns for r in results)
+    return {
+        "wall_seconds": round(wall, 3),
+        "turns": turns,
+        "turns_per_sec": round(turns / wall, 3) if wall else 0.0,
+        "ttff": _percentiles([r.ttff for r in results if r.ttff is not None]),
+        "turn_ttff": _percentiles([v for r in results for v in r.turn_ttff]),
+        "nodes": {node: _percentiles(values) for node, values in sorted(node_latency.items())},
+        "frames": dict(frames),
+        "sessions_timed_out": sum(r.timed_out for r in results),
+        "session_errors": [r.error for r in results if r.error],
+    }
+
+
+async def _bench(args: argparse.Namespace, workdir: str) -> Dict:
+    fake = None
+    fake_port = args.fake_port or _free_port()
+    if args.replay:
+        sessions = replay_sessions(args.replay, args.turns)
+    else:
+        sessions = [(f"bench-{i}", DEFAULT_CASE, args.turns) for i in range(args.sessions)]
+        fake = subprocess.Popen(
+            [
+                sys.executable, "-m", "backend.fake_llm",
+                "--port", str(fake_port),
+                "--latency", str(args.latency),
+                "--tokens-per-sec", str(args.tokens_per_sec),
+                "--error-rate", str(args.error_rate),
+                "--max-tokens", str(args.max_tokens),
+            ],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        )
+    server = None
+    server_task = None
+    try:
+        # 配置在导入后端模块时读取，因此必须先设置环境变量
+        if fake is not None:
+            await _wait_until_ready(f"http://127.0.0.1:{fake_port}/health")
+            os.environ["PBL_LLM_BASE_URL"] = f"http://127.0.0.1:{fake_port}/v1"
+        if args.replay:
+            os.environ["PBL_CASSETTE"] = "replay"
+            os.environ["PBL_CASSETTE_DIR"] = args.replay
+            os.environ["PBL_CASSETTE_TIMING"] = args.replay_timing
+        elif args.record:
+            os.environ["PBL_CASSETTE"] = "record"
+            os.environ["PBL_CASSETTE_DIR"] = args.record
+        os.environ["PBL_CHECKPOINT_PATH"] = os.path.join(workdir, "checkpoints.sqlite")
+        os.environ["PBL_LLM_CACHE_PATH"] = os.path.join(workdir, "llm_cache.sqlite")
+        os.environ["PBL_LLM_CACHE"] = "1" if args.cache else "0"
+        os.environ.setdefault("DASHSCOPE_API_KEY", "fake")
+
+        import uvicorn
+        from .agents import SPECULATOR, TURN_SCHEDULER
+        from .checkpoint import SQLiteCheckpointSaver
+        from .components import COMPONENTS
+        from .server import app_fastapi
+
+        port = args.port or _free_port()
+        server = uvicorn.Server(uvicorn.Config(app_fastapi, host="127.0.0.1", port=port, log_level="warning"))
+        server_task = asyncio.create_task(server.serve())
+        await _wait_until_ready(f"http://127.0.0.1:{port}/readyz")
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*[
+            run_session(f"ws://127.0.0.1:{port}", session_id, turns, args.stream, args.idle_timeout, case)
+            for session_id, case, turns in sessions
+        ])
+        wall = time.perf_counter() - started
+
+        fake_stats = None
+        if fake is not None:
+            async with httpx.AsyncClient() as client:
+                fake_stats = (await client.get(f"http://127.0.0.1:{fake_port}/health")).json()
+
+        report = summarize(results, wall)
+        checkpointer = COMPONENTS.checkpointer
+        report.update({
+            "peak_rss_mb": _peak_rss_mb(),
+            "checkpoint_bytes": checkpointer.size_bytes() if isinstance(checkpointer, SQLiteCheckpointSaver) else None,
+            "llm_gateway": COMPONENTS.gateway.snapshot(),
+            "llm_cache": COMPONENTS.response_cache.snapshot(),
+            "scheduler": TURN_SCHEDULER.stats(),
+            "speculative": dict(SPECULATOR.stats),
+            "fake_llm": fake_stats,
+            "cassette": dict(COMPONENTS.cassette.stats),
+        })
+        return report
+    finally:
+        if server is not None:
+            server.should_exit = True
+            await server_task
+        if fake is not None:
+            fake.terminate()
+            fake.wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="PBL 后端离线基准测试")
+    parser.add_argument("--sessions", type=int, default=8, help="并发 WebSocket 会话数")
+    parser.add_argument("--turns", type=int, default=10, help="每个会话的学生发言次数")
+    parser.add_argument("--latency", type=float, default=0.2, help="假模型的首 token 延迟（秒）")
+    parser.add_argument("--tokens-per-sec", type=float, default=50.0, help="假模型的输出速率")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="假模型注入 429/503 的概率")
+    parser.add_argument("--max-tokens", type=int, default=64, help="假模型单次回复的最大 token 数")
+    parser.add_argument("--no-stream", dest="stream", action="store_false", help="关闭按 token 推送")
+    parser.add_argument("--cache", action="store_true", help="启用 LLM 响应缓存（默认关闭以测量真实调用）")
+    parser.add_argument("--idle-timeout", type=float, default=30.0, help="会话多久没有新帧视为结束（秒）")
+    parser.add_argument("--port", type=int, default=0, help="后端端口，默认随机")
+    parser.add_argument("--fake-port", type=int, default=0, help="假模型端口，默认随机")
+    parser.add_argument("--output", default="bench.json", help="结果 JSON 文件")
+    parser.add_argument("--label", default="", help="写入结果的标签，便于区分多次运行")
+    parser.add_argument("--record", default="", help="把本次运行的 LLM 调用录制到该目录")
+    parser.add_argument("--replay", default="", help="不启动假模型，回放该目录中录制的会话（--sessions 被忽略）")
+    parser.add_argument(
+        "--replay-timing", choices=["original", "none"], default="none",
+        help="回放节奏：original 保持录制时的延迟，none 为零延迟（只测图与服务端的开销）",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        report = asyncio.run(_bench(args, workdir))
+    report = {
+        "label": args.label,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "label")},
+        **report,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(
+        f"{report['turns']} turns in {report['wall_seconds']}s "
+        f"({report['turns_per_sec']} turns/s), ttff p95={report['ttff'].get('p95')}s, "
+        f"peak RSS {report['peak_rss_mb']} MB -> {args.output}"
+    )
+
+
+if __name__ == "__main__":
+    main()
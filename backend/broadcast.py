@@ -0,0 +1,117 @@
+"""PBL2.backend.broadcast
+一个会话、多个观看者：每个 WebSocket 连接是会话的一个订阅者，拥有自己的有界出站队列。
+
+生成端只把帧放进各订阅者的队列而不等待发送，因此一个慢客户端不会拖慢生成，也不会影响其他连接。
+队列满时先合并尚未发出的 delta（同一条消息的 delta 拼接为一帧，已完成消息的 delta 直接丢弃），
+仍然放不下时判定为慢消费者：清空其队列并让它重连，客户端带着 last_seq 重连后从事件日志补齐。
+"""
+from __future__ import annotations
+
+import asyncio
+import hmac
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+from .config import SESSION_TEACHER_TOKEN, SUBSCRIBER_QUEUE_SIZE
+from .metrics import WS_FRAMES_COALESCED, WS_SLOW_CONSUMERS
+
+Frame = Dict[str, Any]
+
+ROLE_TEACHER = "teacher"
+ROLE_OBSERVER = "observer"
+
+# 只有老师可以发送的命令
+CONTROL_ACTIONS = {"start_discussion", "teacher_intervention"}
+
+
+def connection_role(token: Optional[str]) -> str:
+    """由连接携带的口令确定角色；未配置 SESSION_TEACHER_TOKEN 时所有连接都是老师。"""
+    if not SESSION_TEACHER_TOKEN:
+        return ROLE_TEACHER
+    if token and hmac.compare_digest(token.encode(), SESSION_TEACHER_TOKEN.encode()):
+        return ROLE_TEACHER
+    return ROLE_OBSERVER
+
+
+class Subscriber:
+    """一个连接的出站队列。deliver 由会话同步调用，get 由该连接的写出任务等待。
+
+    Args:
+        role: ROLE_TEACHER 或 ROLE_OBSERVER。
+        max_frames: 队列上限；合并 delta 后仍超出时断开该连接。
+    """
+
+    def __init__(self, role: str, max_frames: int = SUBSCRIBER_QUEUE_SIZE):
+        self.role = role
+        self.max_frames = max_frames
+        self._queue: Deque[Frame] = deque()
+        # 在写出任务第一次等待时创建，绑定到当时运行的事件循环
+        self._ready: Optional[asyncio.Event] = None
+        # 被判定为慢消费者后不再接收新帧
+        self.overflowed = False
+
+    @property
+    def can_control(self) -> bool:
+        return self.role == ROLE_TEACHER
+
+    def deliver(self, frame: Frame) -> None:
+        if self.overflowed:
+            return
+        self._queue.append(frame)
+        if len(self._queue) > self.max_frames:
+            self._compact()
+            if len(self._queue) > self.max_frames:
+                self.overflowed = True
+                self._queue.clear()
+                self._queue.append({"type": "reconnect", "reason": "slow_consumer"})
+                WS_SLOW_CONSUMERS.inc()
+        if self._ready is not None:
+            self._ready.set()
+
+    async def get(self) -> Frame:
+        if self._ready is None:
+            self._ready = asyncio.Event()
+        while not self._queue:
+            self._ready.clear()
+            await self._ready.wait()
+        return self._queue.popleft()
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def _compact(self) -> None:
+        """合并队列中的 delta 与瞬时帧。
+
+        同一条消息的 delta 拼接后放在它最后一个 delta 的位置并沿用其序号，
+        保证队列中的序号仍然递增（客户端按序号去重）。帧对象与事件日志共享，合并时复制而不修改原帧。
+        """
+        finished = {
+            f.get("message_id") for f in self._queue if f.get("type") in ("message_complete", "message_cancelled")
+        }
+        last_delta: Dict[str, int] = {}
+        last_transient: Dict[str, int] = {}
+        for i, f in enumerate(self._queue):
+            if f.get("type") == "delta":
+                last_delta[f.get("message_id")] = i
+            elif "seq" not in f:
+                # 不写入日志的瞬时帧（如 backpressure）只保留同类型的最新一个
+                last_transient[f.get("type")] = i
+
+        compacted: Deque[Frame] = deque()
+        pending_text: Dict[str, str] = {}
+        for i, f in enumerate(self._queue):
+            kind = f.get("type")
+            if kind == "delta":
+                message_id = f.get("message_id")
+                if message_id in finished:
+                    continue
+                if i != last_delta[message_id]:
+                    pending_text[message_id] = pending_text.get(message_id, "") + f["delta"]
+                    continue
+                if message_id in pending_text:
+                    f = {**f, "delta": pending_text.pop(message_id) + f["delta"]}
+            elif "seq" not in f and i != last_transient[kind]:
+                continue
+            compacted.append(f)
+        WS_FRAMES_COALESCED.inc(amount=len(self._queue) - len(compacted))
+        self._queue = compacted
@@ -0,0 +1,71 @@
+"""PBL2.backend.budget
+会话预算：学生发言轮数、LLM token 总数与墙钟时间的上限。
+
+预算与用量保存在图状态中（随检查点持久化，任何 worker 接管后都能继续计算），
+由路由器在每一轮开始前检查；任意一项用完后路由到 final_summary 节点生成总结，然后结束讨论。
+"""
+from __future__ import annotations
+
+import time
+from typing import Any, Dict, Optional
+
+from .config import SESSION_BUDGET, SESSION_BUDGET_CEILING
+
+LIMIT_KEYS = ("max_turns", "max_tokens", "max_seconds")
+
+
+def resolve_budget(overrides: Optional[Dict[str, Any]] = None) -> Dict[str, Optional[float]]:
+    """默认预算叠加客户端的覆盖值，并限制在 SESSION_BUDGET_CEILING 之内；非法的值被忽略。"""
+    budget = {key: SESSION_BUDGET.get(key) for key in LIMIT_KEYS}
+    for key, value in (overrides or {}).items():
+        if key not in LIMIT_KEYS or isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+            continue
+        budget[key] = value
+    for key, ceiling in SESSION_BUDGET_CEILING.items():
+        if ceiling is not None and (budget.get(key) is None or budget[key] > ceiling):
+            budget[key] = ceiling
+    return budget
+
+
+def add_usage(left: Optional[Dict[str, int]], right: Optional[Dict[str, int]]) -> Dict[str, int]:
+    """GraphState.usage 的 reducer：节点返回本次的增量，按键累加。"""
+    merged = dict(left or {})
+    for key, value in (right or {}).items():
+        merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+def exhausted(state: Dict, now: Optional[float] = None) -> Optional[str]:
+    """返回已用完的预算项（LIMIT_KEYS 之一），都未用完时返回 None。"""
+    budget = state.get("budget") or {}
+    usage = state.get("usage") or {}
+    if budget.get("max_turns") and usage.get("turns", 0) >= budget["max_turns"]:
+        return "max_turns"
+    if budget.get("max_tokens") and usage.get("tokens", 0) >= budget["max_tokens"]:
+        return "max_tokens"
+    started_at = state.get("started_at")
+    if budget.get("max_seconds") and started_at and (now or time.time()) - started_at >= budget["max_seconds"]:
+        return "max_seconds"
+    return None
+
+
+def budget_report(state: Dict, now: Optional[float] = None) -> Dict[str, Any]:
+    """推送给客户端的预算用量（``budget`` 帧与快照）。"""
+    usage = state.get("usage") or {}
+    started_at = state.get("started_at")
+    return {
+        "turns": usage.get("turns", 0),
+        "tokens": usage.get("tokens", 0),
+        "seconds": round((now or time.time()) - started_at, 1) if started_at else 0.0,
+        "limits": state.get("budget") or {},
+        "exhausted": state.get("budget_exhausted") or None,
+    }
+
+
+def recursion_limit(budget: Dict[str, Optional[float]]) -> int:
+    """一次图运行的步数上限：每轮约为路由 + 发言两步，另为摘要、老师回应与总结留出余量。
+
+    预算由路由器执行，这里只是防止图在异常情况下无限循环的兜底。
+    """
+    max_turns = budget.get("max_turns") or SESSION_BUDGET_CEILING.get("max_turns") or 1000
+    return int(max_turns) * 4 + 20
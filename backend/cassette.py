@@ -0,0 +1,243 @@
+"""PBL2.backend.cassette
+LLM 调用的录制 / 回放（"磁带"）。
+
+录制模式下，每次调用的请求键、节点、耗时、逐 token 的到达时间与最终回复追加写入该会话的磁带文件
+（``<目录>/<session_id>.jsonl``，每行一次调用）；回放模式下不访问网络，
+由 ReplayChatModel 按录制的 token 流重新输出，可以保持原始节奏，也可以零延迟，
+从而把图 / 服务端自身的开销与模型延迟分开测量，或把线上的会话当作回归基准重跑。
+
+请求键与响应缓存相同（llm_cache.cache_key），不含消息 id 等每次运行都会变化的字段。
+回放时所有磁带中相同键的录制按录制顺序依次取用；由于回复被原样回放，之后各轮的 prompt 也与录制时一致。
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import re
+import time
+from collections import defaultdict, deque
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional
+
+import orjson
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, message_chunk_to_message
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from .llm_cache import cache_key
+
+MODE_OFF = "off"
+MODE_RECORD = "record"
+MODE_REPLAY = "replay"
+
+Record = Dict[str, Any]
+
+_UNSAFE_FILENAME = re.compile(r"[^\w.-]")
+
+
+class CassetteMiss(Exception):
+    """回放模式下找不到对应的录制（prompt 与录制时不同，或录制的调用已用完）。"""
+
+
+def cassette_path(directory: str, session_id: Optional[str]) -> str:
+    return os.path.join(directory, _UNSAFE_FILENAME.sub("_", session_id or "default") + ".jsonl")
+
+
+def load_cassette(path: str) -> List[Record]:
+    """读取一个磁带文件；进程在写某一行时崩溃留下的不完整行被忽略。"""
+    records = []
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                records.append(orjson.loads(line))
+            except orjson.JSONDecodeError:
+                continue
+    return records
+
+
+def recorded_sessions(directory: str) -> Dict[str, List[Record]]:
+    """目录中所有磁带：会话（文件名）-> 按录制顺序排列的调用。"""
+    sessions = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".jsonl"):
+            sessions[name[:-len(".jsonl")]] = load_cassette(os.path.join(directory, name))
+    return sessions
+
+
+def _case_of(prompt: List[BaseMessage]) -> Optional[str]:
+    for message in prompt:
+        if message.name == "case_introduction":
+            return message.content if isinstance(message.content, str) else str(message.content)
+    return None
+
+
+class ReplayChatModel(BaseChatModel):
+    """按一条录制输出回复的聊天模型。
+
+    通过 BaseChatModel 的回调机制输出 token，LangGraph 的 ``stream_mode="messages"`` 照常收到 delta。
+    """
+
+    record: Dict[str, Any]
+    realtime: bool = True
+
+    @property
+    def _llm_type(self) -> str:
+        return "cassette-replay"
+
+    def _final_message(self) -> AIMessage:
+        return AIMessage(
+            content=self.record.get("content", ""),
+            response_metadata=self.record.get("response_metadata") or {},
+            usage_metadata=self.record.get("usage"),
+        )
+
+    async def _pause(self, until: float, started: float) -> None:
+        delay = until - (time.perf_counter() - started) if self.realtime else 0.0
+        # 零延迟时也让出事件循环，与真实的网络调用一样允许其他会话穿插执行
+        await asyncio.sleep(max(delay, 0.0))
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        raise NotImplementedError("ReplayChatModel 只支持异步调用")
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        await self._pause(self.record.get("elapsed", 0.0), time.perf_counter())
+        return ChatResult(generations=[ChatGeneration(message=self._final_message())])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        started = time.perf_counter()
+        chunks = self.record.get("chunks")
+        if chunks is None:
+            # 以非流式方式录制的调用：整段回复作为一个 chunk 输出
+            content = self.record.get("content", "")
+            chunks = [[round(self.record.get("elapsed", 0.0) * 1000), content]] if content else []
+        for offset_ms, text in chunks:
+            await self._pause(offset_ms / 1000, started)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=text))
+            if run_manager is not None:
+                await run_manager.on_llm_new_token(text, chunk=chunk)
+            yield chunk
+        await self._pause(self.record.get("elapsed", 0.0), started)
+        # 用量与结束原因放在最后一个空 chunk 上，与 OpenAI 流式接口一致
+        final = self._final_message()
+        yield ChatGenerationChunk(message=AIMessageChunk(
+            content="", response_metadata=final.response_metadata, usage_metadata=final.usage_metadata,
+        ))
+
+
+class Cassette:
+    """录制 / 回放 LLM 调用。
+
+    Args:
+        mode: MODE_OFF、MODE_RECORD 或 MODE_REPLAY。
+        directory: 磁带目录。
+        realtime: 回放时是否按录制的节奏输出（False 为零延迟）。
+    """
+
+    def __init__(self, mode: str = MODE_OFF, directory: str = "", realtime: bool = True):
+        if mode not in (MODE_OFF, MODE_RECORD, MODE_REPLAY):
+            raise ValueError(f"未知的磁带模式: {mode}")
+        self.mode = mode
+        self.directory = directory
+        self.realtime = realtime
+        # 回放：请求键 -> 尚未使用的录制
+        self._replay: Optional[Dict[str, Deque[Record]]] = None
+        # 录制：已写过病例的会话
+        self._sessions_seen: set = set()
+        self.stats: Dict[str, int] = {"recorded": 0, "replayed": 0, "misses": 0}
+        if mode == MODE_RECORD:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != MODE_OFF
+
+    # ---------- 调用入口 ----------
+
+    async def astream(
+        self, llm: Any, prompt: List[BaseMessage], session_id: Optional[str], node: Optional[str]
+    ) -> AsyncIterator[AIMessageChunk]:
+        """代替 ``llm.astream(prompt)``：关闭时直接透传，录制时记下每个 chunk 的到达时间，回放时输出录制内容。"""
+        if self.mode == MODE_REPLAY:
+            async for chunk in self._replayer(llm, prompt).astream(prompt):
+                yield chunk
+            return
+        if self.mode == MODE_OFF:
+            async for chunk in llm.astream(prompt):
+                yield chunk
+            return
+
+        started = time.perf_counter()
+        chunks: List[List[Any]] = []
+        full = None
+        async for chunk in llm.astream(prompt):
+            if chunk.content:
+                chunks.append([round((time.perf_counter() - started) * 1000), chunk.content])
+            full = chunk if full is None else full + chunk
+            yield chunk
+        message = message_chunk_to_message(full) if full is not None else AIMessage(content="")
+        self._record(llm, prompt, session_id, node, "stream", started, message, chunks)
+
+    async def agenerate(
+        self, llm: Any, prompt: List[BaseMessage], session_id: Optional[str], node: Optional[str]
+    ) -> AIMessage:
+        """代替 ``llm.agenerate([prompt])`` 并返回其中的消息。"""
+        model = self._replayer(llm, prompt) if self.mode == MODE_REPLAY else llm
+        started = time.perf_counter()
+        result = await model.agenerate([prompt])
+        message = result.generations[0][0].message
+        if self.mode == MODE_RECORD:
+            self._record(llm, prompt, session_id, node, "generate", started, message)
+        return message
+
+    # ---------- 录制 ----------
+
+    def _record(
+        self,
+        llm: Any,
+        prompt: List[BaseMessage],
+        session_id: Optional[str],
+        node: Optional[str],
+        kind: str,
+        started: float,
+        message: AIMessage,
+        chunks: Optional[List[List[Any]]] = None,
+    ) -> None:
+        record: Record = {
+            "key": cache_key(llm, prompt),
+            "node": node,
+            "kind": kind,
+            "at": round(time.time(), 3),
+            "elapsed": round(time.perf_counter() - started, 4),
+            "content": message.content,
+            "response_metadata": message.response_metadata,
+            "usage": message.usage_metadata,
+        }
+        if chunks is not None:
+            record["chunks"] = chunks
+        # 每个会话的第一条录制带上病例，便于之后以同样的病例重跑该会话
+        if session_id not in self._sessions_seen:
+            case = _case_of(prompt)
+            if case is not None:
+                record["case"] = case
+                self._sessions_seen.add(session_id)
+        with open(cassette_path(self.directory, session_id), "ab") as f:
+            f.write(orjson.dumps(record, default=str) + b"\n")
+        self.stats["recorded"] += 1
+
+    # ---------- 回放 ----------
+
+    def _load(self) -> Dict[str, Deque[Record]]:
+        if self._replay is None:
+            self._replay = defaultdict(deque)
+            for records in recorded_sessions(self.directory).values():
+                for record in records:
+                    self._replay[record["key"]].append(record)
+        return self._replay
+
+    def _replayer(self, llm: Any, prompt: List[BaseMessage]) -> ReplayChatModel:
+        key = cache_key(llm, prompt)
+        pending = self._load().get(key)
+        if not pending:
+            self.stats["misses"] += 1
+            raise CassetteMiss(f"磁带 {self.directory} 中没有与该请求对应的录制（key={key}）")
+        self.stats["replayed"] += 1
+        return ReplayChatModel(record=pending.popleft(), realtime=self.realtime)
@@ -0,0 +1,387 @@
+"""PBL2.backend.checkpoint
+基于 SQLite 的持久化检查点存储，用来替代进程内的 MemorySaver。
+
+- 每个 thread 只保留最近 N 个检查点；
+- 空闲超过 TTL 的会话整体淘汰；
+- 检查点以 ormsgpack（LangGraph 默认 serde）序列化，元数据用 orjson；
+- 提供后台压缩任务，定期淘汰过期会话并回收磁盘空间。
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, Optional, Sequence, Tuple
+
+import orjson
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+
+from .metrics import CHECKPOINT_DURATION
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL DEFAULT '',
+    checkpoint_id TEXT NOT NULL,
+    parent_checkpoint_id TEXT,
+    type TEXT NOT NULL,
+    checkpoint BLOB NOT NULL,
+    metadata BLOB NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+);
+CREATE INDEX IF NOT EXISTS idx_checkpoints_updated ON checkpoints (updated_at);
+CREATE TABLE IF NOT EXISTS writes (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL DEFAULT '',
+    checkpoint_id TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    channel TEXT NOT NULL,
+    type TEXT NOT NULL,
+    value BLOB NOT NULL,
+    task_path TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+);
+"""
+
+
+def _dump_metadata(metadata: Dict[str, Any]) -> bytes:
+    return orjson.dumps(metadata, default=str, option=orjson.OPT_NON_STR_KEYS)
+
+
+class SQLiteCheckpointSaver(BaseCheckpointSaver[int]):
+    """磁盘检查点存储（单文件 SQLite，WAL 模式）。
+
+    Args:
+        path: 数据库文件路径；":memory:" 可用于测试。
+        keep_latest: 每个 (thread, namespace) 保留的最近检查点个数。
+        ttl_seconds: 会话最后一次写入后超过该时长即被淘汰；None 表示不过期。
+        on_evict: 会话因 TTL 被淘汰后以其 thread_id 调用，用于删除随检查点存在的其他数据（如 persona 快照）。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        keep_latest: int = 3,
+        ttl_seconds: Optional[float] = None,
+        on_evict: Optional[Callable[[str], None]] = None,
+        serde=None,
+    ) -> None:
+        super().__init__(serde=serde)
+        self.path = path
+        self.keep_latest = max(1, keep_latest)
+        self.ttl_seconds = ttl_seconds
+        self.on_evict = on_evict
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # auto_vacuum 必须在建表之前设置，才能在压缩时增量回收空间
+        self._conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    # ---------- 读 ----------
+
+    def _row_to_tuple(self, thread_id: str, checkpoint_ns: str, row: Tuple) -> CheckpointTuple:
+        checkpoint_id, parent_id, type_, checkpoint_b, metadata_b = row
+        writes = self._conn.execute(
+            "SELECT task_id, channel, type, value FROM writes "
+            "WHERE thread_id=? AND checkpoint_ns=? AND checkpoint_id=? ORDER BY rowid",
+            (thread_id, checkpoint_ns, checkpoint_id),
+        ).fetchall()
+        return CheckpointTuple(
+            config={
+                "configurable": {
+                    "thread_id": thread_id,
+                    "checkpoint_ns": checkpoint_ns,
+                    "checkpoint_id": checkpoint_id,
+                }
+            },
+            checkpoint=self.serde.loads_typed((type_, checkpoint_b)),
+            metadata=orjson.loads(metadata_b),
+            parent_config=(
+                {
+                    "configurable": {
+                        "thread_id": thread_id,
+                        "checkpoint_ns": checkpoint_ns,
+                        "checkpoint_id": parent_id,
+                    }
+                }
+                if parent_id
+                else None
+            ),
+            pending_writes=[
+                (task_id, channel, self.serde.loads_typed((w_type, value)))
+                for task_id, channel, w_type, value in writes
+            ],
+        )
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id: str = config["configurable"]["thread_id"]
+        checkpoint_ns: str = config["configurable"].get("checkpoint_ns", "")
+        columns = "checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata"
+        with self._lock:
+            if checkpoint_id := get_checkpoint_id(config):
+                row = self._conn.execute(
+                    f"SELECT {columns} FROM checkpoints "
+                    "WHERE thread_id=? AND checkpoint_ns=? AND checkpoint_id=?",
+                    (thread_id, checkpoint_ns, checkpoint_id),
+                ).fetchone()
+            else:
+                row = self._conn.execute(
+                    f"SELECT {columns} FROM checkpoints "
+                    "WHERE thread_id=? AND checkpoint_ns=? ORDER BY checkpoint_id DESC LIMIT 1",
+                    (thread_id, checkpoint_ns),
+                ).fetchone()
+            if row is None:
+                return None
+            return self._row_to_tuple(thread_id, checkpoint_ns, row)
+
+    def list(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[CheckpointTuple]:
+        where, params = [], []
+        if config:
+            where.append("thread_id=?")
+            params.append(config["configurable"]["thread_id"])
+            if (checkpoint_ns := config["configurable"].get("checkpoint_ns")) is not None:
+                where.append("checkpoint_ns=?")
+                params.append(checkpoint_ns)
+            if checkpoint_id := get_checkpoint_id(config):
+                where.append("checkpoint_id=?")
+                params.append(checkpoint_id)
+        if before and (before_id := get_checkpoint_id(before)):
+            where.append("checkpoint_id<?")
+            params.append(before_id)
+        sql = (
+            "SELECT thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata "
+            "FROM checkpoints"
+        )
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY checkpoint_id DESC"
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+            results = []
+            for thread_id, checkpoint_ns, *row in rows:
+                if filter:
+                    metadata = orjson.loads(row[4])
+                    if not all(metadata.get(k) == v for k, v in filter.items()):
+                        continue
+                if limit is not None and len(results) >= limit:
+                    break
+                results.append(self._row_to_tuple(thread_id, checkpoint_ns, tuple(row)))
+        yield from results
+
+    # ---------- 写 ----------
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        type_, checkpoint_b = self.serde.dumps_typed(checkpoint)
+        metadata_b = _dump_metadata(get_checkpoint_metadata(config, metadata))
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        thread_id,
+                        checkpoint_ns,
+                        checkpoint["id"],
+                        config["configurable"].get("checkpoint_id"),
+                        type_,
+                        checkpoint_b,
+                        metadata_b,
+                        time.time(),
+                    ),
+                )
+                self._prune(thread_id, checkpoint_ns)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return {
+            "configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint["id"],
+            }
+        }
+
+    def _prune(self, thread_id: str, checkpoint_ns: str) -> None:
+        """只保留最近 keep_latest 个检查点及其 pending writes（需在持锁事务中调用）。"""
+        row = self._conn.execute(
+            "SELECT checkpoint_id FROM checkpoints WHERE thread_id=? AND checkpoint_ns=? "
+            "ORDER BY checkpoint_id DESC LIMIT 1 OFFSET ?",
+            (thread_id, checkpoint_ns, self.keep_latest - 1),
+        ).fetchone()
+        if row is None:
+            return
+        oldest_kept = row[0]
+        for table in ("checkpoints", "writes"):
+            self._conn.execute(
+                f"DELETE FROM {table} WHERE thread_id=? AND checkpoint_ns=? AND checkpoint_id<?",
+                (thread_id, checkpoint_ns, oldest_kept),
+            )
+
+    def put_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[Tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        # 特殊通道（错误、中断等）的写入覆盖旧值，普通写入只保留第一次
+        replace_rows, ignore_rows = [], []
+        for idx, (channel, value) in enumerate(writes):
+            type_, value_b = self.serde.dumps_typed(value)
+            row = (
+                thread_id,
+                checkpoint_ns,
+                checkpoint_id,
+                task_id,
+                WRITES_IDX_MAP.get(channel, idx),
+                channel,
+                type_,
+                value_b,
+                task_path,
+            )
+            (replace_rows if channel in WRITES_IDX_MAP else ignore_rows).append(row)
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", replace_rows)
+            self._conn.executemany("INSERT OR IGNORE INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", ignore_rows)
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute("DELETE FROM checkpoints WHERE thread_id=?", (thread_id,))
+            self._conn.execute("DELETE FROM writes WHERE thread_id=?", (thread_id,))
+            self._conn.execute("COMMIT")
+
+    # ---------- 异步接口（在线程池中执行，避免阻塞事件循环） ----------
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        items = await asyncio.to_thread(
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit))
+        )
+        for item in items:
+            yield item
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        started = time.perf_counter()
+        try:
+            return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+        finally:
+            CHECKPOINT_DURATION.observe(time.perf_counter() - started, "put")
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[Tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        started = time.perf_counter()
+        try:
+            await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+        finally:
+            CHECKPOINT_DURATION.observe(time.perf_counter() - started, "put_writes")
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
+
+    # ---------- 淘汰与压缩 ----------
+
+    def evict_idle(self, now: Optional[float] = None) -> int:
+        """删除最后一次写入早于 TTL 的会话，返回被淘汰的会话数。"""
+        if self.ttl_seconds is None:
+            return 0
+        cutoff = (now if now is not None else time.time()) - self.ttl_seconds
+        with self._lock:
+            thread_ids = [
+                row[0]
+                for row in self._conn.execute(
+                    "SELECT thread_id FROM checkpoints GROUP BY thread_id HAVING MAX(updated_at) < ?",
+                    (cutoff,),
+                ).fetchall()
+            ]
+        for thread_id in thread_ids:
+            self.delete_thread(thread_id)
+            if self.on_evict is not None:
+                self.on_evict(thread_id)
+        return len(thread_ids)
+
+    def compact(self) -> int:
+        """淘汰过期会话、合并 WAL 并回收空闲页，返回被淘汰的会话数。"""
+        evicted = self.evict_idle()
+        with self._lock:
+            self._conn.execute("PRAGMA incremental_vacuum")
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return evicted
+
+    async def compaction_loop(self, interval: float) -> None:
+        """后台压缩任务，由服务启动时创建、关闭时取消。"""
+        while True:
+            await asyncio.sleep(interval)
+            evicted = await asyncio.to_thread(self.compact)
+            if evicted:
+                print(f"Checkpoint compaction evicted {evicted} idle session(s).")
+
+    def size_bytes(self) -> int:
+        """数据库当前占用的字节数（页数 × 页大小）。"""
+        with self._lock:
+            page_count = self._conn.execute("PRAGMA page_count").fetchone()[0]
+            page_size = self._conn.execute("PRAGMA page_size").fetchone()[0]
+        return page_count * page_size
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
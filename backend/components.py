@@ -0,0 +1,199 @@
+"""PBL2.backend.components
+进程内共享的重量级组件：LLM 网关（连接池）、模型客户端、录制 / 回放、响应缓存、会话存储、检查点存储与编译好的图。
+
+导入任何模块都不会创建这些组件。服务启动后由 runtime 在工作线程中调用 ``COMPONENTS.init()`` 一次性构建；
+没有经过 lifespan 的脚本与测试在第一次访问某个组件时才构建它（及其依赖），用不到的组件不会被创建。
+测试用 ``COMPONENTS.override(...)`` 临时替换组件，被替换的组件不会为此构建。
+"""
+from __future__ import annotations
+
+import time
+from contextlib import contextmanager
+from functools import cached_property
+from typing import TYPE_CHECKING, Any, Dict, Iterator, Optional
+
+from .config import (
+    DASHSCOPE_API_KEY,
+    BASE_URL,
+    LLM_MODEL_NAME,
+    EXTRA_BODY,
+    MODEL_KWARGS,
+    LLM_MAX_CONNECTIONS,
+    LLM_MAX_IN_FLIGHT,
+    LLM_MAX_IN_FLIGHT_PER_SESSION,
+    LLM_MAX_QUEUE,
+    LLM_REQUESTS_PER_MINUTE,
+    LLM_TOKENS_PER_MINUTE,
+    LLM_MAX_RETRIES,
+    LLM_REQUEST_TIMEOUT,
+    LLM_PRIORITY_AGING_SECONDS,
+    LLM_CACHE_STUDENT_SEED,
+    LLM_CACHE_MEMORY_ENTRIES,
+    LLM_CACHE_PATH,
+    LLM_CACHE_MAX_BYTES,
+    CASSETTE_MODE,
+    CASSETTE_DIR,
+    CASSETTE_TIMING,
+    SESSION_STORE_BACKEND,
+    SESSION_STORE_PATH,
+    SESSION_EVENT_LOG_SIZE,
+    CHECKPOINT_BACKEND,
+    CHECKPOINT_PATH,
+    CHECKPOINT_KEEP_LATEST,
+    CHECKPOINT_TTL_SECONDS,
+)
+
+if TYPE_CHECKING:
+    from langchain_openai import ChatOpenAI
+    from langgraph.checkpoint.base import BaseCheckpointSaver
+
+    from .cassette import Cassette
+    from .llm_cache import ResponseCache
+    from .llm_gateway import LLMGateway
+    from .store import SessionStore
+
+
+class Components:
+    """按需构建、每个进程只构建一次的共享组件。"""
+
+    # init() 的构建顺序：被依赖的在前（网关 -> 模型客户端，检查点存储 -> 图）
+    NAMES = (
+        "gateway", "cassette", "response_cache", "student_llm", "host_llm", "sum_llm", "store", "checkpointer", "app",
+    )
+
+    def init(self) -> Dict[str, float]:
+        """构建全部组件（已构建的跳过），返回各组件的构建耗时（秒）。"""
+        timings = {}
+        for name in self.NAMES:
+            started = time.perf_counter()
+            getattr(self, name)
+            timings[name] = round(time.perf_counter() - started, 4)
+        return timings
+
+    def built(self, name: str) -> bool:
+        return name in self.__dict__
+
+    @contextmanager
+    def override(self, **components: Any) -> Iterator[None]:
+        """临时替换若干组件（测试用），退出时恢复原状；尚未构建的组件在退出后仍未构建。"""
+        unknown = set(components) - set(self.NAMES)
+        if unknown:
+            raise AttributeError(f"未知的组件: {', '.join(sorted(unknown))}")
+        saved = {name: self.__dict__[name] for name in components if name in self.__dict__}
+        self.__dict__.update(components)
+        try:
+            yield
+        finally:
+            for name in components:
+                if name in saved:
+                    self.__dict__[name] = saved[name]
+                else:
+                    self.__dict__.pop(name, None)
+
+    async def aclose(self) -> None:
+        """释放 LLM 连接池（未构建时什么也不做）。"""
+        if self.built("gateway"):
+            await self.gateway.aclose()
+
+    # ---------- LLM ----------
+
+    @cached_property
+    def gateway(self) -> LLMGateway:
+        """所有 LLM 调用共享的网关：连接池、并发上限、限流、重试与背压。"""
+        from .llm_gateway import LLMGateway
+
+        return LLMGateway(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_in_flight=LLM_MAX_IN_FLIGHT,
+            max_in_flight_per_session=LLM_MAX_IN_FLIGHT_PER_SESSION,
+            max_queue=LLM_MAX_QUEUE,
+            requests_per_minute=LLM_REQUESTS_PER_MINUTE,
+            tokens_per_minute=LLM_TOKENS_PER_MINUTE,
+            max_retries=LLM_MAX_RETRIES,
+            timeout=LLM_REQUEST_TIMEOUT,
+            aging_seconds=LLM_PRIORITY_AGING_SECONDS,
+        )
+
+    @cached_property
+    def cassette(self) -> Cassette:
+        """LLM 调用的录制 / 回放；关闭时直接透传。"""
+        from .cassette import Cassette
+
+        return Cassette(CASSETTE_MODE, CASSETTE_DIR, realtime=CASSETTE_TIMING != "none")
+
+    @cached_property
+    def response_cache(self) -> ResponseCache:
+        """按内容寻址的响应缓存：相同的模型参数与 prompt 直接返回之前的回复。"""
+        from .llm_cache import ResponseCache
+
+        return ResponseCache(max_entries=LLM_CACHE_MEMORY_ENTRIES, path=LLM_CACHE_PATH, max_bytes=LLM_CACHE_MAX_BYTES)
+
+    def _build_llm(self, temperature: float = 0.7, seed: Optional[int] = None) -> ChatOpenAI:
+        """创建一个 ChatOpenAI（兼容 DashScope）实例，HTTP 连接池由网关统一提供。"""
+        from langchain_openai import ChatOpenAI
+
+        return ChatOpenAI(
+            model=LLM_MODEL_NAME,
+            base_url=BASE_URL,
+            api_key=DASHSCOPE_API_KEY,
+            temperature=temperature,
+            seed=seed,
+            extra_body=EXTRA_BODY,
+            http_async_client=self.gateway.http_client,
+            max_retries=0,  # 重试由网关负责
+            stream_usage=True,  # 流式输出也返回 token 用量
+            **MODEL_KWARGS,
+        )
+
+    @cached_property
+    def student_llm(self) -> ChatOpenAI:
+        """供学生使用的 LLM（稍高温度以鼓励多样性）。"""
+        return self._build_llm(temperature=0.8, seed=LLM_CACHE_STUDENT_SEED)
+
+    @cached_property
+    def host_llm(self) -> ChatOpenAI:
+        """主持人 / 路由器使用的 LLM（更偏向确定性）。"""
+        return self._build_llm(temperature=0.3)
+
+    @cached_property
+    def sum_llm(self) -> ChatOpenAI:
+        """总结器使用的 LLM。"""
+        return self._build_llm(temperature=0.2)
+
+    # ---------- 会话与图 ----------
+
+    @cached_property
+    def store(self) -> SessionStore:
+        """会话共享存储：persona、事件流、控制通道与会话租约，所有 worker 共用。"""
+        from .store import build_session_store
+
+        return build_session_store(SESSION_STORE_BACKEND, SESSION_STORE_PATH, SESSION_EVENT_LOG_SIZE)
+
+    @cached_property
+    def checkpointer(self) -> BaseCheckpointSaver:
+        """根据配置选择检查点存储：磁盘 SQLite（默认）或进程内存。
+
+        会话的 persona 快照与检查点同生命周期：检查点因过期被淘汰时一并删除。
+        """
+        if CHECKPOINT_BACKEND == "sqlite":
+            from .checkpoint import SQLiteCheckpointSaver
+
+            return SQLiteCheckpointSaver(
+                CHECKPOINT_PATH,
+                keep_latest=CHECKPOINT_KEEP_LATEST,
+                ttl_seconds=CHECKPOINT_TTL_SECONDS,
+                on_evict=self.store.drop_personas,
+            )
+        from langgraph.checkpoint.memory import MemorySaver
+
+        return MemorySaver()
+
+    @cached_property
+    def app(self):
+        """编译好的讨论图，附加检查点存储。"""
+        from .graph import wf
+
+        return wf.compile(checkpointer=self.checkpointer)
+
+
+COMPONENTS = Components()
@@ -6,8 +6,8 @@ import os
 # 从环境变量读取 DashScope API Key
 DASHSCOPE_API_KEY = os.getenv("DASHSCOPE_API_KEY", 'sk-de225921dd58479887c1f14d8249b337')  # 请确保已 export
 
-# DashScope OpenAI-Compatible endpoint (北京地域)
-BASE_URL = "https://dashscope.aliyuncs.com/compatible-mode/v1"
+# DashScope OpenAI-Compatible endpoint (北京地域)；压测时可指向本地假模型服务（见 fake_llm.py）
+BASE_URL = os.getenv("PBL_LLM_BASE_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1")
 
 # 模型名称（可改成 qwen3-32b 等）
 LLM_MODEL_NAME = "qwen-plus"
@@ -18,3 +18,177 @@ EXTRA_BODY = {"enable_thinking": False}
 
 # 若还有其他 OpenAI 参数，可放在此处；保持为空即可
 MODEL_KWARGS: dict = {}
+
+# --- 流式输出 ---
+# 是否按 token 增量推送输出（前端可在 start_discussion 中用 "stream" 字段覆盖）
+STREAM_TOKENS = True
+
+# 每个会话事件日志保留的最多帧数（用于断线重连后补发）
+SESSION_EVENT_LOG_SIZE = 2000
+# 会话没有任何连接多久之后关闭（秒）；期间重连可以继续之前的讨论
+SESSION_DETACHED_TTL = 600
+
+# --- 会话共享存储（多 worker） ---
+# "memory"：单 worker；"sqlite"：同一主机上的多个 worker 共享（uvicorn --workers N），
+# 此时检查点也必须使用共享的 sqlite 后端
+SESSION_STORE_BACKEND = os.getenv("PBL_SESSION_STORE", "memory")
+SESSION_STORE_PATH = os.getenv(
+    "PBL_SESSION_STORE_PATH", os.path.join(os.path.dirname(__file__), "data", "sessions.sqlite")
+)
+# 会话租约的有效期（秒）；持有者每 1/3 有效期续约一次，进程退出后其他 worker 可以接管
+SESSION_LEASE_TTL = 15.0
+# 非持有者读取事件流、持有者读取控制通道的轮询间隔（秒）
+SESSION_POLL_INTERVAL = 0.05
+# --- 多人观看 ---
+# 老师连接的口令（WebSocket 查询参数 ?token=），只有老师可以开始讨论与插话；
+# 未设置时所有连接都可以控制讨论（本地开发）
+SESSION_TEACHER_TOKEN = os.getenv("PBL_TEACHER_TOKEN", "")
+# 每个连接出站队列的最多帧数；合并 delta 后仍超出时断开该连接，客户端重连后从事件日志补齐
+SUBSCRIBER_QUEUE_SIZE = 256
+
+# 缓存的学生系统提示词条数（每个会话 / agent / persona 版本一条）
+PERSONA_PROMPT_CACHE_SIZE = 1024
+
+# 需要向前端推送增量 token 的节点（路由器的输出只是内部决策，不推送）
+STREAMING_NODES = {
+    "student_analyst",
+    "student_observer",
+    "student_skeptic",
+    "teacher_handler",
+    "summarizer",
+    "final_summary",
+}
+
+# --- 会话预算 ---
+# 每个会话的默认预算：学生发言轮数、LLM token 总数（提示词 + 输出）、墙钟时间（秒），None 表示不限。
+# 任意一项用完后生成一次总结并结束讨论
+SESSION_BUDGET = {"max_turns": 40, "max_tokens": 200_000, "max_seconds": 1800}
+# start_discussion 的 "budget" 字段可以覆盖默认预算，但不能超过这里的上限
+SESSION_BUDGET_CEILING = {"max_turns": 200, "max_tokens": 1_000_000, "max_seconds": 4 * 3600}
+
+# --- 发言调度 ---
+# 调度策略: "llm"（每轮询问主持人 LLM）、"round_robin"、"least_recent"、"heuristic"（关键词打分）
+SCHEDULER_POLICY = "heuristic"
+# heuristic 策略的置信度阈值（最高分与次高分之差占总分的比例），低于阈值时回退到 LLM
+SCHEDULER_MIN_CONFIDENCE = 0.3
+# 连续若干名学生发言后强制询问一次 LLM，由其判断是否结束讨论（0 表示不强制）
+SCHEDULER_LLM_EVERY = 4
+
+# 轮次发言：router 一次选出多名学生，他们基于同一上下文并行发言，结果按 ROUND_SPEAKERS 的顺序写入状态
+# "off"：每次只有一名学生发言；"boundary"：阶段边界（病例引入、老师插话、主持人回复之后）进行一轮；
+# "always"：每次路由都进行一轮（讨论由预算结束）
+ROUND_MODE = os.getenv("PBL_ROUND_MODE", "off")
+# 参与轮次发言的学生及其写入顺序
+ROUND_SPEAKERS = ("analyst", "observer", "skeptic")
+
+# --- 投机生成 ---
+# 开启后，主持人 LLM 路由的同时为最可能的下一位学生提前生成发言（以 token 换延迟，适合小组）
+SPECULATIVE_ENABLED = False
+# 同时投机生成的学生分支数
+SPECULATIVE_MAX_BRANCHES = 2
+# 每个投机分支的最大输出 token 数；被截断的回复会被丢弃并重新生成
+SPECULATIVE_MAX_TOKENS = 800
+
+# --- 上下文与摘要 ---
+# 用于 token 计数的 tiktoken 编码（通义千问没有官方编码，以 cl100k_base 近似）
+TOKENIZER_ENCODING = "cl100k_base"
+# 单次调用的输入 token 预算：摘要 + 尽可能多的近期消息
+CONTEXT_TOKEN_BUDGET = 6000
+# 消息窗口的硬上限（条），防止摘要来不及执行时无限增长
+MAX_HISTORY_MESSAGES = 40
+# 未摘要的消息超过该条数，或其 token 数超过 CONTEXT_TOKEN_BUDGET 时触发摘要
+SUMMARY_TRIGGER_MESSAGES = 10
+# 摘要后在窗口中保留的最近消息条数，保证学生仍能看到上下文原文
+SUMMARY_KEEP_RECENT = 4
+# 滚动摘要的最大 token 数
+SUMMARY_MAX_TOKENS = 600
+# 在后台任务中摘要，讨论不必等待 SUM_LLM；关闭后由 summarizer 节点同步执行
+SUMMARY_BACKGROUND = True
+
+# --- 指南检索 ---
+# 检索索引目录（由 python -m backend.retrieval build 生成）；目录不存在时学生 prompt 不注入参考资料
+RETRIEVAL_INDEX_PATH = os.getenv(
+    "PBL_RETRIEVAL_INDEX", os.path.join(os.path.dirname(__file__), "data", "guideline_index")
+)
+# 每次学生发言最多注入的片段数
+RETRIEVAL_TOP_K = 4
+# 注入片段的 token 总数上限
+RETRIEVAL_TOKEN_BUDGET = 800
+# 用最近几条消息作为检索查询
+RETRIEVAL_QUERY_MESSAGES = 2
+# 建索引时每块的最大字符数与相邻块的重叠字符数
+RETRIEVAL_CHUNK_SIZE = 400
+RETRIEVAL_CHUNK_OVERLAP = 50
+
+# --- 检查点存储 ---
+# "memory"：进程内存（重启即丢失）；"sqlite"：本地磁盘，只保留最近的检查点并淘汰空闲会话
+CHECKPOINT_BACKEND = os.getenv("PBL_CHECKPOINT_BACKEND", "sqlite")
+# SQLite 文件路径
+CHECKPOINT_PATH = os.getenv(
+    "PBL_CHECKPOINT_PATH", os.path.join(os.path.dirname(__file__), "data", "checkpoints.sqlite")
+)
+# 每个会话保留的最近检查点个数
+CHECKPOINT_KEEP_LATEST = 3
+# 会话空闲超过该秒数后被淘汰（None 表示永不过期）
+CHECKPOINT_TTL_SECONDS = 6 * 3600
+# 后台压缩任务的执行间隔（秒）
+CHECKPOINT_COMPACT_INTERVAL = 300
+
+# --- LLM 网关 ---
+# 共享连接池的最大连接数（keep-alive）
+LLM_MAX_CONNECTIONS = 100
+# 全进程同时在途的 LLM 请求上限
+LLM_MAX_IN_FLIGHT = 32
+# 单个会话同时在途的 LLM 请求上限（需容纳投机分支 + 路由调用）
+LLM_MAX_IN_FLIGHT_PER_SESSION = 4
+# 排队请求达到该数量时向对应会话推送 backpressure 帧
+LLM_MAX_QUEUE = 64
+# 每分钟请求数 / token 数上限（None 表示不限）
+LLM_REQUESTS_PER_MINUTE = None
+LLM_TOKENS_PER_MINUTE = None
+# 429 / 5xx / 网络错误的最大重试次数
+LLM_MAX_RETRIES = 4
+# 单次请求超时（秒）
+LLM_REQUEST_TIMEOUT = 120.0
+# 估算 tokens/min 配额时，为每次调用预留的输出 token 数
+LLM_EXPECTED_COMPLETION_TOKENS = 512
+# 优先级老化：每排队这么多秒，请求的有效优先级提升一级（防止摘要等低优先级请求饿死）
+LLM_PRIORITY_AGING_SECONDS = 5.0
+
+# --- LLM 响应缓存 ---
+# 是否启用按内容寻址的响应缓存（相同模型参数与 prompt 直接复用之前的回复）
+LLM_CACHE_ENABLED = os.getenv("PBL_LLM_CACHE", "1") == "1"
+# 启用缓存的节点：默认只缓存低温度、结果较确定的主持人 / 摘要调用
+LLM_CACHE_NODES = {"router", "teacher_handler", "summarizer"}
+# 学生 LLM 的随机种子；设置后学生输出可复现，其节点（如 "student_analyst"）也可加入 LLM_CACHE_NODES
+LLM_CACHE_STUDENT_SEED = None
+# 内存 LRU 的最大条目数
+LLM_CACHE_MEMORY_ENTRIES = 2048
+# 磁盘缓存路径（None 表示只使用内存层）
+LLM_CACHE_PATH = os.getenv(
+    "PBL_LLM_CACHE_PATH", os.path.join(os.path.dirname(__file__), "data", "llm_cache.sqlite")
+)
+# 磁盘缓存的最大字节数，超过后按最近访问时间淘汰
+LLM_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# --- LLM 调用录制 / 回放 ---
+# off：正常调用模型；record：把每次调用写入会话的磁带文件；replay：只从磁带回放，不访问网络
+CASSETTE_MODE = os.getenv("PBL_CASSETTE", "off")
+# 磁带目录（每个会话一个 <session_id>.jsonl）
+CASSETTE_DIR = os.getenv("PBL_CASSETTE_DIR", os.path.join(os.path.dirname(__file__), "data", "cassettes"))
+# 回放节奏：original 按录制时的 token 到达时间输出，none 为零延迟
+CASSETTE_TIMING = os.getenv("PBL_CASSETTE_TIMING", "original")
+
+# --- 启动与预热 ---
+# 服务启动后是否预热：加载完成后载入 tokenizer 与检索索引，并向模型服务发起一次 max_tokens=1 的调用以建立连接池
+RUNTIME_WARMUP = os.getenv("PBL_WARMUP", "0") == "1"
+# 预热调用的超时（秒）；超时不影响就绪
+RUNTIME_WARMUP_TIMEOUT = 10.0
+
+# --- 指标与轨迹 ---
+# 是否为每个会话保留最近的节点 / LLM 调用轨迹（可通过 /metrics/trace/{session_id} 导出）
+METRICS_TRACE_ENABLED = os.getenv("PBL_TRACE", "0") == "1"
+# 每个会话保留的最近 span 数
+METRICS_TRACE_MAX_SPANS = 512
+# 最多保留轨迹的会话数（超过后淘汰最久未活动的会话）
+METRICS_TRACE_MAX_SESSIONS = 256
@@ -0,0 +1,146 @@
+"""PBL2.backend.context
+消息窗口 reducer 与按 token 预算组装 prompt 上下文。
+"""
+from __future__ import annotations
+
+from functools import lru_cache
+from typing import List, Optional, Sequence
+
+from langchain_core.messages import BaseMessage, RemoveMessage, SystemMessage
+from langgraph.graph.message import add_messages
+
+from .config import MAX_HISTORY_MESSAGES, TOKENIZER_ENCODING
+
+# 每条消息在对话格式中的固定开销（role、分隔符等），与 OpenAI 的计数方式一致
+_PER_MESSAGE_TOKENS = 4
+
+# 病例介绍消息的 name：它常驻消息窗口与每个 prompt，窗口截断或摘要合并之后讨论仍能看到病例
+CASE_MESSAGE_NAME = "case_introduction"
+
+
+def is_pinned(message: BaseMessage) -> bool:
+    return message.name == CASE_MESSAGE_NAME
+
+
+# -------------------- token 计数 --------------------
+
+@lru_cache(maxsize=1)
+def _encoding():
+    """加载 tiktoken 编码；离线环境下无法下载词表时返回 None，改用估算。"""
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception:
+        return None
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """统计一段文本的 token 数。"""
+    enc = _encoding()
+    if enc is not None:
+        return len(enc.encode(text))
+    # 估算：中日韩字符约 1 token/字，其余约 4 字符/token
+    cjk = sum(1 for ch in text if "⺀" <= ch <= "鿿")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _content_text(message: BaseMessage) -> str:
+    content = message.content
+    return content if isinstance(content, str) else str(content)
+
+
+def message_tokens(message: BaseMessage) -> int:
+    """单条消息（含格式开销）的 token 数。"""
+    return count_tokens(_content_text(message)) + _PER_MESSAGE_TOKENS
+
+
+def messages_tokens(messages: Sequence[BaseMessage]) -> int:
+    return sum(message_tokens(m) for m in messages)
+
+
+def truncate_text(text: str, max_tokens: int) -> str:
+    """把文本截断到不超过 ``max_tokens``，保留开头部分。"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    enc = _encoding()
+    if enc is not None:
+        return enc.decode(enc.encode(text)[:max_tokens])
+    # 估算模式下按比例截断后逐步收缩
+    cut = len(text) * max_tokens // max(count_tokens(text), 1)
+    while cut > 0 and count_tokens(text[:cut]) > max_tokens:
+        cut -= max(1, cut // 20)
+    return text[:cut]
+
+
+# -------------------- 消息窗口 --------------------
+
+def window_messages(left: List[BaseMessage], right: List[BaseMessage]) -> List[BaseMessage]:
+    """GraphState.messages 的 reducer。
+
+    在 ``add_messages`` 的基础上（分配 id、支持 RemoveMessage 删除），
+    只保留最近 ``MAX_HISTORY_MESSAGES`` 条，作为摘要来不及执行时的硬上限。
+    病例介绍不会被淘汰，摘要合并时对它的删除也被忽略。
+    """
+    if not isinstance(right, list):
+        right = [right]
+    # 已被窗口淘汰的消息无需再删除，否则 add_messages 会报错
+    existing = {m.id for m in left or [] if not is_pinned(m)}
+    right = [m for m in right if not isinstance(m, RemoveMessage) or m.id in existing]
+    merged = add_messages(left or [], right)
+    if len(merged) > MAX_HISTORY_MESSAGES:
+        pinned = [m for m in merged if is_pinned(m)][:MAX_HISTORY_MESSAGES - 1]
+        rest = [m for m in merged if not is_pinned(m)]
+        merged = pinned + rest[len(rest) - (MAX_HISTORY_MESSAGES - len(pinned)):]
+    return merged
+
+
+def unsummarized(messages: List[BaseMessage], watermark: Optional[str]) -> List[BaseMessage]:
+    """返回摘要水位线（最后一条已折叠消息的 id）之后的消息。"""
+    if watermark:
+        for idx, msg in enumerate(messages):
+            if msg.id == watermark:
+                return messages[idx + 1:]
+    return list(messages)
+
+
+# -------------------- 上下文组装 --------------------
+
+def fit_messages(messages: List[BaseMessage], budget: int) -> List[BaseMessage]:
+    """从最新的消息开始向前选取，直到用完 token 预算；至少保留最后一条。"""
+    selected: List[BaseMessage] = []
+    used = 0
+    for msg in reversed(messages):
+        cost = message_tokens(msg)
+        if selected and used + cost > budget:
+            break
+        selected.append(msg)
+        used += cost
+    selected.reverse()
+    return selected
+
+
+def build_context(
+    messages: List[BaseMessage],
+    summary: str,
+    budget: int,
+    reserved: int = 0,
+) -> List[BaseMessage]:
+    """组装放入 MessagesPlaceholder 的上下文：病例介绍 + 滚动摘要 + 预算内尽可能多的近期消息。
+
+    Args:
+        messages: 当前窗口内的消息。
+        summary: 到目前为止的滚动摘要，为空时不注入。
+        budget: 整个 prompt 的输入 token 预算。
+        reserved: 已被系统提示词等固定部分占用的 token 数。
+    """
+    # 病例介绍始终放在最前面，近期消息只从其余消息中选取
+    context = [m for m in messages if is_pinned(m)]
+    remaining = budget - reserved - messages_tokens(context)
+    if summary:
+        summary_msg = SystemMessage(content=f"【讨论摘要】\n{summary}")
+        context.append(summary_msg)
+        remaining -= message_tokens(summary_msg)
+    recent = [m for m in messages if not is_pinned(m)]
+    return context + (fit_messages(recent, remaining) if recent else [])
@@ -0,0 +1,62 @@
+"""PBL2.backend.event_log
+会话的出站事件日志：为每一帧分配单调递增的序号，并保留最近的若干帧，供断线重连后补发。
+"""
+from __future__ import annotations
+
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+Frame = Dict[str, Any]
+
+
+class EventLog:
+    """有界的事件日志。
+
+    某条消息完成（或被取消）后，它之前的 delta 帧就不再需要：完成帧包含全文，
+    客户端按 message_id 覆盖即可。因此这些 delta 会被压缩掉，日志里主要保留完成帧。
+    超出容量时淘汰最旧的帧，并记录被淘汰的最大序号，补发时据此判断是否出现缺口。
+    """
+
+    def __init__(self, max_events: int = 2000):
+        self.max_events = max_events
+        self._events: Deque[Frame] = deque()
+        self.last_seq = 0
+        # 序号不大于该值的帧已不在日志中
+        self.evicted_upto = 0
+
+    def append(self, frame: Frame) -> Frame:
+        """为帧分配序号并写入日志，返回带序号的帧。"""
+        self.last_seq += 1
+        return self._add({**frame, "seq": self.last_seq})
+
+    def insert(self, frame: Frame) -> Frame:
+        """写入一个已带序号的帧（由其他 worker 分配，经共享存储读到）。"""
+        self.last_seq = frame["seq"]
+        return self._add(frame)
+
+    def _add(self, frame: Frame) -> Frame:
+        if frame.get("type") in ("message_complete", "message_cancelled") and frame.get("message_id"):
+            self._drop_deltas(frame["message_id"])
+        self._events.append(frame)
+        while len(self._events) > self.max_events:
+            self.evicted_upto = self._events.popleft()["seq"]
+        return frame
+
+    def since(self, last_seq: int) -> Optional[List[Frame]]:
+        """返回序号大于 last_seq 的帧；其中一部分已被淘汰（或序号来自之前的进程）时返回 None。"""
+        if last_seq < self.evicted_upto or last_seq > self.last_seq:
+            return None
+        return [e for e in self._events if e["seq"] > last_seq]
+
+    def retained(self) -> List[Frame]:
+        return list(self._events)
+
+    def reset(self) -> None:
+        """开始新的讨论时清空日志（序号继续递增）。"""
+        self._events.clear()
+        self.evicted_upto = self.last_seq
+
+    def _drop_deltas(self, message_id: str) -> None:
+        self._events = deque(
+            e for e in self._events if not (e.get("type") == "delta" and e.get("message_id") == message_id)
+        )
@@ -0,0 +1,175 @@
+"""PBL2.backend.fake_llm
+本地的 OpenAI 兼容假模型服务，用于离线压测与基准测试（不消耗 DashScope 配额）。
+
+支持 ``/v1/chat/completions`` 的流式（SSE）与非流式调用，可配置首 token 延迟、
+输出速率与错误注入。把 ``PBL_LLM_BASE_URL`` 指向该服务即可让后端使用它：
+
+    python -m backend.fake_llm --port 9100 --latency 0.2 --tokens-per-sec 40
+    PBL_LLM_BASE_URL=http://127.0.0.1:9100/v1 uvicorn backend.server:app_fastapi
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import random
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Dict, List
+
+import orjson
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# 学生发言使用的语料，按空格切分为“token”逐个输出
+_STUDENT_REPLY = (
+    "结合 病史 与 心电图 表现 目前 可能 是 急性 冠脉 综合征 需要 进一步 确认 "
+    "建议 完善 肌钙蛋白 动态 监测 与 床旁 超声 同时 排除 主动脉 夹层 与 肺栓塞"
+)
+_SUMMARY_REPLY = "摘要： 讨论 围绕 胸痛 的 鉴别 诊断 与 检查 计划 展开 尚未 形成 最终 结论"
+_ROUTER_CHOICES = ("analyst", "observer", "skeptic")
+
+
+@dataclass
+class FakeLLMSettings:
+    """假模型的行为参数。
+
+    Args:
+        latency: 首个 token 之前的等待秒数。
+        tokens_per_sec: 流式输出速率（每秒 token 数）；0 表示不限速。
+        error_rate: 以该概率返回可重试的错误（随机 429 / 503）。
+        max_tokens: 单次回复的最大 token 数。
+        seed: 随机种子（路由选择与错误注入）。
+    """
+
+    latency: float = 0.2
+    tokens_per_sec: float = 50.0
+    error_rate: float = 0.0
+    max_tokens: int = 64
+    seed: int = 0
+
+
+def _reply_tokens(messages: List[Dict], max_tokens: int, rng: random.Random) -> List[str]:
+    """按系统提示词判断调用方，生成对应的回复 token。"""
+    system = " ".join(m.get("content") or "" for m in messages if m.get("role") == "system")
+    if "下一位发言人" in system:
+        return [rng.choice(_ROUTER_CHOICES)]
+    if "总结" in system:
+        words = _SUMMARY_REPLY.split()
+    else:
+        words = _STUDENT_REPLY.split()
+    return [w + " " for w in words[:max_tokens]]
+
+
+def _usage(messages: List[Dict], tokens: List[str]) -> Dict[str, int]:
+    prompt_tokens = sum(len(m.get("content") or "") for m in messages)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": len(tokens),
+        "total_tokens": prompt_tokens + len(tokens),
+    }
+
+
+def create_app(settings: FakeLLMSettings) -> FastAPI:
+    """创建假模型服务的 FastAPI 应用。"""
+    app = FastAPI()
+    rng = random.Random(settings.seed)
+    stats = {"requests": 0, "streamed": 0, "errors_injected": 0}
+
+    @app.get("/health")
+    def health():
+        return {"status": "ok", **stats}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+        if settings.error_rate and rng.random() < settings.error_rate:
+            stats["errors_injected"] += 1
+            status = rng.choice((429, 503))
+            return JSONResponse(
+                {"error": {"message": "injected error", "type": "fake_llm", "code": status}},
+                status_code=status,
+            )
+
+        messages = body.get("messages", [])
+        limit = min(body.get("max_tokens") or settings.max_tokens, settings.max_tokens)
+        tokens = _reply_tokens(messages, limit, rng)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        model = body.get("model", "fake")
+        finish_reason = "length" if len(tokens) >= limit and limit < settings.max_tokens else "stop"
+
+        if not body.get("stream"):
+            await asyncio.sleep(settings.latency + (len(tokens) / settings.tokens_per_sec if settings.tokens_per_sec else 0))
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "finish_reason": finish_reason,
+                }],
+                "usage": _usage(messages, tokens),
+            }
+
+        stats["streamed"] += 1
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+
+        def _frame(choices: List[Dict], **extra) -> bytes:
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": choices,
+                **extra,
+            }
+            return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+        async def _events():
+            await asyncio.sleep(settings.latency)
+            interval = 1.0 / settings.tokens_per_sec if settings.tokens_per_sec else 0
+            for i, token in enumerate(tokens):
+                delta = {"content": token}
+                if i == 0:
+                    delta["role"] = "assistant"
+                yield _frame([{"index": 0, "delta": delta, "finish_reason": None}])
+                if interval:
+                    await asyncio.sleep(interval)
+            yield _frame([{"index": 0, "delta": {}, "finish_reason": finish_reason}])
+            if include_usage:
+                yield _frame([], usage=_usage(messages, tokens))
+            yield b"data: [DONE]\n\n"
+
+        return StreamingResponse(_events(), media_type="text/event-stream")
+
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="OpenAI 兼容的本地假模型服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", type=float, default=0.2, help="首 token 延迟（秒）")
+    parser.add_argument("--tokens-per-sec", type=float, default=50.0, help="输出速率，0 表示不限速")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="注入 429/503 错误的概率")
+    parser.add_argument("--max-tokens", type=int, default=64, help="单次回复的最大 token 数")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    settings = FakeLLMSettings(
+        latency=args.latency,
+        tokens_per_sec=args.tokens_per_sec,
+        error_rate=args.error_rate,
+        max_tokens=args.max_tokens,
+        seed=args.seed,
+    )
+    uvicorn.run(create_app(settings), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
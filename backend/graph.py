@@ -1,14 +1,21 @@
 """PBL2.backend.graph
 定义 LangGraph 的状态和图的结构。
 """
-from typing import List, Annotated
+from typing import Dict, List, Annotated, Optional
 from langchain_core.messages import BaseMessage
 from typing_extensions import TypedDict
-import operator
 from langgraph.graph import StateGraph, END
-from langgraph.checkpoint.memory import MemorySaver
+from langgraph.types import Send
 
 from . import agents
+from .budget import add_usage
+from .context import window_messages
+from .metrics import timed_node
+
+
+def _latest(left: str, right: str) -> str:
+    """next_speaker 的 reducer：轮次发言时几个学生节点在同一步写入，取最后一个值。"""
+    return right
 
 
 class GraphState(TypedDict):
@@ -16,36 +23,55 @@ class GraphState(TypedDict):
     表示图的状态。
 
     Attributes:
-        messages: 讨论中交换的消息列表。
+        messages: 讨论中交换的消息列表（窗口化，已摘要的旧消息会被移除）。
         discussion_stage: PBL 讨论的当前阶段。
-        summary: 到目前为止的讨论摘要。
-        next_speaker: 预定下一个发言的 Agent。
+        summary: 到目前为止的滚动摘要。
+        summary_watermark: 最后一条已折叠进摘要的消息 id。
+        next_speaker: 预定下一个发言的 Agent；"round" 表示 round_speakers 中的学生并行发言。
+        round_speakers: 本轮并行发言的学生节点，按写入状态的顺序排列。
         is_teacher_interrupted: 标志位，指示老师是否已介入。
+        budget: 本会话的预算（max_turns / max_tokens / max_seconds，见 budget.py）。
+        usage: 已用的学生发言轮数与 LLM token 数（节点返回增量，累加合并）。
+        started_at: 讨论开始的时间戳，用于墙钟预算。
+        budget_exhausted: 已用完的预算项；非空表示总结已生成、讨论已结束。
     """
-    messages: Annotated[List[BaseMessage], operator.add]
+    messages: Annotated[List[BaseMessage], window_messages]
     discussion_stage: str
     summary: str
-    next_speaker: str
+    summary_watermark: str
+    next_speaker: Annotated[str, _latest]
+    round_speakers: List[str]
     is_teacher_interrupted: bool
+    budget: Dict[str, Optional[float]]
+    usage: Annotated[Dict[str, int], add_usage]
+    started_at: float
+    budget_exhausted: str
 
 
 # --------- 构建图 --------- 
 wf = StateGraph(GraphState)
 
-# 添加所有节点
-wf.add_node("student_analyst", agents.STUDENT_ANALYST)
-wf.add_node("student_observer", agents.STUDENT_OBSERVER)
-wf.add_node("student_skeptic", agents.STUDENT_SKEPTIC)
-wf.add_node("teacher_handler", agents.teacher_handler_node)
-wf.add_node("summarizer", agents.summarizer_node)
-wf.add_node("router", agents.router_node)
+# 添加所有节点（每个节点都记录耗时，见 metrics.py）
+wf.add_node("student_analyst", timed_node("student_analyst", agents.STUDENT_ANALYST))
+wf.add_node("student_observer", timed_node("student_observer", agents.STUDENT_OBSERVER))
+wf.add_node("student_skeptic", timed_node("student_skeptic", agents.STUDENT_SKEPTIC))
+wf.add_node("teacher_handler", timed_node("teacher_handler", agents.teacher_handler_node))
+wf.add_node("summarizer", timed_node("summarizer", agents.summarizer_node))
+wf.add_node("final_summary", timed_node("final_summary", agents.final_summary_node))
+wf.add_node("router", timed_node("router", agents.router_node))
 
 # 设置入口点
 wf.set_entry_point("router")
 
 # 定义条件路由
 def _conditional_router(state: GraphState):
-    """根据 next_speaker 决定下一个节点。"""
+    """根据 next_speaker 决定下一个节点。
+
+    轮次发言时为每名学生发出一个 Send，它们在同一步并行执行、读取同一份状态；
+    LangGraph 按 Send 的顺序合并各节点的写入，因此消息的顺序与 round_speakers 一致，与完成先后无关。
+    """
+    if state["next_speaker"] == "round":
+        return [Send(speaker, state) for speaker in state["round_speakers"]]
     return state["next_speaker"]
 
 wf.add_conditional_edges(
@@ -57,6 +83,7 @@ wf.add_conditional_edges(
         "student_skeptic": "student_skeptic",
         "teacher_handler": "teacher_handler",
         "summarizer": "summarizer",
+        "final_summary": "final_summary",
         "END": END,
     },
 )
@@ -67,10 +94,7 @@ wf.add_edge("student_observer", "router")
 wf.add_edge("student_skeptic", "router")
 wf.add_edge("teacher_handler", "router")
 wf.add_edge("summarizer", "router")
+# 预算用完后的总结是讨论的最后一步
+wf.add_edge("final_summary", END)
 
-# --------- 添加检查点并编译 ---------
-# 使用内存检查点来保存状态
-checkpointer = MemorySaver()
-
-# 编译图，并附加检查点
-app = wf.compile(checkpointer=checkpointer)
+# 检查点存储与编译好的图（app）由 COMPONENTS 在服务启动时构建，见 components.py
@@ -0,0 +1,175 @@
+"""PBL2.backend.llm_cache
+按内容寻址的 LLM 响应缓存：内存 LRU + SQLite 磁盘两级。
+
+缓存键是模型名、温度、请求参数（EXTRA_BODY 等）与格式化后消息的稳定哈希（xxhash），
+消息 id 等每次运行都会变化的字段不参与计算。
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import orjson
+import xxhash
+from langchain_core.messages import AIMessage, BaseMessage
+
+
+def cache_key(llm: Any, prompt: List[BaseMessage]) -> str:
+    """计算一次调用的缓存键。``llm`` 可以是 ChatOpenAI 或其 ``.bind(...)`` 结果。"""
+    model = getattr(llm, "bound", llm)
+    bound_kwargs = getattr(llm, "kwargs", {}) if model is not llm else {}
+    payload = {
+        "model": getattr(model, "model_name", None),
+        "temperature": getattr(model, "temperature", None),
+        "seed": getattr(model, "seed", None),
+        "extra_body": getattr(model, "extra_body", None),
+        "model_kwargs": getattr(model, "model_kwargs", None),
+        "bound": bound_kwargs,
+        "messages": [
+            [m.type, m.name, m.content if isinstance(m.content, str) else str(m.content)]
+            for m in prompt
+        ],
+    }
+    raw = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS, default=str)
+    return xxhash.xxh3_128_hexdigest(raw)
+
+
+def _dump_message(message: AIMessage) -> bytes:
+    return orjson.dumps(
+        {"content": message.content, "response_metadata": message.response_metadata},
+        default=str,
+    )
+
+
+def _load_message(raw: bytes) -> AIMessage:
+    data = orjson.loads(raw)
+    # 命中缓存的回复不消耗 token，因此不带 usage_metadata
+    return AIMessage(
+        content=data["content"],
+        response_metadata={**data.get("response_metadata", {}), "cache_hit": True},
+        id=f"cache-{uuid.uuid4()}",
+    )
+
+
+class ResponseCache:
+    """两级响应缓存。
+
+    Args:
+        max_entries: 内存 LRU 的最大条目数。
+        path: SQLite 文件路径；None 表示只使用内存层。
+        max_bytes: 磁盘层的最大字节数，超过后按最近访问时间淘汰。
+    """
+
+    def __init__(self, max_entries: int = 2048, path: Optional[str] = None, max_bytes: int = 256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._disk_bytes = 0
+        self.stats: Dict[str, int] = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "puts": 0,
+            "evictions": 0,
+        }
+        if path:
+            if path != ":memory:":
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed)")
+            self._disk_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    # ---------- 内存层 ----------
+
+    def _memory_get(self, key: str) -> Optional[bytes]:
+        raw = self._memory.get(key)
+        if raw is not None:
+            self._memory.move_to_end(key)
+        return raw
+
+    def _memory_put(self, key: str, raw: bytes) -> None:
+        self._memory[key] = raw
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    # ---------- 磁盘层 ----------
+
+    def _disk_get(self, key: str) -> Optional[bytes]:
+        if self._conn is None:
+            return None
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM responses WHERE key=?", (key,)).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE responses SET accessed=? WHERE key=?", (time.time(), key))
+        return row[0] if row else None
+
+    def _disk_put(self, key: str, raw: bytes) -> None:
+        if self._conn is None:
+            return
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM responses WHERE key=?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, raw, len(raw), time.time())
+            )
+            self._disk_bytes += len(raw) - (old[0] if old else 0)
+            if self._disk_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """按最近访问时间淘汰，直到磁盘层降到上限的 90%（需持锁调用）。"""
+        target = self.max_bytes * 0.9
+        rows = self._conn.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall()
+        doomed = []
+        for key, size in rows:
+            if self._disk_bytes <= target:
+                break
+            doomed.append((key,))
+            self._disk_bytes -= size
+        self._conn.executemany("DELETE FROM responses WHERE key=?", doomed)
+        self.stats["evictions"] += len(doomed)
+
+    # ---------- 对外接口 ----------
+
+    async def aget(self, key: str) -> Optional[AIMessage]:
+        raw = self._memory_get(key)
+        if raw is not None:
+            self.stats["memory_hits"] += 1
+            return _load_message(raw)
+        raw = await asyncio.to_thread(self._disk_get, key)
+        if raw is not None:
+            self.stats["disk_hits"] += 1
+            self._memory_put(key, raw)
+            return _load_message(raw)
+        self.stats["misses"] += 1
+        return None
+
+    async def aput(self, key: str, message: AIMessage) -> None:
+        raw = _dump_message(message)
+        self._memory_put(key, raw)
+        self.stats["puts"] += 1
+        await asyncio.to_thread(self._disk_put, key, raw)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """命中率与各层大小。"""
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_ratio": round(hits / total, 4) if total else 0.0,
+            "memory_entries": len(self._memory),
+            "disk_bytes": self._disk_bytes,
+        }
@@ -0,0 +1,254 @@
+"""PBL2.backend.llm_gateway
+统一的 LLM 网关：所有节点的模型调用都经过这里。
+
+- 共享一个 keep-alive 的异步 HTTP 连接池；
+- 全局与单会话的并发上限，全局槽位按优先级分配（见 priority.py）；
+- 按请求数 / token 数（每分钟）的令牌桶限流；
+- 对 429 / 5xx / 网络错误做带抖动的指数退避重试（tenacity）；
+- 排队过长时通知对应会话（由 WebSocket 层推送 backpressure 帧）。
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+import httpx
+import openai
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+from .priority import Priority, PriorityLimiter
+
+T = TypeVar("T")
+
+# 会话收到背压通知的回调：参数为要推送给客户端的帧
+BackpressureListener = Callable[[Dict], Awaitable[None]]
+
+
+class PartialStreamError(Exception):
+    """流式输出中途失败：已有 token 推送给客户端，不能透明重试。"""
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """限流、服务端错误与网络错误可以重试；其余（参数错误、鉴权失败等）直接抛出。"""
+    if isinstance(exc, (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code == 429 or exc.status_code >= 500
+    return isinstance(exc, httpx.TransportError)
+
+
+class TokenBucket:
+    """每分钟 ``rate`` 个令牌的令牌桶，容量默认等于一分钟的配额。
+
+    允许余额为负：按估算扣除后再用实际用量校正。
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self._level = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount: float) -> None:
+        """等待直到桶中有足够的令牌，然后扣除。"""
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._level >= amount:
+                    self._level -= amount
+                    return
+                await asyncio.sleep((amount - self._level) / self.rate)
+
+    def adjust(self, delta: float) -> None:
+        """按实际用量校正余额（delta 为正表示多扣）。"""
+        self._refill()
+        self._level = min(self.capacity, self._level - delta)
+
+
+class LLMGateway:
+    """所有会话共享的 LLM 调用入口。"""
+
+    def __init__(
+        self,
+        *,
+        max_connections: int = 100,
+        max_in_flight: int = 32,
+        max_in_flight_per_session: int = 4,
+        max_queue: int = 64,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        max_retries: int = 4,
+        timeout: float = 120.0,
+        aging_seconds: float = 5.0,
+    ):
+        # 所有 ChatOpenAI 实例共用的连接池
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            timeout=timeout,
+        )
+        self.max_in_flight = max_in_flight
+        self.max_in_flight_per_session = max_in_flight_per_session
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self._global = PriorityLimiter(max_in_flight, aging_seconds=aging_seconds)
+        self._sessions: Dict[str, asyncio.Semaphore] = {}
+        self._session_refs: Dict[str, int] = {}
+        self._rpm = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._tpm = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._listeners: Dict[str, BackpressureListener] = {}
+        self.in_flight = 0
+        self.queued = 0
+        self.stats: Dict[str, int] = {"calls": 0, "retries": 0, "failures": 0, "backpressure": 0}
+
+    # ---------- 背压通知 ----------
+
+    def add_listener(self, session_id: str, listener: BackpressureListener) -> None:
+        self._listeners[session_id] = listener
+
+    def remove_listener(self, session_id: str) -> None:
+        self._listeners.pop(session_id, None)
+
+    async def _notify(self, session_id: Optional[str], frame: Dict) -> None:
+        listener = self._listeners.get(session_id) if session_id else None
+        if listener is not None:
+            try:
+                await listener(frame)
+            except Exception:
+                pass  # 通知失败不影响调用本身
+
+    # ---------- 准入 ----------
+
+    @asynccontextmanager
+    async def _admit(self, session_id: Optional[str], est_tokens: int, priority: Priority):
+        """按 会话并发 -> 限流 -> 全局并发（按优先级排队） 的顺序获取调用资格。
+
+        限流等待在占用全局槽位之前完成：被限流的请求只是在睡眠，不应占着槽位挡住更高优先级的调用。
+        """
+        session_sem = None
+        if session_id:
+            session_sem = self._sessions.get(session_id)
+            if session_sem is None:
+                session_sem = self._sessions[session_id] = asyncio.Semaphore(self.max_in_flight_per_session)
+            self._session_refs[session_id] = self._session_refs.get(session_id, 0) + 1
+
+        try:
+            if session_sem is not None:
+                await session_sem.acquire()
+            try:
+                if self._rpm is not None:
+                    await self._rpm.acquire(1)
+                if self._tpm is not None:
+                    await self._tpm.acquire(est_tokens)
+                waited = self._global.locked()
+                signalled = False
+                if waited:
+                    self.queued += 1
+                    if self.queued >= self.max_queue:
+                        signalled = True
+                        self.stats["backpressure"] += 1
+                        await self._notify(
+                            session_id, {"type": "backpressure", "state": "queued", "queued": self.queued}
+                        )
+                try:
+                    await self._global.acquire(priority)
+                except BaseException:
+                    # 请求在排队时被取消：退还已扣除的限流令牌
+                    if self._rpm is not None:
+                        self._rpm.adjust(-1)
+                    if self._tpm is not None:
+                        self._tpm.adjust(-est_tokens)
+                    raise
+                finally:
+                    if waited:
+                        self.queued -= 1
+                try:
+                    if signalled:
+                        await self._notify(
+                            session_id, {"type": "backpressure", "state": "resumed", "queued": self.queued}
+                        )
+                    self.in_flight += 1
+                    try:
+                        yield
+                    finally:
+                        self.in_flight -= 1
+                finally:
+                    self._global.release()
+            finally:
+                if session_sem is not None:
+                    session_sem.release()
+        finally:
+            if session_id:
+                self._session_refs[session_id] -= 1
+                if not self._session_refs[session_id]:
+                    del self._session_refs[session_id]
+                    self._sessions.pop(session_id, None)
+
+    # ---------- 调用 ----------
+
+    async def run(
+        self,
+        call: Callable[[], Awaitable[T]],
+        *,
+        session_id: Optional[str] = None,
+        est_tokens: int = 0,
+        usage_of: Optional[Callable[[T], Optional[int]]] = None,
+        priority: Priority = Priority.STUDENT,
+    ) -> T:
+        """在网关的准入与重试控制下执行一次模型调用。
+
+        Args:
+            call: 执行实际请求的无参协程工厂，每次重试都会重新调用。
+            session_id: 发起调用的会话，用于单会话并发控制与背压通知。
+            est_tokens: 预计消耗的 token 数（prompt + 预期输出），用于 tokens/min 限流。
+            usage_of: 从结果中取出实际 token 用量，用于校正令牌桶。
+            priority: 请求的优先级类别，决定全局槽位紧张时的调度顺序。
+        """
+        self.stats["calls"] += 1
+        retrying = AsyncRetrying(
+            stop=stop_after_attempt(self.max_retries + 1),
+            wait=wait_random_exponential(multiplier=0.5, max=8),
+            retry=retry_if_exception(is_retryable),
+            reraise=True,
+        )
+        try:
+            async for attempt in retrying:
+                with attempt:
+                    if attempt.retry_state.attempt_number > 1:
+                        self.stats["retries"] += 1
+                    async with self._admit(session_id, est_tokens, priority):
+                        result = await call()
+        except Exception:
+            self.stats["failures"] += 1
+            raise
+
+        if self._tpm is not None and usage_of is not None:
+            actual = usage_of(result)
+            if actual is not None:
+                self._tpm.adjust(actual - est_tokens)
+        return result
+
+    def snapshot(self) -> Dict[str, int]:
+        """当前排队 / 在途数量与累计统计。"""
+        return {
+            **self.stats,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "priority": self._global.stats(),
+        }
+
+    async def aclose(self) -> None:
+        await self.http_client.aclose()
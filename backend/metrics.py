@@ -0,0 +1,256 @@
+"""PBL2.backend.metrics
+常驻的轻量级指标：图节点与 LLM 调用的耗时、首 token 延迟、token 用量，以及会话 / 队列 / 存储的仪表。
+
+以 Prometheus 文本格式通过 ``/metrics`` 暴露。所有记录都发生在事件循环线程上，
+只做字典查找、二分查找桶与整数累加，不加锁，开销可以忽略。
+可选地为每个会话保留最近的调用轨迹（METRICS_TRACE_ENABLED）。
+"""
+from __future__ import annotations
+
+import functools
+import time
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from typing import TYPE_CHECKING, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+from .config import METRICS_TRACE_ENABLED, METRICS_TRACE_MAX_SPANS, METRICS_TRACE_MAX_SESSIONS
+
+if TYPE_CHECKING:
+    # 只用于类型注解；指标模块被服务端最先导入，不为它加载 langchain
+    from langchain_core.runnables import RunnableConfig
+
+LabelValues = Tuple[str, ...]
+
+# 秒级耗时的默认桶：覆盖本地调度（毫秒级）到长回复（数十秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: LabelValues, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """单调递增计数器。"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name, self.help, self.label_names = name, help_text, tuple(labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_labels(self.label_names, k)} {_number(v)}" for k, v in self._values.items()]
+
+
+class Gauge:
+    """瞬时值；可以直接 set / inc / dec，也可以给出在导出时才求值的回调。"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (), callback: Optional[Callable[[], float]] = None):
+        self.name, self.help, self.label_names = name, help_text, tuple(labels)
+        self._values: Dict[LabelValues, float] = {}
+        self.callback = callback
+
+    def set(self, value: float, *labels: str) -> None:
+        self._values[labels] = value
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def render(self) -> List[str]:
+        if self.callback is not None:
+            try:
+                value = self.callback()
+            except Exception:
+                return []  # 导出时的采集失败不影响其他指标
+            return [] if value is None else [f"{self.name} {_number(value)}"]
+        return [f"{self.name}{_labels(self.label_names, k)} {_number(v)}" for k, v in self._values.items()]
+
+
+class Histogram:
+    """固定桶的直方图（累计桶在导出时计算）。"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name, self.help, self.label_names = name, help_text, tuple(labels)
+        self.buckets = tuple(buckets)
+        # labels -> [各桶计数..., +Inf 桶计数, 总和]
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        row = self._values.get(labels)
+        if row is None:
+            row = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        row[bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, row in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), row):
+                cumulative += count
+                le = 'le="%s"' % _number(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_number(row[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """指标的集合，负责 Prometheus 文本格式导出。"""
+
+    def __init__(self):
+        self._metrics: "OrderedDict[str, object]" = OrderedDict()
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, labels: Sequence[str] = (), callback=None) -> Gauge:
+        return self.register(Gauge(name, help_text, labels, callback))
+
+    def histogram(self, name: str, help_text: str, labels: Sequence[str] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class TraceLog:
+    """每个会话最近 max_spans 条调用轨迹，最多保留 max_sessions 个会话（LRU）。"""
+
+    def __init__(self, max_spans: int, max_sessions: int):
+        self.max_spans = max_spans
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, Deque[Dict]]" = OrderedDict()
+
+    def add(self, session_id: Optional[str], span: Dict) -> None:
+        if not session_id:
+            return
+        spans = self._sessions.get(session_id)
+        if spans is None:
+            spans = self._sessions[session_id] = deque(maxlen=self.max_spans)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        else:
+            self._sessions.move_to_end(session_id)
+        spans.append(span)
+
+    def dump(self, session_id: str) -> List[Dict]:
+        return list(self._sessions.get(session_id, ()))
+
+    def discard(self, session_id: str) -> None:
+        self._sessions.pop(session_id, None)
+
+
+# -------------------- 全局指标 --------------------
+REGISTRY = Registry()
+
+NODE_DURATION = REGISTRY.histogram("pbl_node_duration_seconds", "Wall time of each graph node run.", ["node"])
+NODE_ERRORS = REGISTRY.counter("pbl_node_errors_total", "Graph node runs that raised.", ["node"])
+LLM_DURATION = REGISTRY.histogram("pbl_llm_duration_seconds", "Wall time of LLM calls, including queueing and retries.", ["node"])
+LLM_TTFT = REGISTRY.histogram("pbl_llm_time_to_first_token_seconds", "Time from LLM call start to the first token.", ["node"])
+LLM_TOKENS = REGISTRY.counter("pbl_llm_tokens_total", "Tokens reported in the OpenAI usage field.", ["node", "kind"])
+LLM_CACHE_HITS = REGISTRY.counter("pbl_llm_cache_hits_total", "LLM calls answered from the response cache.", ["node"])
+CHECKPOINT_DURATION = REGISTRY.histogram("pbl_checkpoint_write_seconds", "Time spent writing checkpoints.", ["op"])
+ACTIVE_SESSIONS = REGISTRY.gauge("pbl_active_sessions", "Open discussion sessions.")
+WS_SUBSCRIBERS = REGISTRY.gauge("pbl_ws_subscribers", "Connected WebSocket subscribers.", ["role"])
+WS_FRAMES_COALESCED = REGISTRY.counter("pbl_ws_frames_coalesced_total", "Queued delta frames merged or dropped for slow subscribers.")
+WS_SLOW_CONSUMERS = REGISTRY.counter("pbl_ws_slow_consumers_total", "Subscribers disconnected because their queue overflowed.")
+BUDGET_EXHAUSTED = REGISTRY.counter("pbl_budget_exhausted_total", "Discussions wrapped up because a budget ran out.", ["limit"])
+RETRIEVAL_DURATION = REGISTRY.histogram(
+    "pbl_retrieval_seconds", "Guideline index lookups for student prompts.",
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05),
+)
+
+TRACES = TraceLog(METRICS_TRACE_MAX_SPANS, METRICS_TRACE_MAX_SESSIONS) if METRICS_TRACE_ENABLED else None
+
+
+def _thread_id(config: Optional[RunnableConfig]) -> Optional[str]:
+    if not config:
+        return None
+    return config.get("configurable", {}).get("thread_id")
+
+
+def trace(config: Optional[RunnableConfig], span: Dict) -> None:
+    """开启轨迹记录时，把一条 span 追加到对应会话。"""
+    if TRACES is not None:
+        TRACES.add(_thread_id(config), span)
+
+
+def record_llm_call(
+    node: Optional[str],
+    config: Optional[RunnableConfig],
+    started: float,
+    ttft: Optional[float],
+    usage: Optional[Dict],
+) -> None:
+    """记录一次 LLM 调用的耗时、首 token 延迟与 token 用量（started 为 perf_counter 时间）。"""
+    label = node or "unknown"
+    duration = time.perf_counter() - started
+    LLM_DURATION.observe(duration, label)
+    if ttft is not None:
+        LLM_TTFT.observe(ttft, label)
+    prompt_tokens = usage.get("input_tokens", 0) if usage else 0
+    completion_tokens = usage.get("output_tokens", 0) if usage else 0
+    if usage:
+        LLM_TOKENS.inc(label, "prompt", amount=prompt_tokens)
+        LLM_TOKENS.inc(label, "completion", amount=completion_tokens)
+    trace(config, {
+        "kind": "llm",
+        "node": label,
+        "at": time.time() - duration,
+        "duration": round(duration, 4),
+        "ttft": round(ttft, 4) if ttft is not None else None,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+    })
+
+
+def timed_node(name: str, fn):
+    """包装一个异步图节点，记录其耗时与异常次数。"""
+
+    @functools.wraps(fn)
+    async def _node(state: Dict, config: Optional[RunnableConfig] = None) -> Dict:
+        started = time.perf_counter()
+        try:
+            return await fn(state, config)
+        except Exception:
+            NODE_ERRORS.inc(name)
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            NODE_DURATION.observe(duration, name)
+            trace(config, {"kind": "node", "node": name, "at": time.time() - duration, "duration": round(duration, 4)})
+
+    return _node
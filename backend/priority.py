@@ -0,0 +1,119 @@
+"""PBL2.backend.priority
+跨会话的 LLM 请求优先级调度：老师回应 > 路由 > 学生发言 > 摘要。
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import deque
+from enum import IntEnum
+from typing import Deque, Dict, Tuple
+
+
+class Priority(IntEnum):
+    """优先级类别，数值越小越先被调度。"""
+
+    TEACHER = 0
+    ROUTING = 1
+    STUDENT = 2
+    SUMMARY = 3
+
+
+class PriorityLimiter:
+    """带优先级的并发槽位分配器，用来替代普通的 Semaphore。
+
+    同一类别内先进先出；不同类别之间按“优先级 - 等待秒数 / aging_seconds”的有效值比较，
+    等待越久的低优先级请求会逐渐提升，从而保证任何类别都不会被饿死。
+    """
+
+    def __init__(self, capacity: int, aging_seconds: float = 5.0):
+        self.capacity = capacity
+        self.aging_seconds = aging_seconds
+        self._in_use = 0
+        # 每个类别一个等待队列：(入队时间, future)
+        self._waiters: Dict[Priority, Deque[Tuple[float, asyncio.Future]]] = {p: deque() for p in Priority}
+        self._stats: Dict[Priority, Dict[str, float]] = {
+            p: {"admitted": 0, "wait_total": 0.0, "wait_max": 0.0} for p in Priority
+        }
+
+    # ---------- 对外接口 ----------
+
+    def locked(self) -> bool:
+        """没有空闲槽位，或已有请求在排队。"""
+        return self._in_use >= self.capacity or self.queued > 0
+
+    @property
+    def queued(self) -> int:
+        return sum(len(q) for q in self._waiters.values())
+
+    @property
+    def in_use(self) -> int:
+        return self._in_use
+
+    async def acquire(self, priority: Priority) -> None:
+        enqueued = time.monotonic()
+        if not self.locked():
+            self._in_use += 1
+            self._record(priority, enqueued)
+            return
+
+        fut = asyncio.get_running_loop().create_future()
+        entry = (enqueued, fut)
+        self._waiters[priority].append(entry)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # 槽位已经分配给我们，但调用方放弃了：转交给下一个
+                self.release()
+            elif entry in self._waiters[priority]:
+                self._waiters[priority].remove(entry)
+            raise
+        self._record(priority, enqueued)
+
+    def release(self) -> None:
+        self._in_use -= 1
+        self._dispatch()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """每个类别的当前排队深度与等待时间统计（秒）。"""
+        result = {}
+        for p in Priority:
+            s = self._stats[p]
+            admitted = s["admitted"]
+            result[p.name.lower()] = {
+                "queued": len(self._waiters[p]),
+                "admitted": int(admitted),
+                "wait_avg": round(s["wait_total"] / admitted, 4) if admitted else 0.0,
+                "wait_max": round(s["wait_max"], 4),
+            }
+        return result
+
+    # ---------- 内部 ----------
+
+    def _record(self, priority: Priority, enqueued: float) -> None:
+        waited = time.monotonic() - enqueued
+        s = self._stats[priority]
+        s["admitted"] += 1
+        s["wait_total"] += waited
+        s["wait_max"] = max(s["wait_max"], waited)
+
+    def _dispatch(self) -> None:
+        """把空闲槽位分配给有效优先级最高的等待者。"""
+        while self._in_use < self.capacity:
+            now = time.monotonic()
+            best = None
+            best_score = None
+            for p, queue in self._waiters.items():
+                if not queue:
+                    continue
+                score = p - (now - queue[0][0]) / self.aging_seconds
+                if best_score is None or score < best_score:
+                    best, best_score = p, score
+            if best is None:
+                return
+            _, fut = self._waiters[best].popleft()
+            if fut.done():
+                continue
+            self._in_use += 1
+            fut.set_result(None)
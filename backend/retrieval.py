@@ -0,0 +1,313 @@
+"""PBL2.backend.retrieval
+本地指南 / 病例资料检索：把一个目录下的文档切块后建立 BM25 倒排索引，存为可内存映射的 NumPy 文件。
+
+学生每次发言前只取与近期讨论最相关的 top-k 片段（在 token 预算内）放入 prompt，
+代替在系统提示词中塞入大段固定的背景资料。
+
+    python -m backend.retrieval build guidelines/ --index backend/data/guideline_index
+    python -m backend.retrieval query "胸痛 肌钙蛋白 升高" --index backend/data/guideline_index
+
+索引目录结构：
+    meta.json             参数、词表、每个块的来源
+    postings_offsets.npy  每个词的倒排表在下面两个数组中的起止位置（int64，长度 = 词数 + 1）
+    postings_chunks.npy   倒排表中的块编号（int32）
+    postings_weights.npy  预先算好的 BM25 词项得分（float32），查询时只需按块累加
+    chunk_tokens.npy      每个块的 token 数，用于按预算挑选片段
+    text.bin / text_offsets.npy  所有块的 UTF-8 文本及其偏移
+    vectors.npy           （可选）建索引时传入 embeddings 得到的归一化向量
+
+检索只是对若干个 mmap 数组切片求和再取 top-k，在数万个块的规模下单次查询远低于 1 ms。
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import mmap
+import os
+import re
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from .config import RETRIEVAL_CHUNK_OVERLAP, RETRIEVAL_CHUNK_SIZE, RETRIEVAL_TOKEN_BUDGET, RETRIEVAL_TOP_K
+from .context import count_tokens
+
+INDEX_VERSION = 1
+# 参与建索引的文件类型
+DOCUMENT_SUFFIXES = (".md", ".txt")
+# BM25 参数
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# 中文没有空格分词：连续的汉字按相邻二字切分（单个汉字保留为一个词），英文与数字按词切分。
+# 不单独索引汉字，否则“者”“的”之类的常用字会让无关的块都得到分数
+_TERM_RE = re.compile(r"[a-z0-9]+(?:\.[0-9]+)?|[一-鿿]+")
+# 切块时优先在段落、句子处断开
+_SEPARATORS = ["\n#", "\n\n", "\n", "。", "；", "！", "？", "，", " ", ""]
+
+
+def analyze(text: str) -> List[str]:
+    """把文本切成检索词。"""
+    terms: List[str] = []
+    for run in _TERM_RE.findall(text.lower()):
+        if run.isascii() or len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+@dataclass
+class Hit:
+    """一条检索结果。"""
+
+    chunk_id: int
+    score: float
+    source: str
+    text: str
+    tokens: int
+
+
+# -------------------- 建索引 --------------------
+
+def iter_documents(root: str) -> Iterable[Tuple[str, str]]:
+    """按路径顺序遍历目录下的文档，返回 (相对路径, 文本)。"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.lower().endswith(DOCUMENT_SUFFIXES):
+                path = os.path.join(dirpath, name)
+                with open(path, encoding="utf-8") as f:
+                    yield os.path.relpath(path, root), f.read()
+
+
+def split_documents(
+    documents: Iterable[Tuple[str, str]],
+    chunk_size: int = RETRIEVAL_CHUNK_SIZE,
+    chunk_overlap: int = RETRIEVAL_CHUNK_OVERLAP,
+) -> List[Tuple[str, str]]:
+    """用 langchain-text-splitters 把文档切成 (来源, 文本) 块。"""
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        separators=_SEPARATORS,
+        keep_separator="end",
+    )
+    chunks = []
+    for source, text in documents:
+        for chunk in splitter.split_text(text):
+            chunk = chunk.strip()
+            if chunk:
+                chunks.append((source, chunk))
+    return chunks
+
+
+def build_index(chunks: List[Tuple[str, str]], index_dir: str, embeddings=None) -> None:
+    """为 (来源, 文本) 块建立 BM25 索引并写入 index_dir。
+
+    Args:
+        chunks: split_documents 的结果。
+        index_dir: 输出目录，已有的索引文件会被覆盖。
+        embeddings: 可选的 langchain ``Embeddings``；提供时额外保存块向量，
+            加载索引时传入同一个 embeddings 即改用向量检索。
+    """
+    postings: Dict[str, Dict[int, int]] = {}
+    lengths = np.zeros(len(chunks), dtype=np.float32)
+    for chunk_id, (_, text) in enumerate(chunks):
+        terms = analyze(text)
+        lengths[chunk_id] = len(terms)
+        for term in terms:
+            tf = postings.setdefault(term, {})
+            tf[chunk_id] = tf.get(chunk_id, 0) + 1
+
+    n_chunks = len(chunks)
+    avg_length = float(lengths.mean()) if n_chunks else 0.0
+    vocab: Dict[str, int] = {}
+    offsets = [0]
+    chunk_ids: List[np.ndarray] = []
+    weights: List[np.ndarray] = []
+    for term, tf_by_chunk in postings.items():
+        vocab[term] = len(vocab)
+        ids = np.fromiter(tf_by_chunk.keys(), dtype=np.int32, count=len(tf_by_chunk))
+        tf = np.fromiter(tf_by_chunk.values(), dtype=np.float32, count=len(tf_by_chunk))
+        df = len(ids)
+        idf = math.log(1.0 + (n_chunks - df + 0.5) / (df + 0.5))
+        norm = BM25_K1 * (1.0 - BM25_B + BM25_B * lengths[ids] / max(avg_length, 1e-9))
+        chunk_ids.append(ids)
+        weights.append((idf * tf * (BM25_K1 + 1.0) / (tf + norm)).astype(np.float32))
+        offsets.append(offsets[-1] + df)
+
+    os.makedirs(index_dir, exist_ok=True)
+    meta_path = os.path.join(index_dir, "meta.json")
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    np.save(os.path.join(index_dir, "postings_offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    np.save(
+        os.path.join(index_dir, "postings_chunks.npy"),
+        np.concatenate(chunk_ids) if chunk_ids else np.zeros(0, dtype=np.int32),
+    )
+    np.save(
+        os.path.join(index_dir, "postings_weights.npy"),
+        np.concatenate(weights) if weights else np.zeros(0, dtype=np.float32),
+    )
+    np.save(
+        os.path.join(index_dir, "chunk_tokens.npy"),
+        np.asarray([count_tokens(text) for _, text in chunks], dtype=np.int32),
+    )
+
+    encoded = [text.encode("utf-8") for _, text in chunks]
+    with open(os.path.join(index_dir, "text.bin"), "wb") as f:
+        for data in encoded:
+            f.write(data)
+    np.save(
+        os.path.join(index_dir, "text_offsets.npy"),
+        np.concatenate([[0], np.cumsum([len(d) for d in encoded], dtype=np.int64)]).astype(np.int64),
+    )
+
+    vectors_path = os.path.join(index_dir, "vectors.npy")
+    if embeddings is not None and chunks:
+        vectors = np.asarray(embeddings.embed_documents([text for _, text in chunks]), dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        np.save(vectors_path, vectors)
+    elif os.path.exists(vectors_path):
+        os.remove(vectors_path)
+
+    # meta.json 先删后写：加载时以它是否存在判断索引是否完整
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "version": INDEX_VERSION,
+            "k1": BM25_K1,
+            "b": BM25_B,
+            "n_chunks": n_chunks,
+            "sources": [source for source, _ in chunks],
+            "vocab": vocab,
+        }, f, ensure_ascii=False)
+
+
+# -------------------- 查询 --------------------
+
+class RetrievalIndex:
+    """只读索引。数组以 mmap 方式打开，多个 worker 进程共享操作系统的页缓存。"""
+
+    def __init__(self, index_dir: str, embeddings=None):
+        with open(os.path.join(index_dir, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != INDEX_VERSION:
+            raise ValueError(f"索引版本 {meta.get('version')} 与当前版本 {INDEX_VERSION} 不一致，请重新建索引")
+        self.index_dir = index_dir
+        self.n_chunks: int = meta["n_chunks"]
+        self._sources: List[str] = meta["sources"]
+        self._vocab: Dict[str, int] = meta["vocab"]
+
+        def _load(name: str) -> np.ndarray:
+            return np.load(os.path.join(index_dir, name), mmap_mode="r")
+
+        self._offsets = _load("postings_offsets.npy")
+        self._chunks = _load("postings_chunks.npy")
+        self._weights = _load("postings_weights.npy")
+        self._tokens = _load("chunk_tokens.npy")
+        self._text_offsets = _load("text_offsets.npy")
+        with open(os.path.join(index_dir, "text.bin"), "rb") as f:
+            # 空文件无法 mmap
+            self._text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self._text_offsets[-1] else b""
+
+        vectors_path = os.path.join(index_dir, "vectors.npy")
+        self._embeddings = embeddings
+        self._vectors = np.load(vectors_path, mmap_mode="r") if embeddings is not None and os.path.exists(vectors_path) else None
+
+    def __len__(self) -> int:
+        return self.n_chunks
+
+    def text(self, chunk_id: int) -> str:
+        start, end = self._text_offsets[chunk_id], self._text_offsets[chunk_id + 1]
+        return self._text[start:end].decode("utf-8")
+
+    def scores(self, query: str) -> np.ndarray:
+        """每个块对 query 的得分（BM25，或有向量时为余弦相似度）。"""
+        if self._vectors is not None:
+            q = np.asarray(self._embeddings.embed_query(query), dtype=np.float32)
+            return self._vectors @ (q / max(float(np.linalg.norm(q)), 1e-12))
+        scores = np.zeros(self.n_chunks, dtype=np.float32)
+        for term in set(analyze(query)):
+            term_id = self._vocab.get(term)
+            if term_id is None:
+                continue
+            start, end = self._offsets[term_id], self._offsets[term_id + 1]
+            # 同一个词的倒排表中块编号不重复，可以直接按下标累加
+            scores[self._chunks[start:end]] += self._weights[start:end]
+        return scores
+
+    def search(self, query: str, k: int = RETRIEVAL_TOP_K) -> List[Hit]:
+        """得分最高的 k 个块（得分为 0 的块不返回）。"""
+        if not self.n_chunks or k <= 0:
+            return []
+        scores = self.scores(query)
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(scores[candidates], -k)[-k:]]
+        # 得分相同时按块编号排序，保证结果稳定
+        order = sorted(candidates.tolist(), key=lambda i: (-float(scores[i]), i))
+        return [
+            Hit(
+                chunk_id=i,
+                score=float(scores[i]),
+                source=self._sources[i],
+                text=self.text(i),
+                tokens=int(self._tokens[i]),
+            )
+            for i in order
+        ]
+
+    def retrieve(self, query: str, k: int = RETRIEVAL_TOP_K, token_budget: int = RETRIEVAL_TOKEN_BUDGET) -> List[Hit]:
+        """top-k 中按得分依次放入、总 token 数不超过 token_budget 的片段；放不下的片段跳过。"""
+        selected: List[Hit] = []
+        used = 0
+        for hit in self.search(query, k):
+            if used + hit.tokens > token_budget:
+                continue
+            selected.append(hit)
+            used += hit.tokens
+        return selected
+
+
+def format_hits(hits: List[Hit]) -> str:
+    """把检索结果格式化为注入 prompt 的参考资料。"""
+    return "\n\n".join(f"[{i}] 来源：{hit.source}\n{hit.text}" for i, hit in enumerate(hits, 1))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="建立 / 查询本地指南检索索引")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="从文档目录建立索引")
+    build.add_argument("docs", help="文档目录（递归读取 .md / .txt）")
+    build.add_argument("--index", required=True, help="索引输出目录")
+    build.add_argument("--chunk-size", type=int, default=RETRIEVAL_CHUNK_SIZE, help="每块的最大字符数")
+    build.add_argument("--chunk-overlap", type=int, default=RETRIEVAL_CHUNK_OVERLAP, help="相邻块重叠的字符数")
+    query = sub.add_parser("query", help="查询索引并打印结果与耗时")
+    query.add_argument("text", help="查询文本")
+    query.add_argument("--index", required=True, help="索引目录")
+    query.add_argument("-k", type=int, default=RETRIEVAL_TOP_K, help="返回的片段数")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        started = time.perf_counter()
+        chunks = split_documents(iter_documents(args.docs), args.chunk_size, args.chunk_overlap)
+        build_index(chunks, args.index)
+        print(f"{len(chunks)} chunks indexed in {time.perf_counter() - started:.1f}s -> {args.index}")
+    else:
+        index = RetrievalIndex(args.index)
+        started = time.perf_counter()
+        hits = index.search(args.text, args.k)
+        elapsed = time.perf_counter() - started
+        for hit in hits:
+            print(f"{hit.score:7.3f}  {hit.source}  ({hit.tokens} tokens)\n{hit.text}\n")
+        print(f"{len(hits)} hits from {len(index)} chunks in {elapsed * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
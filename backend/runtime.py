@@ -0,0 +1,125 @@
+"""PBL2.backend.runtime
+后端的运行时：agents / graph / session 模块不在导入 server 时加载，而是在服务启动后的后台任务中导入
+（导入 langchain / langgraph / openai 需要数秒），随后调用 ``COMPONENTS.init()`` 构建模型客户端、网关、
+检查点存储与编译好的图（见 components.py），之后可选地预热：加载 tiktoken 词表与检索索引，并经网关向模型服务发起一次极小的调用，建立连接池。
+
+服务在加载期间已经可以响应 ``/healthz``（存活）；``/readyz`` 在加载与预热完成后才返回 200，
+自动扩容时新副本据此开始接收流量。未经过 lifespan 的调用方（如不进入上下文的 TestClient）
+在第一次需要运行时时按需加载。
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from typing import Dict, Optional
+
+
+def _process_started() -> float:
+    """进程的启动时刻（perf_counter 时间轴）；无法读取 /proc 时退化为本模块的导入时刻。"""
+    try:
+        with open("/proc/self/stat") as f:
+            # 进程名之后的第 20 个字段为启动时刻（开机以来的时钟节拍数）
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return time.perf_counter() - (uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return time.perf_counter()
+
+
+# 启动计时的起点：import_server 与 time_to_ready 都从进程启动算起
+BOOT_STARTED = _process_started()
+
+STATUS_COLD = "cold"
+STATUS_LOADING = "loading"
+STATUS_WARMING = "warming"
+STATUS_READY = "ready"
+STATUS_FAILED = "failed"
+
+
+class Runtime:
+    """运行时的加载状态与各阶段耗时（秒）。"""
+
+    def __init__(self):
+        self.status = STATUS_COLD
+        self.timings: Dict[str, float] = {}
+        self.error: Optional[str] = None
+        self.warmup_error: Optional[str] = None
+        # agents / graph / session 已导入、共享组件已构建，可以直接使用（预热可能仍在进行）
+        self.loaded = False
+        self._task: Optional[asyncio.Task] = None
+
+    def mark(self, name: str, started: float) -> None:
+        self.timings[name] = round(time.perf_counter() - started, 4)
+
+    @property
+    def is_ready(self) -> bool:
+        return self.status == STATUS_READY
+
+    def start(self, warmup: bool = False) -> asyncio.Task:
+        """开始加载（幂等）；返回加载任务。加载失败后再次调用会重试。"""
+        loop = asyncio.get_running_loop()
+        task = self._task
+        # 任务属于已关闭的事件循环（例如每个请求使用独立事件循环的测试客户端）时重新开始，加载本身是幂等的
+        if task is None or self.status == STATUS_FAILED or (task.get_loop() is not loop and not self.is_ready):
+            self.status = STATUS_LOADING
+            task = self._task = loop.create_task(self._start(warmup))
+        return task
+
+    async def ready(self) -> None:
+        """等待运行时就绪；尚未开始加载时立即开始（不预热）。加载失败时抛出异常。"""
+        if not self.is_ready:
+            await asyncio.shield(self.start())
+
+    async def _start(self, warmup: bool) -> None:
+        try:
+            await asyncio.to_thread(self._load)
+            if warmup:
+                self.status = STATUS_WARMING
+                await self._warm_up()
+            self.status = STATUS_READY
+            self.mark("time_to_ready", BOOT_STARTED)
+            print(f"Runtime ready in {self.timings['time_to_ready']:.2f}s: {self.timings}")
+        except Exception as e:
+            self.status = STATUS_FAILED
+            self.error = f"{type(e).__name__}: {e}"
+            print(f"Runtime failed to start: {self.error}")
+            raise
+
+    def _load(self) -> None:
+        """在工作线程中导入各模块并构建共享组件，事件循环在此期间继续响应健康检查。"""
+        from .components import COMPONENTS
+
+        started = time.perf_counter()
+        from . import agents, graph, session  # noqa: F401  只导入，不构建任何组件
+
+        self.mark("import_modules", started)
+        timings = COMPONENTS.init()
+        # 编译图单独计时，其余组件（网关、模型客户端、缓存与各存储）合计
+        self.timings["compile_graph"] = timings.pop("app")
+        self.timings["build_components"] = round(sum(timings.values()), 4)
+        self.loaded = True
+
+    async def _warm_up(self) -> None:
+        from .agents import warm_up
+
+        started = time.perf_counter()
+        try:
+            await warm_up()
+        except Exception as e:
+            # 预热失败（例如模型服务暂时不可达）不阻止就绪：第一次真实调用会再建立连接
+            self.warmup_error = f"{type(e).__name__}: {e}"
+            print(f"Warm-up failed: {self.warmup_error}")
+        self.mark("warmup", started)
+
+    def snapshot(self) -> Dict:
+        return {
+            "status": self.status,
+            "timings": dict(self.timings),
+            "error": self.error,
+            "warmup_error": self.warmup_error,
+        }
+
+
+RUNTIME = Runtime()
@@ -0,0 +1,164 @@
+"""PBL2.backend.scheduler
+本地发言调度器：在大多数轮次中无需调用主持人 LLM 即可决定下一位发言的学生。
+"""
+from __future__ import annotations
+
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from langchain_core.messages import AIMessage, BaseMessage
+
+# 学生代号，顺序即 round_robin 的轮转顺序
+SPEAKERS = ("analyst", "observer", "skeptic")
+
+# heuristic 策略使用的关键词：最后一条消息中出现得越多，对应学生越适合接话
+_KEYWORDS: Dict[str, Tuple[str, ...]] = {
+    # 系统化分析：机制、病因、诊断推理
+    "analyst": ("机制", "病理", "病因", "诊断", "鉴别", "分析", "推断", "因为", "导致"),
+    # 多线观察：检查、体征、数据
+    "observer": ("检查", "体征", "心电图", "化验", "指标", "症状", "观察", "数据", "结果", "生命体征"),
+    # 质疑者：疑问、反驳、证据
+    "skeptic": ("？", "?", "是否", "质疑", "但是", "然而", "不一定", "证据", "排除", "确定"),
+}
+
+
+def speaker_of(message: BaseMessage) -> Optional[str]:
+    """返回消息对应的学生代号；非学生消息返回 None。"""
+    if not isinstance(message, AIMessage):
+        return None
+    name = message.name or ""
+    if name.startswith("student_"):
+        speaker = name[len("student_"):]
+        if speaker in SPEAKERS:
+            return speaker
+    return None
+
+
+class TurnScheduler:
+    """可插拔的发言调度器。
+
+    ``decide`` 返回下一位学生代号（``analyst``/``observer``/``skeptic``）；
+    返回 None 表示本地策略没有把握，需要回退到主持人 LLM。
+    调度器本身不保存会话状态，所有判断都来自消息历史，因此可在多个会话间共享。
+    """
+
+    POLICIES = ("llm", "round_robin", "least_recent", "heuristic")
+
+    def __init__(self, policy: str = "heuristic", min_confidence: float = 0.3, llm_every: int = 4):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown scheduler policy: {policy}")
+        self.policy = policy
+        self.min_confidence = min_confidence
+        self.llm_every = llm_every
+        self._stats: Counter = Counter()
+
+    # ---------- 对外接口 ----------
+
+    def decide(self, messages: List[BaseMessage]) -> Optional[str]:
+        """根据消息历史做出本地调度决策，并记录走了哪条路径。"""
+        if self.policy == "llm":
+            self._stats["llm_policy"] += 1
+            return None
+
+        streak = self._student_streak(messages)
+        # 阶段边界：最后一条不是学生发言（病例引入、老师插话、主持人回复等），交给 LLM
+        if streak == 0:
+            self._stats["llm_boundary"] += 1
+            return None
+        # 连续本地调度若干轮后询问一次 LLM，让它有机会结束讨论
+        if self.llm_every and streak % self.llm_every == 0:
+            self._stats["llm_periodic"] += 1
+            return None
+
+        if self.policy == "round_robin":
+            choice = self._round_robin(messages)
+        elif self.policy == "least_recent":
+            choice = self._least_recent(messages)
+        else:
+            choice = self._heuristic(messages)
+
+        if choice is None:
+            self._stats["llm_low_confidence"] += 1
+        else:
+            self._stats["local"] += 1
+        return choice
+
+    def stats(self) -> Dict[str, int]:
+        """返回各路径被采用的次数及本地决策比例。"""
+        stats = dict(self._stats)
+        total = sum(stats.values())
+        stats["total"] = total
+        stats["local_ratio"] = round(stats.get("local", 0) / total, 4) if total else 0.0
+        return stats
+
+    def rank(self, messages: List[BaseMessage]) -> List[str]:
+        """按“可能接话”的程度对学生排序（关键词得分优先，其次是最久未发言）。
+
+        不记录统计，供投机生成挑选候选人使用。
+        """
+        last_msg = messages[-1] if messages else None
+        text = ""
+        if last_msg is not None:
+            text = last_msg.content if isinstance(last_msg.content, str) else str(last_msg.content)
+        last = speaker_of(last_msg) if last_msg is not None else None
+
+        last_spoken = {speaker: -1 for speaker in SPEAKERS}
+        for idx, msg in enumerate(messages):
+            speaker = speaker_of(msg)
+            if speaker is not None:
+                last_spoken[speaker] = idx
+
+        def _key(speaker: str):
+            score = sum(text.count(word) for word in _KEYWORDS[speaker])
+            return (speaker != last, score, -last_spoken[speaker])
+
+        return sorted(SPEAKERS, key=_key, reverse=True)
+
+    # ---------- 策略实现 ----------
+
+    @staticmethod
+    def _student_streak(messages: List[BaseMessage]) -> int:
+        """末尾连续学生发言的条数。"""
+        streak = 0
+        for msg in reversed(messages):
+            if speaker_of(msg) is None:
+                break
+            streak += 1
+        return streak
+
+    @staticmethod
+    def _round_robin(messages: List[BaseMessage]) -> str:
+        last = speaker_of(messages[-1])
+        return SPEAKERS[(SPEAKERS.index(last) + 1) % len(SPEAKERS)]
+
+    @staticmethod
+    def _least_recent(messages: List[BaseMessage]) -> str:
+        last_spoken = {speaker: -1 for speaker in SPEAKERS}
+        for idx, msg in enumerate(messages):
+            speaker = speaker_of(msg)
+            if speaker is not None:
+                last_spoken[speaker] = idx
+        # 从未发言的优先；并列时按 SPEAKERS 顺序
+        return min(SPEAKERS, key=lambda s: last_spoken[s])
+
+    def _heuristic(self, messages: List[BaseMessage]) -> Optional[str]:
+        last_msg = messages[-1]
+        text = last_msg.content if isinstance(last_msg.content, str) else str(last_msg.content)
+        last = speaker_of(last_msg)
+
+        scores = {
+            speaker: sum(text.count(word) for word in words)
+            for speaker, words in _KEYWORDS.items()
+        }
+        # 避免同一名学生连续发言
+        if last is not None:
+            scores[last] = 0
+
+        ranked = sorted(SPEAKERS, key=lambda s: scores[s], reverse=True)
+        total = sum(scores.values())
+        if total == 0:
+            return None
+        confidence = (scores[ranked[0]] - scores[ranked[1]]) / total
+        if confidence < self.min_confidence:
+            return None
+        return ranked[0]
@@ -1,19 +1,26 @@
 """PBL.backend.server
 使用 FastAPI 和 WebSocket 提供后端服务。
+
+导入本模块只加载 FastAPI 与轻量的本地模块；会话管理（依赖 langchain / langgraph）由 runtime.RUNTIME
+在服务启动后加载，并由它构建 components.COMPONENTS 中的模型客户端与图，各接口在使用前等待其就绪。
 """
 import asyncio
 import uvicorn
 import json
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel
-from typing import List, Dict
-
-from langchain_core.messages import HumanMessage
+from typing import List, Dict, Optional
 
-from .graph import app, GraphState
-# 从 agents 模块导入 student_personas 字典
-from .agents import student_personas
+from .config import CHECKPOINT_COMPACT_INTERVAL, RUNTIME_WARMUP
+from .broadcast import CONTROL_ACTIONS, Subscriber, connection_role
+from .components import COMPONENTS
+from .runtime import BOOT_STARTED, RUNTIME
+from .store import GLOBAL_SCOPE
+from . import metrics
+from .metrics import WS_SUBSCRIBERS
 
 # --- Pydantic 模型定义 ---
 class Persona(BaseModel):
@@ -28,8 +35,69 @@ class UpdatePersonasRequest(BaseModel):
     student_observer: Persona
     student_skeptic: Persona
 
+async def _run_runtime():
+    """加载运行时（可选预热），随后运行检查点的后台压缩任务。"""
+    try:
+        await RUNTIME.start(RUNTIME_WARMUP)
+    except Exception:
+        return  # 错误已记录在 RUNTIME 中，由 /readyz 报告；之后的请求会重试加载
+    from .checkpoint import SQLiteCheckpointSaver
+
+    if isinstance(COMPONENTS.checkpointer, SQLiteCheckpointSaver):
+        await COMPONENTS.checkpointer.compaction_loop(CHECKPOINT_COMPACT_INTERVAL)
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    """服务生命周期：在后台加载运行时，加载期间已可响应 /healthz；关闭时取消任务、结束会话并释放 LLM 连接池。"""
+    background = [asyncio.create_task(_run_runtime())]
+    yield
+    for task in background:
+        task.cancel()
+    if RUNTIME.loaded:
+        from .session import close_all_sessions
+
+        await close_all_sessions()
+        await COMPONENTS.aclose()
+
+
+# --- 导出时才求值的仪表（运行时加载前不导出） ---
+def _gateway_gauge(attr: str):
+    def _value():
+        if not RUNTIME.loaded:
+            return None
+        return getattr(COMPONENTS.gateway, attr)
+
+    return _value
+
+
+def _checkpoint_bytes():
+    if not RUNTIME.loaded:
+        return None
+    from .checkpoint import SQLiteCheckpointSaver
+
+    checkpointer = COMPONENTS.checkpointer
+    return checkpointer.size_bytes() if isinstance(checkpointer, SQLiteCheckpointSaver) else None
+
+
+def _cache_hit_ratio():
+    if not RUNTIME.loaded:
+        return None
+    return COMPONENTS.response_cache.snapshot()["hit_ratio"]
+
+
+metrics.REGISTRY.gauge("pbl_llm_in_flight", "LLM calls currently in flight.", callback=_gateway_gauge("in_flight"))
+metrics.REGISTRY.gauge("pbl_llm_queued", "LLM calls waiting for a gateway slot.", callback=_gateway_gauge("queued"))
+metrics.REGISTRY.gauge("pbl_checkpoint_store_bytes", "Size of the checkpoint store on disk.", callback=_checkpoint_bytes)
+metrics.REGISTRY.gauge("pbl_llm_cache_hit_ratio", "Response cache hit ratio.", callback=_cache_hit_ratio)
+metrics.REGISTRY.gauge(
+    "pbl_runtime_ready", "Whether the runtime is loaded (and warmed up) and serving.",
+    callback=lambda: 1 if RUNTIME.is_ready else 0,
+)
+
+
 # 创建 FastAPI 应用实例
-app_fastapi = FastAPI()
+app_fastapi = FastAPI(lifespan=lifespan)
 
 # --- CORS 中间件配置 ---
 # 允许所有来源，这在开发中很方便。
@@ -45,91 +113,146 @@ app_fastapi.add_middleware(
 
 @app_fastapi.get("/")
 def read_root():
-    return {"message": "PBL Backend is running."}
+    return {"message": "PBL Backend is running.", "status": RUNTIME.status}
+
+@app_fastapi.get("/healthz")
+def liveness():
+    """存活检查：进程能响应请求即返回 200，不等待运行时加载。"""
+    return {"status": "ok"}
+
+@app_fastapi.get("/readyz")
+def readiness():
+    """就绪检查：运行时加载（及预热）完成后返回 200，否则返回 503；同时给出各启动阶段的耗时。"""
+    return JSONResponse(RUNTIME.snapshot(), status_code=200 if RUNTIME.is_ready else 503)
+
+@app_fastapi.get("/scheduler/stats")
+async def scheduler_stats():
+    """返回发言调度器各路径（本地 / LLM）的采用次数及投机生成的命中情况。"""
+    await RUNTIME.ready()
+    from .agents import SPECULATOR, TURN_SCHEDULER
+
+    stats = TURN_SCHEDULER.stats()
+    stats["speculative"] = dict(SPECULATOR.stats)
+    return stats
+
+@app_fastapi.get("/llm/stats")
+async def llm_stats():
+    """返回 LLM 网关的在途 / 排队数量、重试、背压统计及响应缓存命中率。"""
+    await RUNTIME.ready()
+    stats = COMPONENTS.gateway.snapshot()
+    stats["cache"] = COMPONENTS.response_cache.snapshot()
+    return stats
+
+@app_fastapi.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    """以 Prometheus 文本格式导出节点 / LLM 耗时、token 用量与各项仪表。"""
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app_fastapi.get("/metrics/trace/{session_id}")
+def session_trace(session_id: str):
+    """导出某个会话最近的节点与 LLM 调用轨迹（需开启 PBL_TRACE=1）。"""
+    if metrics.TRACES is None:
+        raise HTTPException(status_code=404, detail="Tracing is disabled; set PBL_TRACE=1.")
+    return {"session_id": session_id, "spans": metrics.TRACES.dump(session_id)}
 
 @app_fastapi.post("/update_personas")
-async def update_personas(request: UpdatePersonasRequest):
-    """接收前端发送的 persona 配置并更新。"""
+async def update_personas(request: UpdatePersonasRequest, session_id: Optional[str] = None):
+    """接收前端发送的 persona 配置并写入共享存储（所有 worker 可见）。
+
+    带查询参数 ``session_id`` 时只修改该会话的 persona；否则修改全局 persona，
+    只影响之后开始的会话，进行中的会话保留各自的快照。
+    """
+    await RUNTIME.ready()
+    from .agents import student_personas
+
     new_personas = request.dict()
+    valid = {}
     for agent_id, persona_data in new_personas.items():
         if agent_id in student_personas:
-            student_personas[agent_id] = persona_data
-            print(f"Updated persona for {agent_id}: {persona_data}")
+            valid[agent_id] = persona_data
+            print(f"Updated persona for {agent_id} ({session_id or 'global'}): {persona_data}")
         else:
             print(f"Warning: Agent ID '{agent_id}' not found.")
-    return {"status": "success", "message": "Personas updated successfully."}
+    versions = await asyncio.to_thread(COMPONENTS.store.save_personas, valid, session_id or GLOBAL_SCOPE)
+    return {"status": "success", "message": "Personas updated successfully.", "versions": versions}
+
+@app_fastapi.get("/personas")
+async def current_personas(session_id: Optional[str] = None):
+    """返回全局或某个会话当前生效的 persona 及其版本号。"""
+    await RUNTIME.ready()
+    from .agents import get_personas
+
+    personas = await asyncio.to_thread(get_personas, session_id)
+    return {agent_id: {"version": v, **p} for agent_id, (v, p) in personas.items()}
 
 
 @app_fastapi.websocket("/ws/pbl/{session_id}")
 async def websocket_endpoint(websocket: WebSocket, session_id: str):
-    """处理 PBL 讨论的 WebSocket 连接。"""
+    """处理 PBL 讨论的 WebSocket 连接。
+
+    会话独立于连接存在：断线后生成继续，客户端带上查询参数 ``last_seq``（已收到的最大序号）
+    重连即可补齐缺失的帧，无需重新开始讨论。同一会话可以有任意多个连接，它们共享同一份生成输出；
+    只有带老师口令（查询参数 ``token``）的连接可以开始讨论或插话，其余连接只读。
+    """
     await websocket.accept()
-    print(f"WebSocket connection established for session: {session_id}")
+    try:
+        await RUNTIME.ready()
+    except Exception as e:
+        await websocket.close(code=1011, reason=f"Backend failed to start: {e}")
+        return
+    from .session import get_session
 
-    # 为每个会话配置一个唯一的 thread_id
-    config = {"configurable": {"thread_id": session_id}}
+    subscriber = Subscriber(connection_role(websocket.query_params.get("token")))
+    print(f"WebSocket connection established for session: {session_id} ({subscriber.role})")
+    WS_SUBSCRIBERS.inc(subscriber.role)
 
+    # 生成在独立任务中进行，接收循环始终可以读取老师的插话；
+    # 出站帧先进入该连接的有界队列，由单独的任务按顺序写出
+    async def _writer():
+        try:
+            while True:
+                frame = await subscriber.get()
+                await websocket.send_json(frame)
+                if frame.get("type") == "reconnect":
+                    # 会话的持有者已失效（1012），或本连接跟不上输出（1013）：让客户端重连补齐
+                    await websocket.close(code=1013 if subscriber.overflowed else 1012)
+                    return
+        except Exception:
+            pass  # 连接已断开，由接收循环负责清理
+
+    writer = asyncio.create_task(_writer())
+    session = None
     try:
+        subscriber.deliver({"type": "connected", "role": subscriber.role})
+        # 取得会话或订阅时可能因共享存储 / 租约出错，同样由下面的 finally 清理
+        session = await get_session(session_id)
+        last_seq = websocket.query_params.get("last_seq")
+        await session.attach(subscriber.deliver, int(last_seq) if last_seq is not None and last_seq.isdigit() else None)
+
         # 循环等待前端消息
         while True:
             data = await websocket.receive_text()
             message = json.loads(data)
-            action = message.get("action")
-
-            if action == "start_discussion":
-                # --- 开始新的讨论 ---
-                print(f"[{session_id}] Starting new discussion.")
-                initial_case = message.get("initial_case", "")
-                initial_message = HumanMessage(content=initial_case, name="case_introduction")
-                initial_state: GraphState = {
-                    "messages": [initial_message],
-                    "discussion_stage": "初步诊断与鉴别诊断",
-                    "summary": "",
-                    "next_speaker": "router",
-                    "is_teacher_interrupted": False,
-                }
-                # 流式运行图，并将结果发送到前端
-                async for event in app.astream(initial_state, config=config):
-                    for node_name, output in event.items():
-                        if "messages" in output and output['messages']:
-                            for msg in output['messages']:
-                                if hasattr(msg, 'content'):
-                                    await websocket.send_json({
-                                        "node": node_name,
-                                        "content": msg.content
-                                    })
-
-            elif action == "teacher_intervention":
-                # --- 处理老师干预 ---
-                teacher_message_content = message.get("content", "")
-                print(f"[{session_id}] Teacher intervention: {teacher_message_content}")
-                teacher_message = HumanMessage(content=teacher_message_content, role="teacher")
-                
-                # 更新状态，插入老师消息并设置中断标志
-                await app.update_state(
-                    config,
-                    {
-                        "messages": [teacher_message],
-                        "is_teacher_interrupted": True,
-                    },
-                )
-                # 老师发言后，图会自动从下一个节点（router -> teacher_handler）继续
-                # 我们需要继续流式传输后续的响应
-                async for event in app.astream(None, config=config):
-                    for node_name, output in event.items():
-                        if "messages" in output and output['messages']:
-                            for msg in output['messages']:
-                                if hasattr(msg, 'content'):
-                                    await websocket.send_json({
-                                        "node": node_name,
-                                        "content": msg.content
-                                    })
+            if message.get("action") in CONTROL_ACTIONS and not subscriber.can_control:
+                subscriber.deliver({"type": "error", "message": "Only the teacher can control the discussion."})
+                continue
+            # start_discussion / teacher_intervention：本地会话直接执行，其他 worker 持有的会话经控制通道转发
+            await session.handle(message)
 
     except WebSocketDisconnect:
         print(f"WebSocket connection closed for session: {session_id}")
     except Exception as e:
         print(f"An error occurred in session {session_id}: {e}")
         await websocket.close(code=1011, reason=str(e))
+    finally:
+        if session is not None:
+            session.detach(subscriber.deliver)
+        writer.cancel()
+        WS_SUBSCRIBERS.dec(subscriber.role)
+
+
+# 导入本模块的耗时（从进程启动算起），与 time_to_ready 一起由 /readyz 报告
+RUNTIME.mark("import_server", BOOT_STARTED)
 
 
 # 运行服务器的入口
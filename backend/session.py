@@ -0,0 +1,538 @@
+"""PBL2.backend.session
+单个讨论会话的运行时：图的生成在独立任务中进行，接收端可以随时抢占。
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import socket
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union
+
+from langchain_core.messages import AIMessageChunk, BaseMessage, HumanMessage
+
+from .config import (
+    STREAM_TOKENS,
+    STREAMING_NODES,
+    SESSION_EVENT_LOG_SIZE,
+    SESSION_DETACHED_TTL,
+    SESSION_LEASE_TTL,
+    SESSION_POLL_INTERVAL,
+    SESSION_BUDGET_CEILING,
+)
+from .budget import budget_report, recursion_limit, resolve_budget
+from .context import CASE_MESSAGE_NAME
+from .event_log import EventLog
+from . import agents
+from .components import COMPONENTS
+from .metrics import ACTIVE_SESSIONS
+
+# 向客户端发送一帧 JSON 的回调
+SendFn = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+async def stream_graph(send: SendFn, graph_input, config: Dict, stream_tokens: bool) -> None:
+    """运行图并把输出推送给客户端。
+
+    stream_tokens 为 True 时，模型每产生一段 token 就推送一个 ``delta`` 帧，
+    节点结束后再推送一个包含完整内容的 ``message_complete`` 帧；
+    为 False 时只推送 ``message_complete`` 帧。
+    若运行被取消，已推送过 delta 但尚未完成的消息会收到 ``message_cancelled`` 帧。
+    每当预算用量（发言轮数、token 数）变化时推送一个 ``budget`` 帧。
+    """
+    stream_mode = ["messages", "updates", "values"] if stream_tokens else ["updates", "values"]
+    # message_id -> (node, 已推送的文本)，用于给没有返回消息的节点（如 summarizer）补发完成帧
+    pending: Dict[str, tuple] = {}
+    last_report = None
+
+    try:
+        async for mode, event in COMPONENTS.app.astream(graph_input, config=config, stream_mode=stream_mode):
+            if mode == "values":
+                report = budget_report(event)
+                key = (report["turns"], report["tokens"], report["exhausted"])
+                if event.get("budget") and key != last_report:
+                    last_report = key
+                    await send({"type": "budget", **report})
+                continue
+            if mode == "messages":
+                chunk, metadata = event
+                node_name = metadata.get("langgraph_node")
+                if node_name not in STREAMING_NODES or not isinstance(chunk, AIMessageChunk):
+                    continue
+                if not chunk.content:
+                    continue
+                _, text = pending.get(chunk.id, (node_name, ""))
+                pending[chunk.id] = (node_name, text + chunk.content)
+                await send({
+                    "type": "delta",
+                    "node": node_name,
+                    "message_id": chunk.id,
+                    "delta": chunk.content,
+                })
+                continue
+
+            for node_name, output in event.items():
+                if not output:
+                    continue
+                for msg in output.get("messages") or []:
+                    if hasattr(msg, 'content'):
+                        pending.pop(msg.id, None)
+                        await send({
+                            "type": "message_complete",
+                            "node": node_name,
+                            "message_id": msg.id,
+                            "content": msg.content,
+                        })
+                for message_id, (pending_node, text) in list(pending.items()):
+                    if pending_node == node_name:
+                        del pending[message_id]
+                        await send({
+                            "type": "message_complete",
+                            "node": node_name,
+                            "message_id": message_id,
+                            "content": text,
+                        })
+    except asyncio.CancelledError:
+        try:
+            for message_id, (node_name, _) in pending.items():
+                await send({"type": "message_cancelled", "node": node_name, "message_id": message_id})
+        except Exception:
+            pass  # 连接可能已经断开
+        raise
+
+
+# 客户端连接注册的投递回调：同步地把一帧放入该连接的发送队列
+DeliverFn = Callable[[Dict[str, Any]], None]
+
+
+def _display_node(message: BaseMessage) -> str:
+    """快照中消息对应的前端角色：学生节点名 / teacher；主持人的回复没有 name。"""
+    if message.name:
+        return message.name
+    return "teacher_handler" if message.type == "ai" else message.type
+
+
+async def _snapshot_frame(config: Dict, seq: int) -> Dict[str, Any]:
+    """由检查点构建当前讨论内容的 ``snapshot`` 帧，用于无法补发时的重新同步。"""
+    values = (await COMPONENTS.app.aget_state(config)).values
+    messages = [
+        {"message_id": m.id, "node": _display_node(m), "content": m.content}
+        for m in values.get("messages", [])
+        if m.name != "case_introduction"
+    ]
+    return {
+        "type": "snapshot",
+        "seq": seq,
+        "summary": values.get("summary", ""),
+        "messages": messages,
+        "budget": budget_report(values) if values.get("budget") else None,
+    }
+
+
+def initial_state(initial_case: str, budget: Optional[Dict[str, Any]] = None) -> Dict:
+    """start_discussion 的初始图状态；budget 为客户端对默认预算的覆盖（见 budget.resolve_budget）。"""
+    return {
+        "messages": [HumanMessage(content=initial_case, name=CASE_MESSAGE_NAME)],
+        "discussion_stage": "初步诊断与鉴别诊断",
+        "summary": "",
+        "summary_watermark": "",
+        "next_speaker": "router",
+        "round_speakers": [],
+        "is_teacher_interrupted": False,
+        "budget": resolve_budget(budget),
+        "usage": {"turns": 0, "tokens": 0},
+        "started_at": time.time(),
+        "budget_exhausted": "",
+    }
+
+
+class SessionHub:
+    """会话在本 worker 上的广播中心：一个事件日志加任意数量的订阅连接。
+
+    每个 WebSocket 连接以一个投递回调订阅；所有连接共享同一份生成输出，
+    观看者再多也不会重复调用 LLM。
+    """
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        # 预算由路由器执行；recursion_limit 只是防止图无限循环的兜底，按预算上限取值
+        self.config = {
+            "configurable": {"thread_id": session_id},
+            "recursion_limit": recursion_limit(SESSION_BUDGET_CEILING),
+        }
+        self.store = COMPONENTS.store
+        self.log = EventLog(SESSION_EVENT_LOG_SIZE)
+        self._subscribers: List[DeliverFn] = []
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    async def attach(self, deliver: DeliverFn, last_seq: Optional[int] = None) -> None:
+        """注册一个客户端连接。
+
+        last_seq 为 None 时只接收之后的实时帧；否则先补发序号大于 last_seq 的帧，
+        本地日志不够时再从共享存储补齐。仍有缺口时，先发送一个由检查点构建的 ``snapshot`` 帧，
+        再补发日志中保留的帧。
+        """
+        stored = None
+        snapshot = None
+        if last_seq is not None and self.log.since(last_seq) is None:
+            if self.store.shared:
+                stored = await asyncio.to_thread(self.store.events_since, self.session_id, last_seq)
+            if stored is None:
+                snapshot = await _snapshot_frame(self.config, self.log.evicted_upto)
+        # 以下不再 await：补发的帧与随后的实时帧之间不会交错或遗漏
+        if snapshot is not None:
+            deliver(snapshot)
+            # 日志中保留的帧与快照可能重叠，客户端按 message_id 覆盖即可
+            backlog = self.log.retained()
+        elif stored is not None:
+            # 存储中的帧（本进程接管之前的部分）+ 本地日志中更新的帧
+            newest = stored[-1]["seq"] if stored else last_seq
+            backlog = stored + [f for f in self.log.retained() if f["seq"] > newest]
+        elif last_seq is not None:
+            backlog = self.log.since(last_seq) or []
+        else:
+            backlog = []
+        for frame in backlog:
+            deliver(frame)
+        self._subscribers.append(deliver)
+
+    def detach(self, deliver: DeliverFn) -> None:
+        if deliver in self._subscribers:
+            self._subscribers.remove(deliver)
+        if not self._subscribers:
+            self._on_idle()
+
+    def _on_idle(self) -> None:
+        """最后一个连接断开时调用。"""
+
+    def _broadcast(self, frame: Dict[str, Any]) -> None:
+        for deliver in list(self._subscribers):
+            deliver(frame)
+
+
+class DiscussionSession(SessionHub):
+    """一个会话的生成端，生命周期独立于 WebSocket 连接。
+
+    接收循环（WebSocket 的 ``receive_text``）与生成任务相互独立：
+    老师插话时会取消正在进行的 LLM 调用，插入老师消息后直接路由到 teacher_handler。
+    所有出站帧都带有序号并写入事件日志；连接断开后生成继续进行，
+    客户端带着 ``last_seq`` 重连即可补齐缺失的帧，无需重新生成。
+
+    只有持有会话租约的 worker 会创建该对象。共享存储（store.shared）下，
+    出站帧会批量写入存储供其他 worker 读取，其他 worker 转发来的命令从控制通道读取。
+    """
+
+    def __init__(self, session_id: str):
+        super().__init__(session_id)
+        self.stream_tokens = STREAM_TOKENS
+        self._generation: Optional[asyncio.Task] = None
+        self._expiry: Optional[asyncio.Task] = None
+        self._background: List[asyncio.Task] = []
+        # 尚未写入共享存储的帧
+        self._unflushed: List[Dict[str, Any]] = []
+        # 串行化 start / intervene，避免两次抢占交错
+        self._control_lock = asyncio.Lock()
+        # LLM 请求排队过长时，网关会通过该回调向客户端推送 backpressure 帧（不写入日志）
+        COMPONENTS.gateway.add_listener(session_id, self._publish_transient)
+        ACTIVE_SESSIONS.inc()
+        self._closed = False
+
+    @property
+    def is_generating(self) -> bool:
+        return self._generation is not None and not self._generation.done()
+
+    async def open(self) -> None:
+        """接管会话：从共享存储接续序号；若图在上一个持有者退出时尚未结束，则继续运行。"""
+        last_seq = await asyncio.to_thread(self.store.last_seq, self.session_id)
+        self.log.last_seq = self.log.evicted_upto = last_seq
+        self._background.append(asyncio.create_task(self._keep_lease()))
+        if self.store.shared:
+            self._background.append(asyncio.create_task(self._flush_loop()))
+            self._background.append(asyncio.create_task(self._control_loop()))
+        snapshot = await COMPONENTS.app.aget_state(self.config)
+        if snapshot.values and snapshot.next:
+            print(f"Session {self.session_id}: resuming unfinished discussion.")
+            self._launch(None)
+
+    # ---------- 连接 ----------
+
+    async def attach(self, deliver: DeliverFn, last_seq: Optional[int] = None) -> None:
+        if self._expiry is not None:
+            self._expiry.cancel()
+            self._expiry = None
+        await super().attach(deliver, last_seq)
+
+    def _on_idle(self) -> None:
+        """没有任何连接时，会话在 SESSION_DETACHED_TTL 秒后关闭。"""
+        if not self._closed and self._expiry is None:
+            self._expiry = asyncio.create_task(self._expire())
+
+    # ---------- 控制 ----------
+
+    async def handle(self, message: Dict[str, Any]) -> None:
+        """执行客户端发来的命令（本地连接直接调用，其他 worker 的命令经控制通道到达）。"""
+        action = message.get("action")
+        if action == "start_discussion":
+            print(f"[{self.session_id}] Starting new discussion.")
+            await self.start(
+                initial_state(message.get("initial_case", ""), message.get("budget")),
+                stream_tokens=bool(message.get("stream", STREAM_TOKENS)),
+            )
+        elif action == "teacher_intervention":
+            content = message.get("content", "")
+            print(f"[{self.session_id}] Teacher intervention: {content}")
+            await self.intervene(content)
+
+    async def start(self, initial_state: Dict, stream_tokens: bool = STREAM_TOKENS) -> None:
+        """从 initial_state 开始一轮新的讨论（丢弃该会话之前的检查点与事件日志）。"""
+        async with self._control_lock:
+            await self._cancel_generation()
+            self.stream_tokens = stream_tokens
+            agents.SUMMARIZER.cancel(self.session_id)
+            await COMPONENTS.checkpointer.adelete_thread(self.session_id)
+            self.log.reset()
+            if self.store.shared:
+                self._unflushed.clear()
+                await asyncio.to_thread(self.store.reset_events, self.session_id, self.log.last_seq)
+            await self._emit({"type": "discussion_started"})
+            self._launch(initial_state)
+
+    async def intervene(self, content: str) -> None:
+        """老师插话：抢占当前生成，插入老师消息并推送给所有连接，然后让图从 teacher_handler 继续。"""
+        async with self._control_lock:
+            await self._cancel_generation()
+            snapshot = await COMPONENTS.app.aget_state(self.config)
+            if not snapshot.values:
+                await self._emit({"type": "error", "message": "Discussion has not started."})
+                return
+            teacher_message = HumanMessage(content=content, name="teacher", role="teacher", id=str(uuid.uuid4()))
+            # 以 router 的身份写入，条件边会直接把图路由到 teacher_handler
+            await COMPONENTS.app.aupdate_state(
+                self.config,
+                {
+                    "messages": [teacher_message],
+                    "is_teacher_interrupted": True,
+                    "next_speaker": "teacher_handler",
+                },
+                as_node="router",
+            )
+            # 老师的消息与其他消息一样经事件日志推送，观看者、重连的客户端与快照看到的内容一致
+            await self._emit({
+                "type": "message_complete",
+                "node": "teacher",
+                "message_id": teacher_message.id,
+                "content": content,
+            })
+            self._launch(None)
+
+    async def close(self) -> None:
+        """停止生成、写出剩余的帧并释放租约。"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._expiry is not None and self._expiry is not asyncio.current_task():
+            self._expiry.cancel()
+        self._expiry = None
+        await self._cancel_generation()
+        for task in self._background:
+            task.cancel()
+        agents.SUMMARIZER.cancel(self.session_id)
+        COMPONENTS.gateway.remove_listener(self.session_id)
+        ACTIVE_SESSIONS.dec()
+        if _SESSIONS.get(self.session_id) is self:
+            del _SESSIONS[self.session_id]
+        await self._flush()
+        await asyncio.to_thread(self.store.release_lease, self.session_id, WORKER_ID)
+        await asyncio.to_thread(self.store.drop_session, self.session_id)
+
+    # ---------- 内部 ----------
+
+    async def _emit(self, frame: Dict[str, Any]) -> None:
+        """为帧分配序号、写入日志并投递给所有连接。"""
+        frame = self.log.append(frame)
+        if self.store.shared:
+            self._unflushed.append(frame)
+        self._broadcast(frame)
+
+    async def _publish_transient(self, frame: Dict[str, Any]) -> None:
+        """投递不需要补发的瞬时帧（如 backpressure）。"""
+        self._broadcast(frame)
+
+    async def _flush(self) -> None:
+        frames, self._unflushed = self._unflushed, []
+        if frames:
+            await asyncio.to_thread(self.store.append_events, self.session_id, frames)
+
+    async def _flush_loop(self) -> None:
+        """按轮询间隔批量写出帧：每批一个事务，而不是每个 token 一次写入。"""
+        while True:
+            await asyncio.sleep(SESSION_POLL_INTERVAL)
+            try:
+                await self._flush()
+            except Exception as e:
+                print(f"Failed to persist events for session {self.session_id}: {e}")
+
+    async def _control_loop(self) -> None:
+        """执行其他 worker 写入控制通道的命令。"""
+        while True:
+            await asyncio.sleep(SESSION_POLL_INTERVAL)
+            try:
+                commands = await asyncio.to_thread(self.store.pop_controls, self.session_id)
+                for command in commands:
+                    await self.handle(command)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Failed to handle a remote command for session {self.session_id}: {e}")
+
+    async def _keep_lease(self) -> None:
+        while True:
+            await asyncio.sleep(SESSION_LEASE_TTL / 3)
+            renewed = await asyncio.to_thread(
+                self.store.acquire_lease, self.session_id, WORKER_ID, SESSION_LEASE_TTL
+            )
+            if not renewed:
+                print(f"Lost the lease on session {self.session_id}; stopping here.")
+                asyncio.create_task(self.close())
+                return
+
+    async def _expire(self) -> None:
+        await asyncio.sleep(SESSION_DETACHED_TTL)
+        if not self._subscribers:
+            print(f"Session {self.session_id} expired after {SESSION_DETACHED_TTL}s without a connection.")
+            await self.close()
+
+    def _launch(self, graph_input) -> None:
+        self._generation = asyncio.create_task(self._run(graph_input))
+
+    async def _run(self, graph_input) -> None:
+        try:
+            await stream_graph(self._emit, graph_input, self.config, self.stream_tokens)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"An error occurred in session {self.session_id}: {e}")
+            await self._emit({"type": "error", "message": str(e)})
+
+    async def _cancel_generation(self) -> None:
+        task, self._generation = self._generation, None
+        agents.SPECULATOR.cancel(self.session_id)
+        if task is None or task.done():
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+class RemoteSession(SessionHub):
+    """由其他 worker 持有的会话在本 worker 上的代理。
+
+    本 worker 上该会话的所有连接共用一个轮询任务：从共享存储的事件流读取新帧，
+    写入本地镜像日志并广播；命令写入控制通道。持有者的租约过期时（例如进程退出），
+    向所有连接发送 ``reconnect`` 帧，客户端重连后由某个 worker 接管会话。
+    """
+
+    def __init__(self, session_id: str):
+        super().__init__(session_id)
+        self._tail_task: Optional[asyncio.Task] = None
+        self._start_lock = asyncio.Lock()
+
+    async def attach(self, deliver: DeliverFn, last_seq: Optional[int] = None) -> None:
+        async with self._start_lock:
+            if self._tail_task is None:
+                # 镜像日志从存储的当前位置开始，更早的帧按需从存储补发
+                last = await asyncio.to_thread(self.store.last_seq, self.session_id)
+                self.log.last_seq = self.log.evicted_upto = last
+                self._tail_task = asyncio.create_task(self._tail())
+        await super().attach(deliver, last_seq)
+
+    def _on_idle(self) -> None:
+        self._stop()
+
+    async def handle(self, message: Dict[str, Any]) -> None:
+        await asyncio.to_thread(self.store.push_control, self.session_id, message)
+
+    def _stop(self) -> None:
+        if self._tail_task is not None and self._tail_task is not asyncio.current_task():
+            self._tail_task.cancel()
+        if _REMOTES.get(self.session_id) is self:
+            del _REMOTES[self.session_id]
+
+    async def _tail(self) -> None:
+        polls = 0
+        while True:
+            frames = await asyncio.to_thread(self.store.events_since, self.session_id, self.log.last_seq)
+            if frames is None:
+                # 缺口（落后太多或新讨论已开始）：先发快照，再补发存储中保留的帧
+                frames = await asyncio.to_thread(self.store.retained_events, self.session_id)
+                if frames:
+                    seq = frames[0]["seq"] - 1
+                else:
+                    seq = await asyncio.to_thread(self.store.last_seq, self.session_id)
+                snapshot = await _snapshot_frame(self.config, seq)
+                self.log.reset()
+                self.log.last_seq = self.log.evicted_upto = seq
+                self._broadcast(snapshot)
+            for frame in frames:
+                self._broadcast(self.log.insert(frame))
+            polls += 1
+            # 约每个租约周期检查一次持有者是否仍然存活
+            if polls % max(int(SESSION_LEASE_TTL / SESSION_POLL_INTERVAL / 3), 1) == 0:
+                owner = await asyncio.to_thread(self.store.lease_owner, self.session_id)
+                if owner is None:
+                    self._broadcast({"type": "reconnect"})
+                    self._stop()
+                    return
+            await asyncio.sleep(SESSION_POLL_INTERVAL)
+
+
+# 本 worker 的标识，用于会话租约
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+# session_id -> 本 worker 持有的会话；断线重连时复用同一个会话对象
+_SESSIONS: Dict[str, DiscussionSession] = {}
+# session_id -> 其他 worker 持有的会话在本 worker 上的代理，本 worker 上的所有观看者共用
+_REMOTES: Dict[str, RemoteSession] = {}
+
+
+async def get_session(session_id: str) -> Union[DiscussionSession, RemoteSession]:
+    """取得 session_id 对应的会话：本 worker 已持有或能获得租约时在本地运行，否则返回代理。"""
+    session = _SESSIONS.get(session_id)
+    if session is not None:
+        return session
+    acquired = await asyncio.to_thread(COMPONENTS.store.acquire_lease, session_id, WORKER_ID, SESSION_LEASE_TTL)
+    # 获取租约期间其他连接可能已经创建了会话
+    session = _SESSIONS.get(session_id)
+    if session is not None:
+        return session
+    if not acquired:
+        remote = _REMOTES.get(session_id)
+        if remote is None:
+            remote = _REMOTES[session_id] = RemoteSession(session_id)
+        return remote
+    session = _SESSIONS[session_id] = DiscussionSession(session_id)
+    try:
+        await session.open()
+    except BaseException:
+        # 接管失败：注销半初始化的会话，释放租约与网关监听，之后的连接会重新尝试
+        _SESSIONS.pop(session_id, None)
+        try:
+            await session.close()
+        except Exception as e:
+            print(f"Failed to clean up session {session_id}: {e}")
+        raise
+    return session
+
+
+async def close_all_sessions() -> None:
+    """服务关闭时停止所有会话并释放租约。"""
+    for session in list(_SESSIONS.values()):
+        await session.close()
+    for remote in list(_REMOTES.values()):
+        remote._stop()
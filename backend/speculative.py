@@ -0,0 +1,101 @@
+"""PBL2.backend.speculative
+投机生成：在主持人 LLM 做路由决策的同时，提前为最可能的下一位学生生成发言。
+路由结果出来后只保留被选中的那一路，其余立即取消。
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from langchain_core.messages import AIMessage
+
+
+class SpeculativeRunner:
+    """按 thread_id 管理投机生成的任务。
+
+    每个任务都绑定到生成时最后一条消息的 id（``anchor_id``），学生节点只会采用基于同一条消息生成的结果，
+    避免老师插话或摘要之后误用过期的回复。
+    """
+
+    def __init__(self, max_branches: int = 2):
+        self.max_branches = max_branches
+        # thread_id -> (anchor_id, {agent_id: task})
+        self._pending: Dict[str, Tuple[str, Dict[str, asyncio.Task]]] = {}
+        self.stats: Dict[str, int] = {"started": 0, "committed": 0, "cancelled": 0, "discarded": 0}
+
+    def start(
+        self,
+        thread_id: str,
+        anchor_id: str,
+        candidates: List[str],
+        factory: Callable[[str], Awaitable[AIMessage]],
+    ) -> None:
+        """为前 ``max_branches`` 名候选人启动生成任务。"""
+        self.cancel(thread_id)
+        tasks = {}
+        for agent_id in candidates[: self.max_branches]:
+            # 在空的 context 中创建任务，避免投机分支的 token 经由回调混入当前节点的流式输出
+            tasks[agent_id] = contextvars.Context().run(
+                asyncio.get_running_loop().create_task, factory(agent_id)
+            )
+            self.stats["started"] += 1
+        self._pending[thread_id] = (anchor_id, tasks)
+
+    def keep_only(self, thread_id: str, agent_id: Optional[str]) -> None:
+        """路由结果确定后，取消除 ``agent_id`` 之外的所有分支。"""
+        entry = self._pending.get(thread_id)
+        if entry is None:
+            return
+        _, tasks = entry
+        for other_id, task in list(tasks.items()):
+            if other_id != agent_id:
+                task.cancel()
+                del tasks[other_id]
+                self.stats["cancelled"] += 1
+        if not tasks:
+            del self._pending[thread_id]
+
+    async def take(self, thread_id: str, agent_id: str, anchor_id: str) -> Optional[AIMessage]:
+        """取出基于 ``anchor_id`` 这条消息生成的投机结果；没有可用结果时返回 None，由调用方正常生成。"""
+        entry = self._pending.pop(thread_id, None)
+        if entry is None:
+            return None
+        spec_anchor, tasks = entry
+        task = tasks.pop(agent_id, None)
+        for other in tasks.values():
+            other.cancel()
+            self.stats["cancelled"] += 1
+        if task is None:
+            return None
+        if spec_anchor != anchor_id:
+            task.cancel()
+            self.stats["discarded"] += 1
+            return None
+
+        try:
+            # asyncio.wait 不会把调用方的取消传递给任务，便于区分两种取消
+            await asyncio.wait({task})
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        if task.cancelled() or task.exception() is not None:
+            self.stats["discarded"] += 1
+            return None
+        ai_msg = task.result()
+
+        # 超出 token 预算被截断的回复不能直接使用
+        if ai_msg.response_metadata.get("finish_reason") == "length":
+            self.stats["discarded"] += 1
+            return None
+        self.stats["committed"] += 1
+        return ai_msg
+
+    def cancel(self, thread_id: str) -> None:
+        """取消某个会话的全部投机任务。"""
+        entry = self._pending.pop(thread_id, None)
+        if entry is None:
+            return
+        for task in entry[1].values():
+            task.cancel()
+            self.stats["cancelled"] += 1
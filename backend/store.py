@@ -0,0 +1,451 @@
+"""PBL2.backend.store
+会话的共享存储：persona、出站事件流、控制通道与会话归属（租约）。
+
+多个 worker（``uvicorn --workers N`` 或多台主机）通过同一个 SessionStore 协作：
+持有租约的 worker 负责运行该会话的图，其他 worker 上的连接从事件流读取输出，
+并把老师的操作写入控制通道，由持有者执行。图的状态本身保存在共享的检查点存储中。
+
+- MemorySessionStore：单进程（默认），租约总是成功，事件不需要跨进程共享；
+- SQLiteSessionStore：本机多进程共享的文件实现，也便于测试。其他后端（如 Redis）实现同样的接口即可。
+"""
+from __future__ import annotations
+
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import orjson
+
+from .event_log import EventLog, Frame
+
+# 带版本号的 persona：(version, persona)。每次保存某个 agent 的 persona，其版本号加一
+VersionedPersona = Tuple[int, Dict]
+
+# 全局 persona 的作用域名：新会话从这里复制一份 persona 快照
+GLOBAL_SCOPE = ""
+
+
+class SessionStore:
+    """会话共享存储的接口。所有方法都是同步的，调用方在需要时放到线程中执行。"""
+
+    # 为 True 时事件流与控制通道可以跨进程访问，会话需要把出站帧写入存储
+    shared = False
+
+    # ---------- persona ----------
+
+    def load_personas(self, scope: str = GLOBAL_SCOPE) -> Dict[str, VersionedPersona]:
+        """返回该作用域（会话 id 或 GLOBAL_SCOPE）已保存的 persona，没有时返回空字典。"""
+        raise NotImplementedError
+
+    def save_personas(self, personas: Dict[str, Dict], scope: str = GLOBAL_SCOPE) -> Dict[str, int]:
+        """覆盖写入 persona，返回各 agent 的新版本号。"""
+        raise NotImplementedError
+
+    def init_personas(self, scope: str, personas: Dict[str, Dict]) -> Dict[str, VersionedPersona]:
+        """仅写入该作用域中尚不存在的 persona（版本号为 1），返回写入后的全部 persona。
+
+        多个 worker 同时为同一会话建立快照时只有第一份生效。
+        """
+        raise NotImplementedError
+
+    def drop_personas(self, scope: str) -> None:
+        """删除某个会话的 persona 快照。会话的检查点被淘汰、讨论无法再继续时调用。"""
+        raise NotImplementedError
+
+    # ---------- 事件流 ----------
+
+    def append_events(self, session_id: str, frames: List[Frame]) -> None:
+        """追加已分配序号的帧（序号由会话的持有者分配）。"""
+        raise NotImplementedError
+
+    def events_since(self, session_id: str, last_seq: int) -> Optional[List[Frame]]:
+        """返回序号大于 last_seq 的帧；出现缺口时返回 None。"""
+        raise NotImplementedError
+
+    def retained_events(self, session_id: str) -> List[Frame]:
+        raise NotImplementedError
+
+    def last_seq(self, session_id: str) -> int:
+        raise NotImplementedError
+
+    def reset_events(self, session_id: str, upto: int) -> None:
+        """开始新讨论时清空事件流，序号不大于 upto 的帧视为已淘汰。"""
+        raise NotImplementedError
+
+    # ---------- 控制通道 ----------
+
+    def push_control(self, session_id: str, command: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def pop_controls(self, session_id: str) -> List[Dict[str, Any]]:
+        """取出并删除该会话所有待处理的命令（按写入顺序）。"""
+        raise NotImplementedError
+
+    # ---------- 租约 ----------
+
+    def acquire_lease(self, session_id: str, worker_id: str, ttl: float) -> bool:
+        """获取或续约会话的租约；租约被其他未过期的 worker 持有时返回 False。"""
+        raise NotImplementedError
+
+    def release_lease(self, session_id: str, worker_id: str) -> None:
+        raise NotImplementedError
+
+    def lease_owner(self, session_id: str) -> Optional[str]:
+        """当前未过期租约的持有者。"""
+        raise NotImplementedError
+
+    def drop_session(self, session_id: str) -> None:
+        """会话在本 worker 上关闭（或过期）时调用，丢弃只在本进程内有用的数据。
+
+        共享实现中的数据仍可能被其他 worker 接管会话时使用，默认保留。
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    """进程内实现：单 worker 部署时使用。"""
+
+    shared = False
+
+    def __init__(self, max_events: int = 2000):
+        self.max_events = max_events
+        self._personas: Dict[str, Dict[str, VersionedPersona]] = {}
+        self._logs: Dict[str, EventLog] = {}
+        self._controls: Dict[str, List[Dict[str, Any]]] = {}
+        self._leases: Dict[str, tuple] = {}
+
+    def load_personas(self, scope: str = GLOBAL_SCOPE) -> Dict[str, VersionedPersona]:
+        return dict(self._personas.get(scope, {}))
+
+    def save_personas(self, personas: Dict[str, Dict], scope: str = GLOBAL_SCOPE) -> Dict[str, int]:
+        saved = self._personas.setdefault(scope, {})
+        for agent_id, persona in personas.items():
+            saved[agent_id] = (saved.get(agent_id, (0, None))[0] + 1, persona)
+        return {agent_id: saved[agent_id][0] for agent_id in personas}
+
+    def init_personas(self, scope: str, personas: Dict[str, Dict]) -> Dict[str, VersionedPersona]:
+        saved = self._personas.setdefault(scope, {})
+        for agent_id, persona in personas.items():
+            saved.setdefault(agent_id, (1, persona))
+        return dict(saved)
+
+    def drop_personas(self, scope: str) -> None:
+        self._personas.pop(scope, None)
+
+    def _log(self, session_id: str) -> EventLog:
+        """写入用：按需创建该会话的日志。只读的查询不创建日志，避免为只被探测过的会话 id 保留对象。"""
+        log = self._logs.get(session_id)
+        if log is None:
+            log = self._logs[session_id] = EventLog(self.max_events)
+        return log
+
+    def append_events(self, session_id: str, frames: List[Frame]) -> None:
+        log = self._log(session_id)
+        for frame in frames:
+            log.insert(frame)
+
+    def events_since(self, session_id: str, last_seq: int) -> Optional[List[Frame]]:
+        log = self._logs.get(session_id)
+        if log is None:
+            return [] if last_seq == 0 else None
+        return log.since(last_seq)
+
+    def retained_events(self, session_id: str) -> List[Frame]:
+        log = self._logs.get(session_id)
+        return log.retained() if log is not None else []
+
+    def last_seq(self, session_id: str) -> int:
+        log = self._logs.get(session_id)
+        return log.last_seq if log is not None else 0
+
+    def reset_events(self, session_id: str, upto: int) -> None:
+        log = self._log(session_id)
+        log.reset()
+        log.last_seq = log.evicted_upto = upto
+
+    def push_control(self, session_id: str, command: Dict[str, Any]) -> None:
+        self._controls.setdefault(session_id, []).append(command)
+
+    def pop_controls(self, session_id: str) -> List[Dict[str, Any]]:
+        return self._controls.pop(session_id, [])
+
+    def acquire_lease(self, session_id: str, worker_id: str, ttl: float) -> bool:
+        owner, until = self._leases.get(session_id, (None, 0.0))
+        now = time.time()
+        if owner not in (None, worker_id) and until > now:
+            return False
+        self._leases[session_id] = (worker_id, now + ttl)
+        return True
+
+    def release_lease(self, session_id: str, worker_id: str) -> None:
+        if self._leases.get(session_id, (None,))[0] == worker_id:
+            del self._leases[session_id]
+
+    def lease_owner(self, session_id: str) -> Optional[str]:
+        owner, until = self._leases.get(session_id, (None, 0.0))
+        return owner if until > time.time() else None
+
+    def drop_session(self, session_id: str) -> None:
+        # 单进程部署中没有其他 worker 会接管该会话。persona 快照保留：检查点仍在时讨论可以继续，
+        # 快照随检查点的淘汰一起删除（见 drop_personas）
+        self._logs.pop(session_id, None)
+        self._controls.pop(session_id, None)
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS personas (
+    scope TEXT NOT NULL,
+    agent_id TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    persona BLOB NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (scope, agent_id)
+);
+CREATE TABLE IF NOT EXISTS session_meta (
+    session_id TEXT PRIMARY KEY,
+    last_seq INTEGER NOT NULL DEFAULT 0,
+    evicted_upto INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    lease_until REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS events (
+    session_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    message_id TEXT,
+    frame BLOB NOT NULL,
+    PRIMARY KEY (session_id, seq)
+);
+CREATE TABLE IF NOT EXISTS controls (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    command BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_controls_session ON controls (session_id, id);
+"""
+
+
+class SQLiteSessionStore(SessionStore):
+    """基于 SQLite 文件的共享实现：同一主机上的多个 worker 打开同一个文件即可协作。
+
+    Args:
+        path: 数据库文件路径。
+        max_events: 每个会话保留的最多帧数。
+    """
+
+    shared = True
+
+    def __init__(self, path: str, max_events: int = 2000):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.max_events = max_events
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    # ---------- persona ----------
+
+    def _load_personas(self, scope: str) -> Dict[str, VersionedPersona]:
+        rows = self._conn.execute(
+            "SELECT agent_id, version, persona FROM personas WHERE scope=?", (scope,)
+        ).fetchall()
+        return {agent_id: (version, orjson.loads(persona)) for agent_id, version, persona in rows}
+
+    def load_personas(self, scope: str = GLOBAL_SCOPE) -> Dict[str, VersionedPersona]:
+        with self._lock:
+            return self._load_personas(scope)
+
+    def save_personas(self, personas: Dict[str, Dict], scope: str = GLOBAL_SCOPE) -> Dict[str, int]:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO personas VALUES (?, ?, 1, ?, ?) "
+                    "ON CONFLICT(scope, agent_id) DO UPDATE SET "
+                    "version=version+1, persona=excluded.persona, updated_at=excluded.updated_at",
+                    [(scope, agent_id, orjson.dumps(p), now) for agent_id, p in personas.items()],
+                )
+                versions = {agent_id: version for agent_id, (version, _) in self._load_personas(scope).items()}
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return {agent_id: versions[agent_id] for agent_id in personas}
+
+    def init_personas(self, scope: str, personas: Dict[str, Dict]) -> Dict[str, VersionedPersona]:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO personas VALUES (?, ?, 1, ?, ?)",
+                    [(scope, agent_id, orjson.dumps(p), now) for agent_id, p in personas.items()],
+                )
+                saved = self._load_personas(scope)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return saved
+
+    def drop_personas(self, scope: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM personas WHERE scope=?", (scope,))
+
+    # ---------- 事件流 ----------
+
+    def _meta(self, session_id: str) -> tuple:
+        row = self._conn.execute(
+            "SELECT last_seq, evicted_upto FROM session_meta WHERE session_id=?", (session_id,)
+        ).fetchone()
+        return row or (0, 0)
+
+    def append_events(self, session_id: str, frames: List[Frame]) -> None:
+        if not frames:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for frame in frames:
+                    kind = frame.get("type")
+                    message_id = frame.get("message_id")
+                    if kind in ("message_complete", "message_cancelled") and message_id:
+                        # 与 EventLog 相同：完成后不再需要该消息的 delta
+                        self._conn.execute(
+                            "DELETE FROM events WHERE session_id=? AND type='delta' AND message_id=?",
+                            (session_id, message_id),
+                        )
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?)",
+                        (session_id, frame["seq"], kind, message_id, orjson.dumps(frame)),
+                    )
+                last_seq = frames[-1]["seq"]
+                self._conn.execute(
+                    "INSERT INTO session_meta (session_id, last_seq) VALUES (?, ?) "
+                    "ON CONFLICT(session_id) DO UPDATE SET last_seq=excluded.last_seq",
+                    (session_id, last_seq),
+                )
+                count = self._conn.execute("SELECT COUNT(*) FROM events WHERE session_id=?", (session_id,)).fetchone()[0]
+                if count > self.max_events:
+                    cutoff = self._conn.execute(
+                        "SELECT seq FROM events WHERE session_id=? ORDER BY seq LIMIT 1 OFFSET ?",
+                        (session_id, count - self.max_events - 1),
+                    ).fetchone()[0]
+                    self._conn.execute("DELETE FROM events WHERE session_id=? AND seq<=?", (session_id, cutoff))
+                    self._conn.execute(
+                        "UPDATE session_meta SET evicted_upto=? WHERE session_id=?", (cutoff, session_id)
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def events_since(self, session_id: str, last_seq: int) -> Optional[List[Frame]]:
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                store_last, evicted_upto = self._meta(session_id)
+                if last_seq < evicted_upto or last_seq > store_last:
+                    return None
+                rows = self._conn.execute(
+                    "SELECT frame FROM events WHERE session_id=? AND seq>? ORDER BY seq", (session_id, last_seq)
+                ).fetchall()
+            finally:
+                self._conn.execute("COMMIT")
+        return [orjson.loads(r[0]) for r in rows]
+
+    def retained_events(self, session_id: str) -> List[Frame]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT frame FROM events WHERE session_id=? ORDER BY seq", (session_id,)
+            ).fetchall()
+        return [orjson.loads(r[0]) for r in rows]
+
+    def last_seq(self, session_id: str) -> int:
+        with self._lock:
+            return self._meta(session_id)[0]
+
+    def reset_events(self, session_id: str, upto: int) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute("DELETE FROM events WHERE session_id=?", (session_id,))
+            self._conn.execute(
+                "INSERT INTO session_meta (session_id, last_seq, evicted_upto) VALUES (?, ?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET last_seq=excluded.last_seq, evicted_upto=excluded.evicted_upto",
+                (session_id, upto, upto),
+            )
+            self._conn.execute("COMMIT")
+
+    # ---------- 控制通道 ----------
+
+    def push_control(self, session_id: str, command: Dict[str, Any]) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO controls (session_id, command) VALUES (?, ?)", (session_id, orjson.dumps(command))
+            )
+
+    def pop_controls(self, session_id: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            rows = self._conn.execute(
+                "SELECT id, command FROM controls WHERE session_id=? ORDER BY id", (session_id,)
+            ).fetchall()
+            if rows:
+                self._conn.execute("DELETE FROM controls WHERE session_id=? AND id<=?", (session_id, rows[-1][0]))
+            self._conn.execute("COMMIT")
+        return [orjson.loads(command) for _, command in rows]
+
+    # ---------- 租约 ----------
+
+    def acquire_lease(self, session_id: str, worker_id: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT owner, lease_until FROM session_meta WHERE session_id=?", (session_id,)
+                ).fetchone()
+                if row is not None and row[0] not in (None, worker_id) and row[1] > now:
+                    return False
+                self._conn.execute(
+                    "INSERT INTO session_meta (session_id, owner, lease_until) VALUES (?, ?, ?) "
+                    "ON CONFLICT(session_id) DO UPDATE SET owner=excluded.owner, lease_until=excluded.lease_until",
+                    (session_id, worker_id, now + ttl),
+                )
+                return True
+            finally:
+                self._conn.execute("COMMIT")
+
+    def release_lease(self, session_id: str, worker_id: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE session_meta SET owner=NULL, lease_until=0 WHERE session_id=? AND owner=?",
+                (session_id, worker_id),
+            )
+
+    def lease_owner(self, session_id: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT owner, lease_until FROM session_meta WHERE session_id=?", (session_id,)
+            ).fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+        return row[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def build_session_store(backend: str, path: str, max_events: int = 2000) -> SessionStore:
+    """根据配置创建会话存储："memory"（单 worker）或 "sqlite"（本机多 worker 共享）。"""
+    if backend == "sqlite":
+        return SQLiteSessionStore(path, max_events=max_events)
+    return MemorySessionStore(max_events=max_events)
@@ -0,0 +1,82 @@
+"""PBL2.backend.summary_runner
+后台摘要：把摘要从讨论的关键路径上移走。
+
+路由器发现未摘要的消息过多时，截取到某条消息（目标水位线）为止的快照，在后台任务中
+把它折叠进已有摘要；讨论同时照常进行。之后的某次路由取回结果并合并进 state。
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Optional
+
+
+@dataclass
+class SummaryJob:
+    """一次后台摘要任务。
+
+    Attributes:
+        base_watermark: 启动时 state 中的摘要水位线，合并时据此判断结果是否过期。
+        target_watermark: 快照中最后一条消息的 id，合并后成为新的水位线。
+        task: 产出新摘要文本的任务。
+    """
+
+    base_watermark: str
+    target_watermark: str
+    task: asyncio.Task
+
+
+class BackgroundSummarizer:
+    """按 thread_id 管理后台摘要任务，每个会话同时最多一个。"""
+
+    def __init__(self):
+        self._jobs: Dict[str, SummaryJob] = {}
+        self.stats: Dict[str, int] = {"started": 0, "merged": 0, "discarded": 0, "failed": 0}
+
+    def running(self, thread_id: str) -> bool:
+        return thread_id in self._jobs
+
+    def start(
+        self,
+        thread_id: str,
+        base_watermark: str,
+        target_watermark: str,
+        factory: Callable[[], Awaitable[str]],
+    ) -> None:
+        """启动一次摘要；该会话已有任务在进行时忽略。"""
+        if thread_id in self._jobs:
+            return
+        # 在空的 context 中创建任务，避免摘要的 token 经由回调混入当前节点的流式输出
+        task = contextvars.Context().run(asyncio.get_running_loop().create_task, factory())
+        self._jobs[thread_id] = SummaryJob(base_watermark, target_watermark, task)
+        self.stats["started"] += 1
+
+    def collect(self, thread_id: str, current_watermark: str) -> Optional[SummaryJob]:
+        """取出已完成的任务；未完成时返回 None 并保持任务继续运行。
+
+        任务启动后若 state 的水位线已经变化（会话被重置或被其他摘要推进），结果视为过期并丢弃；
+        失败的任务同样丢弃，下一次路由会重新触发摘要。
+        """
+        job = self._jobs.get(thread_id)
+        if job is None or not job.task.done():
+            return None
+        del self._jobs[thread_id]
+        if job.task.cancelled():
+            self.stats["discarded"] += 1
+            return None
+        if job.task.exception() is not None:
+            print(f"Background summary failed for {thread_id}: {job.task.exception()}")
+            self.stats["failed"] += 1
+            return None
+        if job.base_watermark != current_watermark:
+            self.stats["discarded"] += 1
+            return None
+        self.stats["merged"] += 1
+        return job
+
+    def cancel(self, thread_id: str) -> None:
+        job = self._jobs.pop(thread_id, None)
+        if job is not None and not job.task.done():
+            job.task.cancel()
+            self.stats["discarded"] += 1
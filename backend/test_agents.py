@@ -2,16 +2,20 @@
 对 agents.py 中的节点进行单元测试。
 """
 import asyncio
+import tempfile
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import MagicMock, patch
 
-from langchain_core.messages import HumanMessage, AIMessage
-from langchain_core.outputs import ChatGeneration
+from langchain_core.messages import HumanMessage, AIMessage, AIMessageChunk
 
 # 在测试环境中，我们需要确保模块可以被正确导入
 # 这通常需要配置 PYTHONPATH 或使用相对导入
 from . import agents
+from .components import COMPONENTS
 from .graph import GraphState
+from .llm_cache import ResponseCache
+from .retrieval import RetrievalIndex, build_index
+from .store import MemorySessionStore
 
 
 class TestAgentNodes(unittest.TestCase):
@@ -45,18 +49,22 @@ class TestAgentNodes(unittest.TestCase):
             "is_teacher_interrupted": False,
         }
 
-        # 2. 创建一个模拟的 AI 回复
+        # 2. 创建一个模拟的流式 AI 回复（按 chunk 返回）
         mock_ai_response = AIMessage(content="根据ST段抬高，我首先考虑急性心肌梗死。")
-        mock_generation = ChatGeneration(message=mock_ai_response)
-        mock_llm_result = MagicMock()
-        mock_llm_result.generations = [mock_generation]
+        mock_chunks = [
+            AIMessageChunk(content="根据ST段抬高，", id="run-1"),
+            AIMessageChunk(content="我首先考虑急性心肌梗死。", id="run-1"),
+        ]
+
+        async def _fake_astream(prompt):
+            for chunk in mock_chunks:
+                yield chunk
 
         # 3. 使用 patch 来替换真实的 LLM 调用
-        with patch('PBL2.backend.agents.STUDENT_LLM') as mock_llm:
-            # 配置 mock LLM 的异步方法 agenerate 的返回值
-            future = asyncio.Future()
-            future.set_result(mock_llm_result)
-            mock_llm.agenerate.return_value = future
+        mock_llm = MagicMock()
+        with COMPONENTS.override(student_llm=mock_llm, store=MemorySessionStore()):
+            # 配置 mock LLM 的流式方法 astream
+            mock_llm.astream.side_effect = _fake_astream
 
             # 4. 运行被测试的异步节点函数
             result = self.run_async_test(agents.STUDENT_ANALYST(initial_state))
@@ -73,6 +81,92 @@ class TestAgentNodes(unittest.TestCase):
         self.assertIn("next_speaker", result, "输出应包含 'next_speaker' 键")
         self.assertEqual(result["next_speaker"], "router", "'next_speaker' 应被设置为 'router'")
 
+    def test_session_persona_snapshot(self):
+        """会话使用开始时的 persona 快照；全局修改不影响它，会话自己的修改使提示词重新编译，会话关闭后快照保留。"""
+        store = MemorySessionStore()
+        with COMPONENTS.override(store=store):
+            original = agents.get_personas("s1")["student_analyst"]
+            changed = {**agents.student_personas["student_analyst"], "proficiency": 2}
+            store.save_personas({"student_analyst": changed})
+            self.assertEqual(agents.get_personas("s1")["student_analyst"], original)
+            self.assertEqual(agents.get_personas("s2")["student_analyst"][1]["proficiency"], 2)
+
+            sys_msg, _ = agents.student_system_message("s1", "student_analyst", *original)
+            self.assertIn("知识熟练程度: 8/10", sys_msg.content)
+            self.assertIs(agents.student_system_message("s1", "student_analyst", *original)[0], sys_msg)
+
+            store.save_personas({"student_analyst": changed}, "s1")
+            version, persona = agents.get_personas("s1")["student_analyst"]
+            self.assertEqual(version, 2)
+            updated, _ = agents.student_system_message("s1", "student_analyst", version, persona)
+            self.assertIn("知识熟练程度: 2/10", updated.content)
+            self.assertNotIn(("s1", "student_analyst", 1), agents._STUDENT_SYSTEM_CACHE)
+
+            # 会话过期关闭后检查点仍可继续讨论，恢复时沿用同一份快照
+            store.drop_session("s1")
+            self.assertEqual(agents.get_personas("s1")["student_analyst"], (version, persona))
+
+    def test_reference_message_from_index(self):
+        """学生 prompt 只注入与最近消息相关的指南片段；没有索引时不注入。"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            build_index([
+                ("acs.md", "高敏肌钙蛋白升高提示心肌损伤。"),
+                ("dm.md", "糖尿病应定期监测血糖。"),
+            ], tmpdir)
+            messages = [HumanMessage(content="患者胸痛，肌钙蛋白升高。", name="case_introduction")]
+            with patch('backend.agents.guideline_index', return_value=RetrievalIndex(tmpdir)):
+                ref_msg = agents.reference_message(messages)
+            self.assertIn("acs.md", ref_msg.content)
+            self.assertNotIn("dm.md", ref_msg.content)
+        with patch('backend.agents.guideline_index', return_value=None):
+            self.assertIsNone(agents.reference_message(messages))
+
+    def test_parallel_round(self):
+        """轮次发言：三名学生并行发言，消息按 ROUND_SPEAKERS 的顺序写入，与完成先后无关。"""
+        from langgraph.checkpoint.memory import MemorySaver
+
+        from .graph import wf
+        from .session import initial_state
+
+        # persona 中各学生独有的特征 -> 学生
+        markers = {"锚定偏差": "analyst", "多线并行": "observer", "代表性启发": "skeptic"}
+        started, finished = [], []
+        all_started = asyncio.Event()
+        done = {agent: asyncio.Event() for agent in markers.values()}
+        # 完成顺序与 ROUND_SPEAKERS 相反：skeptic 先完成，analyst 最后
+        waits_for = {"analyst": "observer", "observer": "skeptic", "skeptic": None}
+
+        async def _fake_astream(prompt):
+            agent = next(a for marker, a in markers.items() if marker in prompt[0].content)
+            started.append(agent)
+            if len(started) == len(markers):
+                all_started.set()
+            # 三次调用都开始之后才能继续：串行执行时这里会超时
+            await asyncio.wait_for(all_started.wait(), timeout=5)
+            if waits_for[agent]:
+                await done[waits_for[agent]].wait()
+            finished.append(agent)
+            done[agent].set()
+            yield AIMessageChunk(content=f"{agent} 的发言")
+
+        async def _fake_summary():
+            yield AIMessageChunk(content="总结")
+
+        app = wf.compile(checkpointer=MemorySaver())
+        state = initial_state("并行发言测试：患者发热三天。", {"max_turns": 3})
+        config = {"configurable": {"thread_id": "test-parallel-round"}}
+        student_llm, host_llm = MagicMock(), MagicMock()
+        with patch('backend.agents.ROUND_MODE', "boundary"), COMPONENTS.override(
+                student_llm=student_llm, host_llm=host_llm, store=MemorySessionStore(), response_cache=ResponseCache(path=None)):
+            student_llm.astream.side_effect = _fake_astream
+            host_llm.astream.side_effect = lambda prompt: _fake_summary()
+            result = self.run_async_test(app.ainvoke(state, config))
+
+        self.assertEqual(finished, ["skeptic", "observer", "analyst"])
+        names = [m.name for m in result["messages"]]
+        self.assertEqual(names, ["case_introduction", "student_analyst", "student_observer", "student_skeptic", "final_summary"])
+        self.assertEqual(result["usage"]["turns"], 3)
+        host_llm.agenerate.assert_not_called()
 
 # 如何运行测试:
 # 在 PBL2 目录下打开终端，然后执行以下命令:
@@ -0,0 +1,87 @@
+"""PBL2.backend.test_batch
+对 batch.py 中病例读取、续跑逻辑与单个病例的运行进行单元测试。
+"""
+import asyncio
+import itertools
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage
+from langgraph.checkpoint.memory import MemorySaver
+
+from . import graph
+from .batch import Case, load_cases, load_finished, run_case
+from .components import COMPONENTS
+from .llm_cache import ResponseCache
+from .store import MemorySessionStore
+
+
+class TestBatchFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.tmpdir.name, name)
+
+    def test_load_cases(self):
+        with open(self._path("cases.jsonl"), "w", encoding="utf-8") as f:
+            f.write(json.dumps({"case_id": "a", "initial_case": "胸痛", "max_turns": 3}) + "\n\n")
+            f.write(json.dumps({"initial_case": "腹痛"}) + "\n")
+        cases = load_cases(self._path("cases.jsonl"))
+        self.assertEqual([(c.case_id, c.max_turns) for c in cases], [("a", 3), ("line-3", None)])
+
+    def test_duplicate_case_ids_rejected(self):
+        """重复的 case_id 会共用同一个检查点线程，读取时直接报错。"""
+        with open(self._path("cases.jsonl"), "w", encoding="utf-8") as f:
+            f.write(json.dumps({"case_id": "a", "initial_case": "胸痛"}) + "\n")
+            f.write(json.dumps({"case_id": "a", "initial_case": "腹痛"}) + "\n")
+        with self.assertRaisesRegex(ValueError, "第 1 行重复"):
+            load_cases(self._path("cases.jsonl"))
+
+    def test_resume_skips_finished_and_truncates_partial_line(self):
+        """error 的病例需要重跑；崩溃留下的半行被截掉，之后追加的结果从新行开始。"""
+        path = self._path("out.jsonl")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"case_id": "a", "status": "completed"}) + "\n")
+            f.write(json.dumps({"case_id": "b", "status": "error"}) + "\n")
+            f.write('{"case_id": "c", "sta')
+        self.assertEqual(load_finished(path), {"a"})
+        with open(path, encoding="utf-8") as f:
+            self.assertTrue(f.read().endswith('"error"}\n'))
+        self.assertEqual(load_finished(self._path("missing.jsonl")), set())
+
+
+
+class TestRunCase(unittest.TestCase):
+
+    def test_run_case_until_turn_limit(self):
+        """发言轮数用完后生成总结并结束，记录包含完整的讨论与状态。"""
+        checkpointer = MemorySaver()
+        student_llm = GenericFakeChatModel(messages=itertools.cycle([AIMessage(content="可能 是 急性 冠脉 综合征")]))
+        host_llm = GenericFakeChatModel(messages=itertools.cycle([AIMessage(content="observer")]))
+        app = graph.wf.compile(checkpointer=checkpointer)
+        with patch('backend.agents.LLM_CACHE_ENABLED', False), COMPONENTS.override(
+                checkpointer=checkpointer, app=app, student_llm=student_llm, host_llm=host_llm,
+                store=MemorySessionStore(), response_cache=ResponseCache(path=None)):
+            record = asyncio.run(run_case(Case("c1", "54岁男性，突发胸痛 2 小时。"), 2, None, None))
+
+        self.assertEqual(record["status"], "turn_limit")
+        self.assertEqual(record["turns"], 2)
+        nodes = [entry["node"] for entry in record["transcript"]]
+        self.assertEqual(nodes[0], "case_introduction")
+        self.assertEqual(sum(node.startswith("student_") for node in nodes), 2)
+        self.assertEqual(nodes[-1], "final_summary")
+        # 运行结束后检查点被删除
+        self.assertIsNone(asyncio.run(checkpointer.aget_tuple({"configurable": {"thread_id": "batch-c1"}})))
+
+
+if __name__ == '__main__':
+    unittest.main()
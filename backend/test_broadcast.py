@@ -0,0 +1,95 @@
+"""PBL2.backend.test_broadcast
+对 broadcast.py 中订阅者队列的 delta 合并、慢消费者处理、连接角色与 WebSocket 连接的清理进行单元测试。
+"""
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, patch
+
+from . import broadcast
+from .broadcast import ROLE_OBSERVER, ROLE_TEACHER, Subscriber, connection_role
+
+
+def _drain(subscriber: Subscriber):
+    async def _main():
+        return [await subscriber.get() for _ in range(len(subscriber))]
+    return asyncio.run(_main())
+
+
+class TestSubscriber(unittest.TestCase):
+
+    def test_deltas_coalesced_in_seq_order(self):
+        """同一消息的 delta 合并到最后一个 delta 的位置；已完成消息的 delta 被丢弃。"""
+        sub = Subscriber(ROLE_OBSERVER, max_frames=4)
+        frames = [
+            {"type": "delta", "message_id": "m2", "delta": "心", "seq": 1},
+            {"type": "delta", "message_id": "m1", "delta": "胸", "seq": 2},
+            {"type": "message_complete", "message_id": "m1", "content": "胸痛", "seq": 3},
+            {"type": "delta", "message_id": "m2", "delta": "电", "seq": 4},
+            {"type": "delta", "message_id": "m2", "delta": "图", "seq": 5},
+        ]
+        for frame in frames:
+            sub.deliver(frame)
+        out = _drain(sub)
+        self.assertEqual([f["seq"] for f in out], [3, 5])
+        self.assertEqual(out[1]["delta"], "心电图")
+        self.assertEqual(frames[4]["delta"], "图")  # 与事件日志共享的原帧不被修改
+        self.assertFalse(sub.overflowed)
+
+    def test_slow_consumer_is_asked_to_reconnect(self):
+        sub = Subscriber(ROLE_OBSERVER, max_frames=2)
+        for i in range(4):
+            sub.deliver({"type": "message_complete", "message_id": f"m{i}", "seq": i + 1})
+        self.assertTrue(sub.overflowed)
+        self.assertEqual(_drain(sub), [{"type": "reconnect", "reason": "slow_consumer"}])
+        sub.deliver({"type": "message_complete", "message_id": "m9", "seq": 9})
+        self.assertEqual(len(sub), 0)
+
+    def test_connection_role(self):
+        with patch.object(broadcast, "SESSION_TEACHER_TOKEN", ""):
+            self.assertEqual(connection_role(None), ROLE_TEACHER)
+        with patch.object(broadcast, "SESSION_TEACHER_TOKEN", "sekret"):
+            self.assertEqual(connection_role("sekret"), ROLE_TEACHER)
+            self.assertEqual(connection_role("guess"), ROLE_OBSERVER)
+            self.assertEqual(connection_role(None), ROLE_OBSERVER)
+
+
+
+class TestWebSocketEndpoint(unittest.TestCase):
+
+    def test_session_error_cleans_up_connection(self):
+        """取得会话失败时连接以 1011 关闭，订阅者计数复原。"""
+        from starlette.testclient import TestClient
+        from starlette.websockets import WebSocketDisconnect
+
+        from langgraph.checkpoint.memory import MemorySaver
+
+        from . import graph
+        from .components import COMPONENTS
+        from .llm_cache import ResponseCache
+        from .metrics import WS_SUBSCRIBERS
+        from .server import app_fastapi
+        from .store import MemorySessionStore
+
+        before = WS_SUBSCRIBERS._values.get((ROLE_TEACHER,), 0)
+        failing = AsyncMock(side_effect=RuntimeError("store unavailable"))
+        # 连接前会等待运行时加载（构建全部组件），落盘的组件换成进程内的
+        checkpointer = MemorySaver()
+        in_memory = COMPONENTS.override(
+            checkpointer=checkpointer,
+            app=graph.wf.compile(checkpointer=checkpointer),
+            response_cache=ResponseCache(path=None),
+            store=MemorySessionStore(),
+        )
+        with in_memory, patch.object(broadcast, "SESSION_TEACHER_TOKEN", ""), \
+                patch("backend.session.get_session", failing):
+            client = TestClient(app_fastapi)
+            with self.assertRaises(WebSocketDisconnect) as ctx:
+                with client.websocket_connect("/ws/pbl/broken") as ws:
+                    while True:
+                        ws.receive_json()
+        self.assertEqual(ctx.exception.code, 1011)
+        failing.assert_awaited_once_with("broken")
+        self.assertEqual(WS_SUBSCRIBERS._values.get((ROLE_TEACHER,), 0), before)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+"""PBL2.backend.test_budget
+对 budget.py 中的预算合并、用量累加与路由器的预算检查进行单元测试。
+"""
+import asyncio
+import unittest
+
+from langchain_core.messages import HumanMessage
+
+from . import agents
+from .budget import add_usage, exhausted, resolve_budget
+from .config import SESSION_BUDGET, SESSION_BUDGET_CEILING
+from .metrics import BUDGET_EXHAUSTED
+
+
+class TestBudget(unittest.TestCase):
+
+    def test_resolve_overrides_within_ceiling(self):
+        budget = resolve_budget({"max_turns": 5, "max_tokens": "很多", "max_seconds": 10 ** 9, "other": 1})
+        self.assertEqual(budget["max_turns"], 5)
+        self.assertEqual(budget["max_tokens"], SESSION_BUDGET["max_tokens"])  # 非法值被忽略
+        self.assertEqual(budget["max_seconds"], SESSION_BUDGET_CEILING["max_seconds"])
+        self.assertNotIn("other", budget)
+
+    def test_usage_and_exhaustion(self):
+        usage = add_usage(add_usage({}, {"turns": 1, "tokens": 100}), {"tokens": 50})
+        self.assertEqual(usage, {"turns": 1, "tokens": 150})
+        state = {"budget": {"max_turns": 2, "max_tokens": 1000, "max_seconds": 60}, "usage": usage, "started_at": 100.0}
+        self.assertIsNone(exhausted(state, now=120.0))
+        self.assertEqual(exhausted(state, now=200.0), "max_seconds")
+        state["usage"] = add_usage(usage, {"turns": 1})
+        self.assertEqual(exhausted(state, now=120.0), "max_turns")
+        self.assertIsNone(exhausted({"messages": []}))  # 旧检查点没有预算
+
+    def test_router_wraps_up_once(self):
+        """预算用完时路由到 final_summary；总结之后（如老师再次插话）直接结束。"""
+        state = {
+            "messages": [HumanMessage(content="胸痛", id="m0")],
+            "budget": {"max_turns": 1},
+            "usage": {"turns": 1, "tokens": 0},
+        }
+        before = BUDGET_EXHAUSTED._values.get(("max_turns",), 0)
+        update = asyncio.run(agents.router_node(state))
+        self.assertEqual(update, {"next_speaker": "final_summary", "budget_exhausted": "max_turns"})
+        self.assertEqual(BUDGET_EXHAUSTED._values[("max_turns",)], before + 1)
+        update = asyncio.run(agents.router_node({**state, **update}))
+        self.assertEqual(update, {"next_speaker": "END"})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+"""PBL2.backend.test_cassette
+对 cassette.py 中 LLM 调用的录制、回放（含节奏）与未命中进行单元测试，并经过整个图录制后回放一次讨论。
+"""
+import asyncio
+import itertools
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+import orjson
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langgraph.checkpoint.memory import MemorySaver
+
+from .cassette import MODE_RECORD, MODE_REPLAY, Cassette, CassetteMiss, load_cassette
+from .components import COMPONENTS
+from .llm_cache import cache_key
+from .store import MemorySessionStore
+
+
+def _prompt(text="54岁男性，突发胸痛 2 小时。"):
+    return [SystemMessage(content="你是一名医学生。"), HumanMessage(content=text, name="case_introduction")]
+
+
+class _SlowFakeChatModel(GenericFakeChatModel):
+    """每次回复前等待 delay 秒的假模型。"""
+
+    delay: float = 0.0
+
+    async def _astream(self, *args, **kwargs):
+        await asyncio.sleep(self.delay)
+        async for chunk in super()._astream(*args, **kwargs):
+            yield chunk
+
+
+async def _collect(stream):
+    return "".join([chunk.content async for chunk in stream])
+
+
+class TestCassette(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dir = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _record(self):
+        recorder = Cassette(MODE_RECORD, self.dir)
+        llm = GenericFakeChatModel(messages=iter([AIMessage(content="可能 是 急性 冠脉 综合征"), AIMessage(content="observer")]))
+        streamed = asyncio.run(_collect(recorder.astream(llm, _prompt(), "s/1", "student_analyst")))
+        routed = asyncio.run(recorder.agenerate(llm, _prompt("路由"), "s/1", "router"))
+        return llm, streamed, routed.content
+
+    def test_record_then_replay(self):
+        llm, streamed, routed = self._record()
+        records = load_cassette(os.path.join(self.dir, "s_1.jsonl"))
+        self.assertEqual([r["node"] for r in records], ["student_analyst", "router"])
+        self.assertEqual(records[0]["case"], "54岁男性，突发胸痛 2 小时。")
+        self.assertEqual("".join(text for _, text in records[0]["chunks"]), streamed)
+
+        replayer = Cassette(MODE_REPLAY, self.dir, realtime=False)
+        self.assertEqual(asyncio.run(_collect(replayer.astream(llm, _prompt(), "other", "student_analyst"))), streamed)
+        self.assertEqual(asyncio.run(replayer.agenerate(llm, _prompt("路由"), "other", "router")).content, routed)
+        # 同一请求的录制已用完；不同的 prompt 也没有录制
+        with self.assertRaises(CassetteMiss):
+            asyncio.run(replayer.agenerate(llm, _prompt("路由"), "other", "router"))
+        with self.assertRaises(CassetteMiss):
+            asyncio.run(_collect(replayer.astream(llm, _prompt("发热"), "other", "student_analyst")))
+        self.assertEqual(replayer.stats, {"recorded": 0, "replayed": 2, "misses": 2})
+
+    def test_replay_timing(self):
+        """original 节奏按录制的 token 到达时间输出，零延迟模式不等待；用量随最后一个 chunk 返回。"""
+        llm = GenericFakeChatModel(messages=iter([]))
+        record = {
+            "key": cache_key(llm, _prompt()), "node": "student_analyst", "kind": "stream", "elapsed": 0.2,
+            "chunks": [[100, "胸痛"], [150, "待查"]], "content": "胸痛待查", "response_metadata": {},
+            "usage": {"input_tokens": 10, "output_tokens": 2, "total_tokens": 12},
+        }
+        with open(os.path.join(self.dir, "s.jsonl"), "wb") as f:
+            f.write(orjson.dumps(record) + b"\n")
+
+        async def _replay(realtime):
+            started = time.perf_counter()
+            full = None
+            async for chunk in Cassette(MODE_REPLAY, self.dir, realtime=realtime).astream(llm, _prompt(), "s", None):
+                full = chunk if full is None else full + chunk
+            return time.perf_counter() - started, full
+
+        elapsed, full = asyncio.run(_replay(True))
+        self.assertGreaterEqual(elapsed, 0.2)
+        self.assertEqual(full.content, "胸痛待查")
+        self.assertEqual(full.usage_metadata["total_tokens"], 12)
+        elapsed, _ = asyncio.run(_replay(False))
+        self.assertLess(elapsed, 0.1)
+
+    def test_replay_discussion_through_graph(self):
+        """录制一次带摘要的讨论后零延迟回放：讨论记录、摘要与 token 用量与录制时一致。
+
+        录制时摘要比学生发言慢得多；若摘要在后台进行，回放时它的合并位置会提前，学生的 prompt 随之不同。
+        """
+        from . import graph
+        from .session import initial_state
+
+        def _models(student_replies, host_replies, summaries):
+            return {
+                "student_llm": GenericFakeChatModel(messages=iter(student_replies)),
+                "host_llm": GenericFakeChatModel(messages=iter(host_replies)),
+                "sum_llm": _SlowFakeChatModel(messages=iter(summaries), delay=0.05),
+            }
+
+        async def _run(cassette, models):
+            app = graph.wf.compile(checkpointer=MemorySaver())
+            config = {"configurable": {"thread_id": "graph-replay"}, "recursion_limit": 100}
+            with patch('backend.agents.SUMMARY_TRIGGER_MESSAGES', 3), COMPONENTS.override(
+                    cassette=cassette, store=MemorySessionStore(), **models):
+                result = await app.ainvoke(initial_state("54岁男性，突发胸痛 2 小时。", {"max_turns": 6}), config)
+            return [(m.name, m.content) for m in result["messages"]], result["summary"], result["usage"]
+
+        recorded = asyncio.run(_run(Cassette(MODE_RECORD, self.dir), _models(
+            [AIMessage(content=f"第 {i} 次 发言") for i in range(100)],
+            itertools.cycle([AIMessage(content="observer")]),
+            [AIMessage(content=f"摘要 {i}") for i in range(100)],
+        )))
+        self.assertTrue(recorded[1], "讨论中应发生过摘要")
+
+        replayer = Cassette(MODE_REPLAY, self.dir, realtime=False)
+        replayed = asyncio.run(_run(replayer, _models([], [], [])))
+        self.assertEqual(replayed, recorded)
+        self.assertEqual(replayer.stats["misses"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
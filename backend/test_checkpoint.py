@@ -0,0 +1,78 @@
+"""PBL2.backend.test_checkpoint
+对 checkpoint.py 中的 SQLite 检查点存储进行单元测试。
+"""
+import asyncio
+import operator
+import os
+import tempfile
+import unittest
+from typing import Annotated, List
+
+from typing_extensions import TypedDict
+from langgraph.graph import StateGraph, END
+
+from .checkpoint import SQLiteCheckpointSaver
+
+
+class _CounterState(TypedDict):
+    steps: Annotated[List[int], operator.add]
+
+
+def _build_graph(saver: SQLiteCheckpointSaver):
+    """一个三步的小图，每步追加一个数字。"""
+    wf = StateGraph(_CounterState)
+    wf.add_node("a", lambda state: {"steps": [1]})
+    wf.add_node("b", lambda state: {"steps": [2]})
+    wf.add_node("c", lambda state: {"steps": [3]})
+    wf.set_entry_point("a")
+    wf.add_edge("a", "b")
+    wf.add_edge("b", "c")
+    wf.add_edge("c", END)
+    return wf.compile(checkpointer=saver)
+
+
+class TestSQLiteCheckpointSaver(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "checkpoints.sqlite")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_state_survives_restart(self):
+        """检查点写入磁盘，重新打开后仍能读到最新状态。"""
+        saver = SQLiteCheckpointSaver(self.path, keep_latest=2)
+        config = {"configurable": {"thread_id": "s1"}}
+        asyncio.run(_build_graph(saver).ainvoke({"steps": []}, config))
+        saver.close()
+
+        reopened = SQLiteCheckpointSaver(self.path, keep_latest=2)
+        state = _build_graph(reopened).get_state(config)
+        self.assertEqual(state.values["steps"], [1, 2, 3])
+        reopened.close()
+
+    def test_keep_latest(self):
+        saver = SQLiteCheckpointSaver(self.path, keep_latest=2)
+        config = {"configurable": {"thread_id": "s1"}}
+        _build_graph(saver).invoke({"steps": []}, config)
+        self.assertEqual(len(list(saver.list(config))), 2)
+        saver.close()
+
+    def test_ttl_eviction(self):
+        evicted = []
+        saver = SQLiteCheckpointSaver(self.path, keep_latest=2, ttl_seconds=60, on_evict=evicted.append)
+        graph = _build_graph(saver)
+        graph.invoke({"steps": []}, {"configurable": {"thread_id": "old"}})
+        graph.invoke({"steps": []}, {"configurable": {"thread_id": "new"}})
+        saver._conn.execute("UPDATE checkpoints SET updated_at = updated_at - 120 WHERE thread_id='old'")
+
+        self.assertEqual(saver.compact(), 1)
+        self.assertEqual(evicted, ["old"])
+        self.assertIsNone(saver.get_tuple({"configurable": {"thread_id": "old"}}))
+        self.assertIsNotNone(saver.get_tuple({"configurable": {"thread_id": "new"}}))
+        saver.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+"""PBL2.backend.test_context
+对 context.py 中的消息窗口与上下文组装进行单元测试。
+"""
+import unittest
+from unittest.mock import patch
+
+from langchain_core.messages import HumanMessage, AIMessage, RemoveMessage, SystemMessage
+
+from . import context
+
+
+class TestWindowMessages(unittest.TestCase):
+
+    def test_remove_messages_really_clears(self):
+        """summarizer 返回的 RemoveMessage 应真正从窗口中删除消息。"""
+        history = context.window_messages([], [HumanMessage(content="病例"), AIMessage(content="发言")])
+        self.assertTrue(all(m.id for m in history), "reducer 应为每条消息分配 id")
+
+        history = context.window_messages(history, [RemoveMessage(id=history[0].id)])
+        self.assertEqual([m.content for m in history], ["发言"])
+
+        # 已经不存在的消息再次删除时不应报错
+        history = context.window_messages(history, [RemoveMessage(id="missing")])
+        self.assertEqual(len(history), 1)
+
+    def test_hard_cap(self):
+        with patch.object(context, "MAX_HISTORY_MESSAGES", 3):
+            history = []
+            for i in range(5):
+                history = context.window_messages(history, [AIMessage(content=str(i))])
+        self.assertEqual([m.content for m in history], ["2", "3", "4"])
+
+    def test_case_introduction_is_pinned(self):
+        """病例介绍不会被硬上限淘汰，也不会被摘要合并删除。"""
+        case = HumanMessage(content="54岁男性，突发胸痛", name="case_introduction")
+        with patch.object(context, "MAX_HISTORY_MESSAGES", 3):
+            history = context.window_messages([], [case])
+            for i in range(5):
+                history = context.window_messages(history, [AIMessage(content=str(i))])
+        self.assertEqual([m.content for m in history], ["54岁男性，突发胸痛", "3", "4"])
+
+        history = context.window_messages(history, [RemoveMessage(id=m.id) for m in history[:2]])
+        self.assertEqual([m.content for m in history], ["54岁男性，突发胸痛", "4"])
+
+
+class TestContextAssembly(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = context.window_messages(
+            [], [AIMessage(content="第%d条发言，" % i * 10) for i in range(6)]
+        )
+
+    def test_unsummarized(self):
+        watermark = self.messages[3].id
+        self.assertEqual(context.unsummarized(self.messages, watermark), self.messages[4:])
+        self.assertEqual(context.unsummarized(self.messages, ""), self.messages)
+
+    def test_fit_messages_keeps_newest_within_budget(self):
+        per_message = context.message_tokens(self.messages[0])
+        fitted = context.fit_messages(self.messages, per_message * 2)
+        self.assertEqual(fitted, self.messages[-2:])
+
+        # 预算不足时至少保留最后一条
+        self.assertEqual(context.fit_messages(self.messages, 0), self.messages[-1:])
+
+    def test_build_context_includes_summary(self):
+        ctx = context.build_context(self.messages, "既往讨论要点", budget=10_000)
+        self.assertIsInstance(ctx[0], SystemMessage)
+        self.assertIn("既往讨论要点", ctx[0].content)
+        self.assertEqual(ctx[1:], self.messages)
+
+    def test_build_context_keeps_case_introduction(self):
+        """预算只够近期消息时，病例介绍仍然排在最前面。"""
+        case = HumanMessage(content="54岁男性，突发胸痛", name="case_introduction")
+        messages = context.window_messages([], [case]) + self.messages
+        budget = context.message_tokens(case) + context.message_tokens(self.messages[-1])
+        ctx = context.build_context(messages, "", budget=budget)
+        self.assertEqual(ctx, [messages[0], self.messages[-1]])
+
+        ctx = context.build_context(messages, "既往讨论要点", budget=10_000)
+        self.assertEqual(ctx[0], messages[0])
+        self.assertIn("既往讨论要点", ctx[1].content)
+        self.assertEqual(ctx[2:], self.messages)
+
+    def test_truncate_text(self):
+        text = "胸痛" * 200
+        truncated = context.truncate_text(text, 50)
+        self.assertLessEqual(context.count_tokens(truncated), 50)
+        self.assertTrue(text.startswith(truncated))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+"""PBL2.backend.test_event_log
+对 event_log.py 中的序号分配、delta 压缩与缺口检测进行单元测试。
+"""
+import unittest
+
+from .event_log import EventLog
+
+
+class TestEventLog(unittest.TestCase):
+
+    def test_sequence_and_replay(self):
+        log = EventLog()
+        for i in range(3):
+            frame = log.append({"type": "message_complete", "message_id": f"m{i}", "content": str(i)})
+        self.assertEqual(frame["seq"], 3)
+        self.assertEqual([f["seq"] for f in log.since(1)], [2, 3])
+        self.assertEqual(log.since(3), [])
+
+    def test_deltas_compacted_on_complete(self):
+        """消息完成后其 delta 被压缩，从中途的序号补发时直接拿到完整内容。"""
+        log = EventLog()
+        log.append({"type": "delta", "message_id": "m1", "delta": "胸"})
+        log.append({"type": "delta", "message_id": "m1", "delta": "痛"})
+        log.append({"type": "delta", "message_id": "m2", "delta": "心"})
+        log.append({"type": "message_complete", "message_id": "m1", "content": "胸痛"})
+        replay = log.since(1)
+        self.assertEqual([(f["type"], f["message_id"]) for f in replay], [("delta", "m2"), ("message_complete", "m1")])
+
+    def test_gap_detection(self):
+        log = EventLog(max_events=2)
+        for i in range(4):
+            log.append({"type": "message_complete", "message_id": f"m{i}"})
+        self.assertIsNone(log.since(1))  # 序号 2 已被淘汰
+        self.assertEqual([f["seq"] for f in log.since(2)], [3, 4])
+        self.assertIsNone(log.since(10))  # 来自之前进程的序号
+        log.reset()
+        self.assertIsNone(log.since(3))
+        self.assertEqual(log.append({"type": "discussion_started"})["seq"], 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
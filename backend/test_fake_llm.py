@@ -0,0 +1,55 @@
+"""PBL2.backend.test_fake_llm
+验证 fake_llm.py 的假模型服务能被 ChatOpenAI 直接调用（流式与非流式），并能注入错误。
+"""
+import asyncio
+import unittest
+
+import httpx
+import openai
+from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_openai import ChatOpenAI
+
+from .fake_llm import FakeLLMSettings, create_app
+
+
+def _llm(settings: FakeLLMSettings) -> ChatOpenAI:
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=create_app(settings)))
+    return ChatOpenAI(
+        model="fake",
+        api_key="fake",
+        base_url="http://fake/v1",
+        http_async_client=client,
+        max_retries=0,
+        stream_usage=True,
+    )
+
+
+class TestFakeLLM(unittest.TestCase):
+
+    def test_stream_and_generate(self):
+        llm = _llm(FakeLLMSettings(latency=0, tokens_per_sec=0))
+        prompt = [SystemMessage(content="请选择下一位发言人"), HumanMessage(content="胸痛")]
+
+        async def _main():
+            chunks = [c async for c in llm.astream([HumanMessage(content="胸痛")])]
+            routed = await llm.agenerate([prompt])
+            return chunks, routed.generations[0][0].message
+
+        chunks, routed = asyncio.run(_main())
+        full = chunks[0]
+        for c in chunks[1:]:
+            full = full + c
+        self.assertGreater(len(chunks), 2)
+        self.assertIn("急性", full.content)
+        self.assertGreater(full.usage_metadata["output_tokens"], 0)
+        self.assertIn(routed.content, {"analyst", "observer", "skeptic"})
+
+    def test_error_injection(self):
+        llm = _llm(FakeLLMSettings(latency=0, error_rate=1.0))
+        with self.assertRaises(openai.APIStatusError) as ctx:
+            asyncio.run(llm.agenerate([[HumanMessage(content="胸痛")]]))
+        self.assertIn(ctx.exception.status_code, (429, 503))
+
+
+if __name__ == '__main__':
+    unittest.main()
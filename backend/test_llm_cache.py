@@ -0,0 +1,72 @@
+"""PBL2.backend.test_llm_cache
+对 llm_cache.py 中的缓存键、两级缓存与淘汰进行单元测试。
+"""
+import asyncio
+import os
+import tempfile
+import unittest
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_openai import ChatOpenAI
+
+from .llm_cache import ResponseCache, cache_key
+
+
+def _llm(temperature):
+    return ChatOpenAI(model="qwen-plus", api_key="test", temperature=temperature)
+
+
+class TestLLMCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "cache.sqlite")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_key_ignores_message_ids(self):
+        """消息 id 每次运行都不同，不应影响缓存键；温度与参数绑定则应影响。"""
+        prompt_a = [SystemMessage(content="sys", id="a"), HumanMessage(content="病例", id="b")]
+        prompt_b = [SystemMessage(content="sys", id="c"), HumanMessage(content="病例", id="d")]
+        llm = _llm(0.3)
+        self.assertEqual(cache_key(llm, prompt_a), cache_key(llm, prompt_b))
+        self.assertNotEqual(cache_key(llm, prompt_a), cache_key(_llm(0.8), prompt_a))
+        self.assertNotEqual(cache_key(llm, prompt_a), cache_key(llm.bind(max_tokens=10), prompt_a))
+
+    def test_memory_and_disk_tiers(self):
+        """内存层被挤出后仍可从磁盘层命中，且重启后磁盘层依然有效。"""
+        async def _main():
+            cache = ResponseCache(max_entries=1, path=self.path)
+            await cache.aput("k1", AIMessage(content="第一条"))
+            await cache.aput("k2", AIMessage(content="第二条"))
+            self.assertIsNone(await cache.aget("missing"))
+            hit = await cache.aget("k1")
+            self.assertEqual(hit.content, "第一条")
+            self.assertTrue(hit.response_metadata["cache_hit"])
+            return cache.snapshot()
+
+        stats = asyncio.run(_main())
+        self.assertEqual(stats["disk_hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+
+        reopened = ResponseCache(max_entries=1, path=self.path)
+        self.assertEqual(asyncio.run(reopened.aget("k2")).content, "第二条")
+
+    def test_disk_eviction_by_size(self):
+        async def _main():
+            cache = ResponseCache(max_entries=1, path=self.path, max_bytes=400)
+            for i in range(10):
+                await cache.aput(f"k{i}", AIMessage(content="x" * 50))
+            return cache
+
+        cache = asyncio.run(_main())
+        snapshot = cache.snapshot()
+        self.assertLessEqual(snapshot["disk_bytes"], 400)
+        self.assertGreater(snapshot["evictions"], 0)
+        # 最近写入的条目保留
+        self.assertIsNotNone(asyncio.run(cache.aget("k9")))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+"""PBL2.backend.test_llm_gateway
+对 llm_gateway.py 中的并发控制、重试与背压进行单元测试。
+"""
+import asyncio
+import unittest
+
+import httpx
+
+from .llm_gateway import LLMGateway
+from .priority import Priority, PriorityLimiter
+
+
+class TestLLMGateway(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_async_test(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_retries_transient_errors(self):
+        """网络错误应被重试，最终返回成功结果。"""
+        gateway = LLMGateway(max_retries=2)
+        attempts = []
+
+        async def _flaky():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise httpx.ConnectError("connection reset")
+            return "ok"
+
+        self.assertEqual(self.run_async_test(gateway.run(_flaky)), "ok")
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(gateway.stats["retries"], 1)
+
+    def test_non_retryable_error_is_raised(self):
+        gateway = LLMGateway(max_retries=2)
+
+        async def _bad():
+            raise ValueError("bad request")
+
+        with self.assertRaises(ValueError):
+            self.run_async_test(gateway.run(_bad))
+        self.assertEqual(gateway.stats["failures"], 1)
+
+    def test_limits_and_backpressure(self):
+        """全局并发上限生效，排队达到阈值时通知对应会话。"""
+        gateway = LLMGateway(max_in_flight=1, max_queue=1)
+        frames = []
+        peak = []
+
+        async def _listener(frame):
+            frames.append(frame)
+
+        gateway.add_listener("s2", _listener)
+
+        async def _call():
+            peak.append(gateway.in_flight)
+            await asyncio.sleep(0.01)
+            return gateway.in_flight
+
+        async def _main():
+            return await asyncio.gather(
+                gateway.run(_call, session_id="s1"),
+                gateway.run(_call, session_id="s2"),
+            )
+
+        self.run_async_test(_main())
+        self.assertEqual(max(peak), 1)
+        self.assertEqual([f["state"] for f in frames], ["queued", "resumed"])
+        self.assertEqual(gateway.snapshot()["in_flight"], 0)
+
+    def test_rate_limited_request_holds_no_slot(self):
+        """被限流的请求在等待令牌时不占用全局槽位。"""
+        gateway = LLMGateway(max_in_flight=1, tokens_per_minute=6000)
+
+        async def _call():
+            return "ok"
+
+        async def _main():
+            await gateway.run(_call, est_tokens=6000)  # 用完令牌桶
+            throttled = asyncio.ensure_future(gateway.run(_call, est_tokens=50))
+            await asyncio.sleep(0.02)
+            locked = gateway._global.locked()
+            result = await throttled
+            return locked, result
+
+        locked, result = self.run_async_test(_main())
+        self.assertFalse(locked)
+        self.assertEqual(result, "ok")
+
+
+class TestPriorityLimiter(unittest.TestCase):
+
+    def test_higher_priority_admitted_first(self):
+        """槽位紧张时，老师回应先于排在前面的摘要与学生请求。"""
+        order = []
+
+        async def _worker(limiter, priority):
+            await limiter.acquire(priority)
+            order.append(priority)
+            await asyncio.sleep(0)
+            limiter.release()
+
+        async def _main():
+            limiter = PriorityLimiter(1, aging_seconds=60)
+            await limiter.acquire(Priority.STUDENT)  # 占住唯一的槽位
+            tasks = [
+                asyncio.ensure_future(_worker(limiter, p))
+                for p in (Priority.SUMMARY, Priority.STUDENT, Priority.TEACHER, Priority.ROUTING)
+            ]
+            await asyncio.sleep(0)
+            limiter.release()
+            await asyncio.gather(*tasks)
+            return limiter.stats()
+
+        stats = asyncio.run(_main())
+        self.assertEqual(order, [Priority.TEACHER, Priority.ROUTING, Priority.STUDENT, Priority.SUMMARY])
+        self.assertEqual(stats["teacher"]["admitted"], 1)
+        self.assertEqual(stats["summary"]["queued"], 0)
+
+    def test_aging_prevents_starvation(self):
+        """等待足够久的摘要请求应先于新到的学生请求。"""
+        order = []
+
+        async def _main():
+            limiter = PriorityLimiter(1, aging_seconds=0.01)
+            await limiter.acquire(Priority.STUDENT)
+
+            async def _worker(priority):
+                await limiter.acquire(priority)
+                order.append(priority)
+                limiter.release()
+
+            summary = asyncio.ensure_future(_worker(Priority.SUMMARY))
+            await asyncio.sleep(0.05)
+            student = asyncio.ensure_future(_worker(Priority.STUDENT))
+            await asyncio.sleep(0)
+            limiter.release()
+            await asyncio.gather(summary, student)
+
+        asyncio.run(_main())
+        self.assertEqual(order, [Priority.SUMMARY, Priority.STUDENT])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+"""PBL2.backend.test_metrics
+对 metrics.py 中的指标导出格式、节点计时与轨迹记录进行单元测试。
+"""
+import asyncio
+import unittest
+
+from .metrics import Registry, TraceLog, NODE_DURATION, NODE_ERRORS, timed_node
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_prometheus_text_format(self):
+        registry = Registry()
+        hist = registry.histogram("t_seconds", "Test histogram.", ["node"], buckets=(0.1, 1.0))
+        counter = registry.counter("t_total", "Test counter.", ["kind"])
+        registry.gauge("t_gauge", "Test gauge.", callback=lambda: 3)
+        hist.observe(0.05, "router")
+        hist.observe(0.5, "router")
+        counter.inc("prompt", amount=10)
+
+        text = registry.render()
+        self.assertIn("# TYPE t_seconds histogram", text)
+        self.assertIn('t_seconds_bucket{node="router",le="0.1"} 1', text)
+        self.assertIn('t_seconds_bucket{node="router",le="+Inf"} 2', text)
+        self.assertIn('t_seconds_count{node="router"} 2', text)
+        self.assertIn('t_total{kind="prompt"} 10', text)
+        self.assertIn("t_gauge 3", text)
+
+    def test_timed_node_records_duration_and_errors(self):
+        async def _ok(state, config=None):
+            return {"next_speaker": "router"}
+
+        async def _bad(state, config=None):
+            raise ValueError("boom")
+
+        ok = timed_node("test_ok", _ok)
+        bad = timed_node("test_bad", _bad)
+        self.assertEqual(asyncio.run(ok({})), {"next_speaker": "router"})
+        with self.assertRaises(ValueError):
+            asyncio.run(bad({}))
+        self.assertIn(("test_ok",), NODE_DURATION._values)
+        self.assertEqual(NODE_ERRORS._values[("test_bad",)], 1)
+
+    def test_trace_log_is_bounded(self):
+        traces = TraceLog(max_spans=2, max_sessions=1)
+        for i in range(3):
+            traces.add("s1", {"i": i})
+        traces.add("s2", {"i": 0})
+        self.assertEqual(traces.dump("s1"), [])  # 被较新的会话淘汰
+        self.assertEqual(traces.dump("s2"), [{"i": 0}])
+
+
+if __name__ == '__main__':
+    unittest.main()
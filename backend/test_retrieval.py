@@ -0,0 +1,89 @@
+"""PBL2.backend.test_retrieval
+对 retrieval.py 中的切块、BM25 排序、token 预算与索引持久化进行单元测试。
+"""
+import os
+import random
+import tempfile
+import time
+import unittest
+
+from .retrieval import RetrievalIndex, analyze, build_index, iter_documents, split_documents
+
+GUIDELINES = {
+    "acs.md": (
+        "# 急性冠脉综合征\n\n"
+        "胸痛患者应在 10 分钟内完成心电图检查。高敏肌钙蛋白升高提示心肌损伤，需结合动态变化判断。\n\n"
+        "ST 段抬高型心肌梗死应尽早再灌注治疗，首选直接 PCI。"
+    ),
+    "pe.md": "# 肺栓塞\n\n突发呼吸困难伴胸痛时应评估肺栓塞，D-二聚体阴性可帮助排除低危患者。",
+    "dm.txt": "糖尿病患者应定期监测糖化血红蛋白，目标一般低于 7%。",
+}
+
+
+class TestRetrieval(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.docs = os.path.join(self.tmpdir.name, "docs")
+        self.index_dir = os.path.join(self.tmpdir.name, "index")
+        os.makedirs(self.docs)
+        for name, text in GUIDELINES.items():
+            with open(os.path.join(self.docs, name), "w", encoding="utf-8") as f:
+                f.write(text)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _build(self, chunk_size=60):
+        chunks = split_documents(iter_documents(self.docs), chunk_size=chunk_size, chunk_overlap=0)
+        build_index(chunks, self.index_dir)
+        return chunks, RetrievalIndex(self.index_dir)
+
+    def test_analyze_mixes_cjk_bigrams_and_words(self):
+        self.assertEqual(analyze("胸痛加重 PCI 术后"), ["胸痛", "痛加", "加重", "pci", "术后"])
+        self.assertEqual(analyze("痛 7.5"), ["痛", "7.5"])
+
+    def test_ranking_and_persistence(self):
+        chunks, index = self._build()
+        self.assertGreater(len(chunks), len(GUIDELINES))
+        hits = index.search("肌钙蛋白升高", k=2)
+        self.assertEqual(hits[0].source, "acs.md")
+        self.assertIn("肌钙蛋白", hits[0].text)
+        self.assertTrue(all(a.score >= b.score for a, b in zip(hits, hits[1:])))
+        self.assertEqual(index.search("D-二聚体", k=1)[0].source, "pe.md")
+        self.assertEqual(index.search("骨折 qwerty"), [])
+        # 重新打开索引得到相同的结果
+        self.assertEqual([h.chunk_id for h in RetrievalIndex(self.index_dir).search("肌钙蛋白升高", k=2)],
+                         [h.chunk_id for h in hits])
+
+    def test_token_budget(self):
+        _, index = self._build()
+        hits = index.search("胸痛", k=4)
+        self.assertGreater(len(hits), 1)
+        budget = hits[0].tokens
+        selected = index.retrieve("胸痛", k=4, token_budget=budget)
+        self.assertLessEqual(sum(h.tokens for h in selected), budget)
+        self.assertEqual(selected[0].chunk_id, hits[0].chunk_id)
+        self.assertEqual(index.retrieve("胸痛", k=4, token_budget=0), [])
+
+    def test_lookup_latency(self):
+        """数千个块（每个块都包含大部分查询词）的索引上，单次查询应远低于 10 ms。"""
+        rng = random.Random(0)
+        vocab = "胸痛心电图肌钙蛋白呼吸困难咳嗽发热血压血糖肝肾功能影像学检查治疗诊断评估随访"
+        chunks = [
+            ("synthetic.md", "".join(rng.choice(vocab) for _ in range(120)))
+            for _ in range(5000)
+        ]
+        build_index(chunks, self.index_dir)
+        index = RetrievalIndex(self.index_dir)
+        index.retrieve("胸痛伴肌钙蛋白升高，下一步检查")
+        timings = []
+        for _ in range(20):
+            started = time.perf_counter()
+            index.retrieve("胸痛伴肌钙蛋白升高，下一步检查")
+            timings.append(time.perf_counter() - started)
+        self.assertLess(sorted(timings)[len(timings) // 2], 0.01)
+
+
+if __name__ == '__main__':
+    unittest.main()
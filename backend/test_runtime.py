@@ -0,0 +1,71 @@
+"""PBL2.backend.test_runtime
+对 runtime.py 的按需加载与 server 的存活 / 就绪检查进行单元测试。
+"""
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+from fastapi.testclient import TestClient
+
+
+class TestRuntime(unittest.TestCase):
+
+    def test_server_import_is_light(self):
+        """导入 server 不加载 langchain / langgraph / openai，也不构建模型客户端与图。"""
+        code = (
+            "import sys, backend.server\n"
+            "heavy = [m for m in ('langgraph', 'langchain_core', 'langchain_openai', 'openai', 'backend.agents')"
+            " if m in sys.modules]\n"
+            "print(heavy)\n"
+        )
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        out = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True)
+        self.assertEqual(out.stdout.strip(), "[]")
+
+    def test_module_import_builds_nothing(self):
+        """导入 agents / graph / session 不创建模型客户端、网关、存储与图，它们由 COMPONENTS.init() 构建。"""
+        code = (
+            "import backend.agents, backend.graph, backend.session\n"
+            "from backend.components import COMPONENTS\n"
+            "print([name for name in COMPONENTS.NAMES if COMPONENTS.built(name)])\n"
+        )
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        out = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True)
+        self.assertEqual(out.stdout.strip(), "[]")
+
+    def test_liveness_and_readiness(self):
+        from langgraph.checkpoint.memory import MemorySaver
+
+        from . import graph
+        from .components import COMPONENTS
+        from .llm_cache import ResponseCache
+        from .runtime import RUNTIME
+        from .server import app_fastapi
+        from .store import MemorySessionStore
+
+        # lifespan 会构建全部组件：落盘的检查点、响应缓存与会话存储换成进程内的，测试不写 backend/data
+        checkpointer = MemorySaver()
+        in_memory = COMPONENTS.override(
+            checkpointer=checkpointer,
+            app=graph.wf.compile(checkpointer=checkpointer),
+            response_cache=ResponseCache(path=None),
+            store=MemorySessionStore(),
+        )
+        with in_memory, TestClient(app_fastapi) as client:
+            self.assertEqual(client.get("/healthz").status_code, 200)
+            deadline = time.monotonic() + 60
+            while client.get("/readyz").status_code != 200:
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.05)
+            report = client.get("/readyz").json()
+            self.assertEqual(report["status"], "ready")
+            for phase in ("import_modules", "build_components", "compile_graph", "time_to_ready"):
+                self.assertIn(phase, report["timings"])
+            self.assertTrue(RUNTIME.loaded)
+            self.assertIn("pbl_runtime_ready 1", client.get("/metrics").text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+"""PBL2.backend.test_scheduler
+对 scheduler.py 中的本地发言调度器进行单元测试。
+"""
+import unittest
+
+from langchain_core.messages import HumanMessage, AIMessage
+
+from .scheduler import TurnScheduler
+
+
+def _student(agent_id: str, content: str) -> AIMessage:
+    return AIMessage(content=content, name=agent_id)
+
+
+class TestTurnScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.case = HumanMessage(content="54岁男性，突发胸痛 2 小时。", name="case_introduction")
+
+    def test_boundary_falls_back_to_llm(self):
+        """最后一条不是学生发言时（阶段边界），应交给 LLM。"""
+        scheduler = TurnScheduler(policy="round_robin")
+        self.assertIsNone(scheduler.decide([self.case]))
+        self.assertEqual(scheduler.stats()["llm_boundary"], 1)
+
+    def test_round_robin(self):
+        scheduler = TurnScheduler(policy="round_robin")
+        messages = [self.case, _student("student_observer", "心率偏快。")]
+        self.assertEqual(scheduler.decide(messages), "skeptic")
+
+    def test_least_recent(self):
+        scheduler = TurnScheduler(policy="least_recent")
+        messages = [
+            self.case,
+            _student("student_analyst", "考虑急性冠脉综合征。"),
+            _student("student_skeptic", "证据不足。"),
+        ]
+        self.assertEqual(scheduler.decide(messages), "observer")
+
+    def test_heuristic_confident_and_unconfident(self):
+        scheduler = TurnScheduler(policy="heuristic", min_confidence=0.3)
+        confident = [self.case, _student("student_analyst", "建议先做心电图检查，再看化验指标和生命体征。")]
+        self.assertEqual(scheduler.decide(confident), "observer")
+
+        # 没有任何关键词时不自信，回退到 LLM
+        unconfident = [self.case, _student("student_analyst", "好的。")]
+        self.assertIsNone(scheduler.decide(unconfident))
+
+        stats = scheduler.stats()
+        self.assertEqual(stats["local"], 1)
+        self.assertEqual(stats["llm_low_confidence"], 1)
+        self.assertEqual(stats["local_ratio"], 0.5)
+
+    def test_periodic_llm_check(self):
+        """连续 llm_every 名学生发言后，应询问一次 LLM 以便结束讨论。"""
+        scheduler = TurnScheduler(policy="round_robin", llm_every=2)
+        messages = [
+            self.case,
+            _student("student_analyst", "考虑心肌梗死。"),
+            _student("student_observer", "需要检查心电图。"),
+        ]
+        self.assertIsNone(scheduler.decide(messages))
+        self.assertEqual(scheduler.stats()["llm_periodic"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
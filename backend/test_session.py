@@ -0,0 +1,285 @@
+"""PBL2.backend.test_session
+对 session.py 中图输出到前端帧的转换（stream_graph）、老师插话时对生成的抢占与会话的接管进行单元测试。
+"""
+import asyncio
+import itertools
+import operator
+import time
+import unittest
+from typing import Annotated, Dict, List
+
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, message_chunk_to_message
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.graph import END, StateGraph
+from typing_extensions import TypedDict
+
+from . import graph
+from .budget import add_usage
+from .components import COMPONENTS
+from .llm_cache import ResponseCache
+from . import session as session_module
+from .metrics import ACTIVE_SESSIONS
+from .session import DiscussionSession, get_session, initial_state, stream_graph
+from .store import MemorySessionStore
+
+
+class _State(TypedDict):
+    messages: Annotated[List[BaseMessage], operator.add]
+    summary: str
+    budget: Dict
+    usage: Annotated[Dict[str, int], add_usage]
+
+
+async def _stream(llm, prompt) -> AIMessage:
+    full = None
+    async for chunk in llm.astream(prompt):
+        full = chunk if full is None else full + chunk
+    return message_chunk_to_message(full)
+
+
+def _small_graph():
+    """router（内部决策，不推送）-> student_analyst（返回消息）-> summarizer（只返回摘要）。"""
+    router_llm = GenericFakeChatModel(messages=iter([AIMessage(content="analyst")]))
+    student_llm = GenericFakeChatModel(messages=iter([AIMessage(content="胸痛 待查")]))
+    summary_llm = GenericFakeChatModel(messages=iter([AIMessage(content="考虑 心梗")]))
+
+    async def router(state):
+        await _stream(router_llm, state["messages"])
+        return {}
+
+    async def student_analyst(state):
+        return {"messages": [await _stream(student_llm, state["messages"])], "usage": {"turns": 1}}
+
+    async def summarizer(state):
+        return {"summary": (await _stream(summary_llm, state["messages"])).content}
+
+    wf = StateGraph(_State)
+    wf.add_node("router", router)
+    wf.add_node("student_analyst", student_analyst)
+    wf.add_node("summarizer", summarizer)
+    wf.set_entry_point("router")
+    wf.add_edge("router", "student_analyst")
+    wf.add_edge("student_analyst", "summarizer")
+    wf.add_edge("summarizer", END)
+    return wf.compile(checkpointer=MemorySaver())
+
+
+def _run(stream_tokens: bool) -> List[Dict]:
+    frames = []
+
+    async def _send(frame):
+        frames.append(frame)
+
+    state = {
+        "messages": [HumanMessage(content="54岁男性，突发胸痛 2 小时。", name="case_introduction")],
+        "summary": "",
+        "budget": {"max_turns": 4},
+        "usage": {"turns": 0, "tokens": 0},
+    }
+    config = {"configurable": {"thread_id": "stream-graph"}}
+    with COMPONENTS.override(app=_small_graph()):
+        asyncio.run(stream_graph(_send, state, config, stream_tokens))
+    return frames
+
+
+def _shape(frame: Dict):
+    if frame["type"] == "budget":
+        return ("budget", frame["turns"])
+    if frame["type"] == "delta":
+        return ("delta", frame["node"], frame["delta"])
+    return (frame["type"], frame["node"], frame["content"])
+
+
+class TestStreamGraph(unittest.TestCase):
+
+    def test_frame_sequence(self):
+        """delta 在前、完成帧在后且 message_id 一致；summarizer 没有返回消息，由已推送的文本补发完成帧。"""
+        frames = _run(stream_tokens=True)
+        self.assertEqual([_shape(f) for f in frames], [
+            ("budget", 0),
+            ("delta", "student_analyst", "胸痛"),
+            ("delta", "student_analyst", " "),
+            ("delta", "student_analyst", "待查"),
+            ("message_complete", "student_analyst", "胸痛 待查"),
+            ("budget", 1),
+            ("delta", "summarizer", "考虑"),
+            ("delta", "summarizer", " "),
+            ("delta", "summarizer", "心梗"),
+            ("message_complete", "summarizer", "考虑 心梗"),
+        ])
+        analyst_ids = {f["message_id"] for f in frames if f.get("node") == "student_analyst"}
+        summary_ids = {f["message_id"] for f in frames if f.get("node") == "summarizer"}
+        self.assertEqual(len(analyst_ids), 1)
+        self.assertEqual(len(summary_ids), 1)
+        self.assertNotEqual(analyst_ids, summary_ids)
+        self.assertIsNotNone(next(iter(analyst_ids)))
+
+    def test_without_token_streaming(self):
+        """关闭增量推送时只有返回消息的完成帧与预算帧。"""
+        frames = _run(stream_tokens=False)
+        self.assertEqual([_shape(f) for f in frames], [
+            ("budget", 0),
+            ("message_complete", "student_analyst", "胸痛 待查"),
+            ("budget", 1),
+        ])
+
+
+class _PacedFakeChatModel(GenericFakeChatModel):
+    """每个 token 之间等待 delay 秒的假模型，便于在生成中途插话。"""
+
+    delay: float = 0.0
+
+    async def _astream(self, *args, **kwargs):
+        async for chunk in super()._astream(*args, **kwargs):
+            await asyncio.sleep(self.delay)
+            yield chunk
+
+
+def _discussion_components():
+    """讨论用的假模型与进程内存储（不读写 backend/data），学生发言较慢，主持人总是选 observer。"""
+    checkpointer = MemorySaver()
+    return {
+        "checkpointer": checkpointer,
+        "app": graph.wf.compile(checkpointer=checkpointer),
+        "store": MemorySessionStore(),
+        "response_cache": ResponseCache(path=None),
+        "student_llm": _PacedFakeChatModel(
+            messages=itertools.cycle([AIMessage(content="我 认为 可能 是 急性 冠脉 综合征 需要 心电图")]), delay=0.02,
+        ),
+        "host_llm": GenericFakeChatModel(messages=itertools.cycle([AIMessage(content="observer")])),
+        "sum_llm": GenericFakeChatModel(messages=itertools.cycle([AIMessage(content="摘要")])),
+    }
+
+
+async def _wait_for(frames: List[Dict], predicate, timeout: float = 5.0) -> Dict:
+    deadline = time.monotonic() + timeout
+    while True:
+        for frame in frames:
+            if predicate(frame):
+                return frame
+        if time.monotonic() > deadline:
+            raise AssertionError(f"frame not received; got {[f.get('type') for f in frames]}")
+        await asyncio.sleep(0.01)
+
+
+def _is_student_delta(frame: Dict) -> bool:
+    return frame["type"] == "delta" and frame["node"].startswith("student_")
+
+
+def _is_teacher_reply(frame: Dict) -> bool:
+    return frame["type"] == "message_complete" and frame["node"] == "teacher_handler"
+
+
+class TestIntervention(unittest.TestCase):
+
+    def _assert_preempted(self, frames: List[Dict], cancelled_id: str) -> None:
+        """被打断的消息先收到 message_cancelled，然后是老师的消息，之后才出现 teacher_handler 的输出；被打断的消息从未完成。"""
+        types = [(f["type"], f.get("message_id")) for f in frames]
+        cancelled_at = types.index(("message_cancelled", cancelled_id))
+        last_delta = max(i for i, f in enumerate(frames) if f.get("message_id") == cancelled_id and f["type"] == "delta")
+        teacher_at = next(i for i, f in enumerate(frames) if f.get("node") == "teacher")
+        first_reply = next(i for i, f in enumerate(frames) if f.get("node") == "teacher_handler")
+        self.assertLess(last_delta, cancelled_at)
+        self.assertLess(cancelled_at, teacher_at)
+        self.assertLess(teacher_at, first_reply)
+        self.assertEqual(frames[teacher_at]["type"], "message_complete")
+        self.assertEqual(frames[teacher_at]["content"], "先看心电图。")
+        self.assertNotIn(("message_complete", cancelled_id), types)
+
+    def test_intervene_preempts_generation(self):
+        """插话取消进行中的学生发言：推送 message_cancelled，半条消息不进入检查点，图从 teacher_handler 继续。"""
+        async def _main():
+            session = DiscussionSession("preempt")
+            frames: List[Dict] = []
+            # 每次启动生成时检查点中待执行的节点
+            launched = []
+            launch = session._launch
+
+            def _launch(graph_input):
+                launched.append(COMPONENTS.app.get_state(session.config).next)
+                launch(graph_input)
+
+            session._launch = _launch
+            await session.open()
+            await session.attach(frames.append)
+            try:
+                await session.start(initial_state("54岁男性，突发胸痛 2 小时。", {"max_turns": 10}))
+                partial = await _wait_for(frames, _is_student_delta)
+                await session.intervene("先看心电图。")
+                await _wait_for(frames, _is_teacher_reply)
+                values = (await COMPONENTS.app.aget_state(session.config)).values
+            finally:
+                await session.close()
+            return frames, partial["message_id"], launched[-1], values["messages"]
+
+        with COMPONENTS.override(**_discussion_components()):
+            frames, cancelled_id, next_nodes, messages = asyncio.run(_main())
+
+        self._assert_preempted(frames, cancelled_id)
+        self.assertEqual(next_nodes, ("teacher_handler",))
+        self.assertNotIn(cancelled_id, [m.id for m in messages])
+        teacher_at = next(i for i, m in enumerate(messages) if m.name == "teacher")
+        self.assertEqual(messages[teacher_at].content, "先看心电图。")
+        # 推送的老师消息与检查点（快照）中的是同一条
+        self.assertEqual(next(f for f in frames if f.get("node") == "teacher")["message_id"], messages[teacher_at].id)
+        self.assertEqual(messages[teacher_at + 1].type, "ai")
+        self.assertIsNone(messages[teacher_at + 1].name)  # teacher_handler 的回复
+
+    def test_websocket_receives_while_generating(self):
+        """WebSocket 的接收循环不等待生成结束：讨论进行中发来的插话立即抢占生成。"""
+        from fastapi.testclient import TestClient
+
+        from .server import app_fastapi
+
+        with COMPONENTS.override(**_discussion_components()), TestClient(app_fastapi) as client:
+            with client.websocket_connect("/ws/pbl/preempt-ws") as ws:
+                frames = [ws.receive_json()]  # connected
+                ws.send_json({"action": "start_discussion", "initial_case": "54岁男性，突发胸痛 2 小时。"})
+                while not _is_student_delta(frames[-1]):
+                    frames.append(ws.receive_json())
+                ws.send_json({"action": "teacher_intervention", "content": "先看心电图。"})
+                while not _is_teacher_reply(frames[-1]):
+                    frames.append(ws.receive_json())
+
+        self._assert_preempted(frames, next(f for f in frames if _is_student_delta(f))["message_id"])
+
+
+class _BrokenCheckpointer(MemorySaver):
+    """读取检查点时失败的存储，模拟接管会话时检查点存储不可用。"""
+
+    async def aget_tuple(self, config):
+        raise RuntimeError("checkpoint store unavailable")
+
+
+class TestGetSession(unittest.TestCase):
+
+    def test_failed_open_is_not_registered(self):
+        """open() 失败时会话不留在注册表中，租约、网关监听与活跃会话计数都被复原，下一次调用重新接管。"""
+        store = MemorySessionStore()
+        before = ACTIVE_SESSIONS._values.get((), 0)
+
+        async def _main():
+            broken = _BrokenCheckpointer()
+            with COMPONENTS.override(store=store, checkpointer=broken, app=graph.wf.compile(checkpointer=broken)):
+                with self.assertRaises(RuntimeError):
+                    await get_session("broken-open")
+            self.assertNotIn("broken-open", session_module._SESSIONS)
+            self.assertIsNone(store.lease_owner("broken-open"))
+            self.assertNotIn("broken-open", COMPONENTS.gateway._listeners)
+            self.assertEqual(ACTIVE_SESSIONS._values.get((), 0), before)
+
+            checkpointer = MemorySaver()
+            with COMPONENTS.override(store=store, checkpointer=checkpointer, app=graph.wf.compile(checkpointer=checkpointer)):
+                session = await get_session("broken-open")
+                try:
+                    self.assertIs(await get_session("broken-open"), session)
+                    self.assertEqual(store.lease_owner("broken-open"), session_module.WORKER_ID)
+                finally:
+                    await session.close()
+
+        asyncio.run(_main())
+
+
+if __name__ == '__main__':
+    unittest.main()
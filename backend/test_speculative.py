@@ -0,0 +1,182 @@
+"""PBL2.backend.test_speculative
+对 speculative.py 中投机生成的启动、裁剪、采用与丢弃进行单元测试。
+"""
+import asyncio
+import unittest
+from typing import Dict, List
+
+from langchain_core.messages import AIMessage
+
+from .speculative import SpeculativeRunner
+
+
+class _StubLLM:
+    """按 agent_id 返回预设回复的假模型；在 release() 之前一直等待，并记录被取消的调用。"""
+
+    def __init__(self, replies: Dict[str, AIMessage]):
+        self.replies = replies
+        self.calls: List[str] = []
+        self.cancelled: List[str] = []
+        self._gate = asyncio.Event()
+
+    def release(self) -> None:
+        self._gate.set()
+
+    async def ainvoke(self, agent_id: str) -> AIMessage:
+        self.calls.append(agent_id)
+        try:
+            await self._gate.wait()
+        except asyncio.CancelledError:
+            self.cancelled.append(agent_id)
+            raise
+        reply = self.replies[agent_id]
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+
+def _reply(content: str, finish_reason: str = "stop") -> AIMessage:
+    return AIMessage(content=content, response_metadata={"finish_reason": finish_reason})
+
+
+class TestSpeculativeRunner(unittest.TestCase):
+
+    def _replies(self, **overrides):
+        replies = {
+            "student_analyst": _reply("分析者的发言"),
+            "student_observer": _reply("观察者的发言"),
+            "student_skeptic": _reply("质疑者的发言"),
+        }
+        replies.update(overrides)
+        return replies
+
+    def test_take_committed_branch(self):
+        """只为前 max_branches 名候选人生成；采用被选中的一路，其余被取消。"""
+        async def _main():
+            runner = SpeculativeRunner(max_branches=2)
+            llm = _StubLLM(self._replies())
+            runner.start("t", "m1", ["student_analyst", "student_observer", "student_skeptic"], llm.ainvoke)
+            await asyncio.sleep(0)
+            llm.release()
+            return runner, llm, await runner.take("t", "student_analyst", "m1")
+
+        runner, llm, ai_msg = asyncio.run(_main())
+        self.assertEqual(ai_msg.content, "分析者的发言")
+        self.assertEqual(llm.calls, ["student_analyst", "student_observer"])
+        self.assertEqual(runner.stats, {"started": 2, "committed": 1, "cancelled": 1, "discarded": 0})
+
+    def test_keep_only_cancels_other_branches(self):
+        async def _main():
+            runner = SpeculativeRunner(max_branches=2)
+            llm = _StubLLM(self._replies())
+            runner.start("t", "m1", ["student_analyst", "student_observer"], llm.ainvoke)
+            await asyncio.sleep(0)
+            runner.keep_only("t", "student_observer")
+            await asyncio.sleep(0)
+            llm.release()
+            dropped = await runner.take("t", "student_analyst", "m1")
+            return runner, llm, dropped
+
+        runner, llm, dropped = asyncio.run(_main())
+        self.assertIsNone(dropped)
+        self.assertEqual(llm.cancelled, ["student_analyst", "student_observer"])
+        self.assertEqual(runner.stats["committed"], 0)
+
+    def test_keep_only_unknown_speaker_clears_thread(self):
+        """路由选中的学生没有投机分支时，全部分支被取消，之后的 take 正常生成。"""
+        async def _main():
+            runner = SpeculativeRunner(max_branches=2)
+            llm = _StubLLM(self._replies())
+            runner.start("t", "m1", ["student_analyst", "student_observer"], llm.ainvoke)
+            await asyncio.sleep(0)
+            runner.keep_only("t", "student_skeptic")
+            return runner, await runner.take("t", "student_skeptic", "m1")
+
+        runner, ai_msg = asyncio.run(_main())
+        self.assertIsNone(ai_msg)
+        self.assertEqual(runner.stats["cancelled"], 2)
+        self.assertNotIn("t", runner._pending)
+
+    def test_anchor_mismatch_is_rejected(self):
+        """投机开始后状态已前进（例如老师插话），基于旧消息生成的结果不被采用。"""
+        async def _main():
+            runner = SpeculativeRunner(max_branches=1)
+            llm = _StubLLM(self._replies())
+            runner.start("t", "m1", ["student_analyst"], llm.ainvoke)
+            await asyncio.sleep(0)
+            llm.release()
+            stale = await runner.take("t", "student_analyst", "m2")
+            await asyncio.sleep(0)
+            return runner, llm, stale
+
+        runner, llm, stale = asyncio.run(_main())
+        self.assertIsNone(stale)
+        self.assertEqual(llm.cancelled, ["student_analyst"])
+        self.assertEqual(runner.stats["discarded"], 1)
+        self.assertEqual(runner.stats["committed"], 0)
+
+    def test_result_is_used_at_most_once(self):
+        """结果被采用后即被移除；新的投机会取消同一会话尚未采用的分支。"""
+        async def _main():
+            runner = SpeculativeRunner(max_branches=1)
+            llm = _StubLLM(self._replies())
+            runner.start("t", "m1", ["student_analyst"], llm.ainvoke)
+            llm.release()
+            first = await runner.take("t", "student_analyst", "m1")
+            again = await runner.take("t", "student_analyst", "m1")
+            runner.start("t", "m2", ["student_observer"], llm.ainvoke)
+            runner.start("t", "m3", ["student_skeptic"], llm.ainvoke)
+            superseded = await runner.take("t", "student_observer", "m3")
+            return runner, first, again, superseded
+
+        runner, first, again, superseded = asyncio.run(_main())
+        self.assertEqual(first.content, "分析者的发言")
+        self.assertIsNone(again)
+        self.assertIsNone(superseded)
+        self.assertEqual(runner.stats["committed"], 1)
+
+    def test_truncated_reply_is_discarded(self):
+        """超出 token 预算被截断（finish_reason == "length"）的回复不采用。"""
+        async def _main():
+            runner = SpeculativeRunner(max_branches=1)
+            llm = _StubLLM(self._replies(student_analyst=_reply("分析者的发", finish_reason="length")))
+            runner.start("t", "m1", ["student_analyst"], llm.ainvoke)
+            llm.release()
+            return runner, await runner.take("t", "student_analyst", "m1")
+
+        runner, ai_msg = asyncio.run(_main())
+        self.assertIsNone(ai_msg)
+        self.assertEqual(runner.stats["discarded"], 1)
+
+    def test_failed_branch_is_discarded(self):
+        async def _main():
+            runner = SpeculativeRunner(max_branches=1)
+            llm = _StubLLM(self._replies(student_analyst=RuntimeError("503")))
+            runner.start("t", "m1", ["student_analyst"], llm.ainvoke)
+            llm.release()
+            return runner, await runner.take("t", "student_analyst", "m1")
+
+        runner, ai_msg = asyncio.run(_main())
+        self.assertIsNone(ai_msg)
+        self.assertEqual(runner.stats["discarded"], 1)
+
+    def test_cancel_stops_all_branches(self):
+        async def _main():
+            runner = SpeculativeRunner(max_branches=2)
+            llm = _StubLLM(self._replies())
+            runner.start("t", "m1", ["student_analyst", "student_observer"], llm.ainvoke)
+            runner.start("u", "m1", ["student_skeptic"], llm.ainvoke)
+            await asyncio.sleep(0)
+            runner.cancel("t")
+            await asyncio.sleep(0)
+            llm.release()
+            return runner, llm, await runner.take("t", "student_analyst", "m1"), await runner.take("u", "student_skeptic", "m1")
+
+        runner, llm, cancelled, other = asyncio.run(_main())
+        self.assertIsNone(cancelled)
+        self.assertEqual(sorted(llm.cancelled), ["student_analyst", "student_observer"])
+        self.assertEqual(other.content, "质疑者的发言")  # 其他会话不受影响
+
+
+if __name__ == '__main__':
+    unittest.main()
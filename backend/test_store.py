@@ -0,0 +1,98 @@
+"""PBL2.backend.test_store
+对 store.py 中共享会话存储的 persona 版本、事件流、控制通道与租约进行单元测试。
+"""
+import os
+import tempfile
+import unittest
+
+from .store import MemorySessionStore, SQLiteSessionStore
+
+
+class TestSQLiteSessionStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "sessions.sqlite")
+        self.store = SQLiteSessionStore(self.path, max_events=3)
+
+    def tearDown(self):
+        self.store.close()
+        self.tmpdir.cleanup()
+
+    def test_events_visible_to_other_workers(self):
+        """另一个 worker 打开同一文件即可读到事件，delta 在消息完成后被压缩。"""
+        self.store.append_events("s", [
+            {"type": "delta", "message_id": "m1", "delta": "胸", "seq": 1},
+            {"type": "delta", "message_id": "m1", "delta": "痛", "seq": 2},
+            {"type": "message_complete", "message_id": "m1", "content": "胸痛", "seq": 3},
+        ])
+        other = SQLiteSessionStore(self.path)
+        try:
+            self.assertEqual(other.last_seq("s"), 3)
+            self.assertEqual([f["seq"] for f in other.events_since("s", 0)], [3])
+            self.assertEqual(other.events_since("s", 3), [])
+            self.assertIsNone(other.events_since("s", 9))
+        finally:
+            other.close()
+
+    def test_gap_after_eviction_and_reset(self):
+        self.store.append_events("s", [{"type": "message_complete", "message_id": f"m{i}", "seq": i} for i in range(1, 6)])
+        self.assertIsNone(self.store.events_since("s", 1))
+        self.assertEqual([f["seq"] for f in self.store.events_since("s", 2)], [3, 4, 5])
+        self.store.reset_events("s", 5)
+        self.assertEqual(self.store.retained_events("s"), [])
+        self.assertIsNone(self.store.events_since("s", 4))
+        self.assertEqual(self.store.events_since("s", 5), [])
+
+    def test_lease_and_controls(self):
+        self.assertTrue(self.store.acquire_lease("s", "w1", ttl=30))
+        self.assertFalse(self.store.acquire_lease("s", "w2", ttl=30))
+        self.assertTrue(self.store.acquire_lease("s", "w1", ttl=30))  # 续约
+        self.assertEqual(self.store.lease_owner("s"), "w1")
+        self.store.release_lease("s", "w1")
+        self.assertIsNone(self.store.lease_owner("s"))
+        self.assertTrue(self.store.acquire_lease("s", "w2", ttl=0))
+        self.assertTrue(self.store.acquire_lease("s", "w1", ttl=30))  # 过期的租约可被接管
+
+        self.store.push_control("s", {"action": "teacher_intervention", "content": "看心电图"})
+        self.assertEqual(self.store.pop_controls("s"), [{"action": "teacher_intervention", "content": "看心电图"}])
+        self.assertEqual(self.store.pop_controls("s"), [])
+
+    def test_persona_versions(self):
+        self.assertEqual(self.store.save_personas({"a": {"x": 1}}), {"a": 1})
+        self.assertEqual(self.store.save_personas({"a": {"x": 2}}), {"a": 2})
+        # 会话快照只写入缺少的 persona，已有的保持不变
+        self.store.save_personas({"a": {"x": 9}}, "s")
+        snapshot = self.store.init_personas("s", {"a": {"x": 2}, "b": {"x": 3}})
+        self.assertEqual(snapshot, {"a": (1, {"x": 9}), "b": (1, {"x": 3})})
+        self.assertEqual(self.store.load_personas(), {"a": (2, {"x": 2})})
+        self.store.drop_personas("s")
+        self.assertEqual(self.store.load_personas("s"), {})
+        self.assertEqual(self.store.load_personas(), {"a": (2, {"x": 2})})
+
+
+
+class TestMemorySessionStore(unittest.TestCase):
+
+    def test_no_log_for_probed_sessions(self):
+        """只读查询不为会话创建日志；会话关闭后丢弃日志与控制命令，persona 快照保留到检查点被淘汰。"""
+        store = MemorySessionStore(max_events=3)
+        self.assertEqual(store.last_seq("probe"), 0)
+        self.assertEqual(store.events_since("probe", 0), [])
+        self.assertIsNone(store.events_since("probe", 2))
+        self.assertEqual(store.retained_events("probe"), [])
+        self.assertEqual(store._logs, {})
+
+        store.append_events("s", [{"type": "message_complete", "message_id": "m1", "seq": 1}])
+        store.push_control("s", {"action": "start_discussion"})
+        store.init_personas("s", {"a": {"x": 1}})
+        self.assertEqual(store.last_seq("s"), 1)
+        store.drop_session("s")
+        self.assertEqual(store.last_seq("s"), 0)
+        self.assertEqual((store._logs, store._controls), ({}, {}))
+        self.assertEqual(store.load_personas("s"), {"a": (1, {"x": 1})})
+        store.drop_personas("s")
+        self.assertEqual(store.load_personas("s"), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+"""PBL2.backend.test_summary_runner
+对后台摘要（summary_runner.py）及其合并逻辑进行单元测试。
+"""
+import asyncio
+import unittest
+
+from langchain_core.messages import AIMessage, HumanMessage, RemoveMessage
+
+from .agents import _fold_summary
+from .summary_runner import BackgroundSummarizer
+
+
+class TestBackgroundSummarizer(unittest.TestCase):
+
+    def test_collect_after_completion(self):
+        async def _main():
+            runner = BackgroundSummarizer()
+            gate = asyncio.Event()
+
+            async def _summary():
+                await gate.wait()
+                return "新摘要"
+
+            runner.start("t", "", "m3", _summary)
+            runner.start("t", "", "m4", _summary)  # 已有任务时忽略
+            self.assertIsNone(runner.collect("t", ""))  # 尚未完成
+            gate.set()
+            await asyncio.sleep(0)
+            job = runner.collect("t", "")
+            return runner, job
+
+        runner, job = asyncio.run(_main())
+        self.assertEqual(job.target_watermark, "m3")
+        self.assertEqual(job.task.result(), "新摘要")
+        self.assertEqual(runner.stats["started"], 1)
+        self.assertFalse(runner.running("t"))
+
+    def test_stale_result_is_discarded(self):
+        """任务启动后水位线已变化（会话被重置）时丢弃结果。"""
+        async def _main():
+            runner = BackgroundSummarizer()
+
+            async def _summary():
+                return "旧摘要"
+
+            runner.start("t", "m1", "m5", _summary)
+            await asyncio.sleep(0)
+            return runner, runner.collect("t", "")
+
+        runner, job = asyncio.run(_main())
+        self.assertIsNone(job)
+        self.assertEqual(runner.stats["discarded"], 1)
+
+    def test_fold_keeps_turns_after_watermark(self):
+        """摘要期间新到达的消息不会被删除，也不会被视为已摘要。"""
+        messages = [HumanMessage(content="病例", id="m0")] + [
+            AIMessage(content=f"发言{i}", id=f"m{i}") for i in range(1, 10)
+        ]
+        update = _fold_summary(messages, "摘要", "m5")
+        removed = [m.id for m in update["messages"]]
+        self.assertTrue(all(isinstance(m, RemoveMessage) for m in update["messages"]))
+        self.assertEqual(removed, ["m0", "m1", "m2", "m3", "m4", "m5"])
+        self.assertEqual(update["summary_watermark"], "m5")
+
+
+if __name__ == '__main__':
+    unittest.main()
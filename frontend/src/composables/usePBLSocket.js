@@ -4,20 +4,31 @@ import { ref, onUnmounted, nextTick } from 'vue';
  * @description 管理 PBL 讨论的 WebSocket 连接的组合式函数。
  * @param {string} sessionId - 讨论会话的唯一标识符。
  * @param {function} onScrollToBottom - 在接收到新消息后用于滚动聊天视图的回调函数。
+ * @param {object} [options]
+ * @param {string} [options.token] - 老师口令；不带口令（或口令错误）的连接只能观看讨论。
  */
-export function usePBLSocket(sessionId, onScrollToBottom) {
+export function usePBLSocket(sessionId, onScrollToBottom, options = {}) {
   // --- 响应式状态 ---
   const messages = ref([]);
   const isConnected = ref(false);
   const discussionStage = ref('等待开始'); // 初始阶段
+  // 预算用量：{ turns, tokens, seconds, limits, exhausted }
+  const budget = ref(null);
+  // 后端确认的连接角色：'teacher' 或 'observer'
+  const role = ref(null);
 
   let socket = null;
   let reconnectTimer = null;
   const reconnectInterval = 5000; // 5秒
+  // 已收到的最大帧序号；重连时带上，由后端补发断线期间错过的帧
+  let lastSeq = 0;
 
   // --- 私有方法 ---
   const connect = () => {
-    const url = `ws://127.0.0.1:8000/ws/pbl/${sessionId}`;
+    let url = `ws://127.0.0.1:8000/ws/pbl/${sessionId}?last_seq=${lastSeq}`;
+    if (options.token) {
+      url += `&token=${encodeURIComponent(options.token)}`;
+    }
     socket = new WebSocket(url);
 
     socket.onopen = () => {
@@ -28,13 +39,69 @@ export function usePBLSocket(sessionId, onScrollToBottom) {
 
     socket.onmessage = (event) => {
       const data = JSON.parse(event.data);
-      
-      if (data.node && data.content) {
-        messages.value.push({
-          id: Date.now() + Math.random(), // 简单的唯一ID
-          agent: data.node,
-          text: data.content,
-        });
+
+      if (data.seq !== undefined) {
+        // 补发与实时帧可能重叠，跳过已处理过的帧
+        // 快照的序号可能小于本地记录（例如后端重启），以快照为准
+        if (data.type === 'snapshot') {
+          lastSeq = data.seq;
+        } else if (data.seq <= lastSeq) {
+          return;
+        } else {
+          lastSeq = data.seq;
+        }
+      }
+
+      if (data.type === 'connected') {
+        role.value = data.role;
+      } else if (data.type === 'error') {
+        console.warn('后端错误:', data.message);
+      } else if (data.type === 'snapshot') {
+        // 错过的帧已无法补发：以后端检查点中的讨论内容为准
+        messages.value = data.messages.map((m) => ({
+          id: m.message_id,
+          agent: m.node,
+          text: m.content,
+        }));
+        budget.value = data.budget;
+        nextTick(() => onScrollToBottom());
+      } else if (data.type === 'budget') {
+        budget.value = data;
+        if (data.exhausted) {
+          discussionStage.value = '讨论总结';
+        }
+      } else if (data.type === 'discussion_started') {
+        // 新一轮讨论（可能由其他连接发起）
+        messages.value = [];
+      } else if (data.type === 'delta') {
+        // 增量 token：按 message_id 追加到同一条消息
+        const existing = messages.value.find((m) => m.id === data.message_id);
+        if (existing) {
+          existing.text += data.delta;
+        } else {
+          messages.value.push({
+            id: data.message_id,
+            agent: data.node,
+            text: data.delta,
+          });
+        }
+        nextTick(() => onScrollToBottom());
+      } else if (data.type === 'message_cancelled') {
+        // 老师插话抢占了正在生成的消息，移除未完成的部分
+        messages.value = messages.value.filter((m) => m.id !== data.message_id);
+      } else if (data.node && data.content) {
+        // 完整消息：若已通过 delta 渲染，则以最终内容覆盖
+        const id = data.message_id || Date.now() + Math.random(); // 简单的唯一ID
+        const existing = messages.value.find((m) => m.id === id);
+        if (existing) {
+          existing.text = data.content;
+        } else {
+          messages.value.push({
+            id,
+            agent: data.node,
+            text: data.content,
+          });
+        }
 
         // DOM 更新后自动滚动到底部
         nextTick(() => {
@@ -63,14 +130,17 @@ export function usePBLSocket(sessionId, onScrollToBottom) {
   /**
    * 通过向后端发送初始案例来开始 PBL 讨论。
    * @param {string} initialCase - 病例介绍文本。
+   * @param {object} [budgetOverrides] - 可选的预算覆盖，如 { max_turns: 20, max_seconds: 900 }。
    */
-  const startDiscussion = (initialCase) => {
+  const startDiscussion = (initialCase, budgetOverrides) => {
     if (socket && isConnected.value) {
       messages.value = []; // 清空之前的消息
+      budget.value = null;
       discussionStage.value = '初步诊断与鉴别诊断';
       socket.send(JSON.stringify({
         action: 'start_discussion',
         initial_case: initialCase,
+        budget: budgetOverrides,
       }));
     } else {
       console.error('WebSocket 未连接。');
@@ -83,14 +153,7 @@ export function usePBLSocket(sessionId, onScrollToBottom) {
    */
   const sendTeacherIntervention = (interventionText) => {
     if (socket && isConnected.value) {
-      // 为即时反馈，直接将老师的消息添加到聊天中
-      messages.value.push({
-        id: Date.now(),
-        agent: 'teacher',
-        text: interventionText,
-      });
-      nextTick(() => onScrollToBottom());
-
+      // 老师的消息由后端写入讨论后作为 message_complete 帧推送给所有连接（包括本连接）
       socket.send(JSON.stringify({
         action: 'teacher_intervention',
         content: interventionText,
@@ -116,6 +179,8 @@ export function usePBLSocket(sessionId, onScrollToBottom) {
     messages,
     isConnected,
     discussionStage,
+    budget,
+    role,
     startDiscussion,
     sendTeacherIntervention,
   };